@@ -0,0 +1,159 @@
+"""
+    Benchmark deep pagination of the dataset search on a synthetic SQLite DB.
+
+    Builds a DB with the relevant columns of tDataset, tMetadata and
+    tDatasetOwner (1M datasets by default) and compares:
+
+      * search_datasets as it is: load every matching row, then slice
+        out the page in python
+      * offset paging in SQL: LIMIT/OFFSET over the same joined query
+      * keyset paging, as done by search_datasets_by_cursor:
+        'id > cursor ORDER BY id LIMIT n' with EXISTS filters
+      * a metadata filter with and without idx_metadata_key_value
+
+    Only the standard library is needed:
+
+        python benchmarks/search_datasets_pagination.py [num_datasets] [db_path]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+PAGE_SIZE = 2000
+USER_ID = 1
+
+def build_db(path, num_datasets):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE tDataset (
+            id INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            type VARCHAR(60) NOT NULL,
+            unit_id INTEGER,
+            hash BIGINT NOT NULL UNIQUE,
+            cr_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            hidden VARCHAR(1) NOT NULL DEFAULT 'N',
+            created_by INTEGER,
+            value TEXT
+        );
+        CREATE TABLE tMetadata (
+            dataset_id INTEGER NOT NULL,
+            key VARCHAR(60) NOT NULL,
+            value VARCHAR(1000) NOT NULL,
+            PRIMARY KEY (dataset_id, key)
+        );
+        CREATE TABLE tDatasetOwner (
+            dataset_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (dataset_id, user_id)
+        );
+    """)
+
+    rnd = random.Random(42)
+    types = ['scalar', 'descriptor', 'array', 'timeseries']
+    sources = ['model_%s' % i for i in range(50)]
+
+    batch = 100000
+    for start in range(1, num_datasets + 1, batch):
+        ids = range(start, min(start + batch, num_datasets + 1))
+        conn.executemany(
+            "INSERT INTO tDataset (id, name, type, unit_id, hash, hidden, created_by, value)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((i, 'dataset %s' % i, types[i % 4], i % 100, i * 7919,
+              'Y' if i % 50 == 0 else 'N', 1 + i % 10, str(rnd.random()))
+             for i in ids))
+        conn.executemany(
+            "INSERT INTO tMetadata (dataset_id, key, value) VALUES (?, ?, ?)",
+            ((i, k, v) for i in ids for k, v in (('source', sources[i % 50]),
+                                                  ('user_id', str(1 + i % 10)))))
+        conn.executemany(
+            "INSERT INTO tDatasetOwner (dataset_id, user_id) VALUES (?, ?)",
+            ((i, 1 + (i // 50) % 10) for i in ids if i % 50 == 0))
+    conn.commit()
+    conn.execute("ANALYZE")
+    return conn
+
+OWNER_FILTER = """(d.hidden = 'N' OR EXISTS (SELECT 1 FROM tDatasetOwner o
+                                          WHERE o.dataset_id = d.id AND o.user_id = %s))""" % USER_ID
+
+JOINED_QRY = """SELECT d.id, d.type, d.unit_id, d.name, d.hidden, d.cr_date, d.created_by
+                FROM tDataset d
+                LEFT JOIN tDatasetOwner o ON o.dataset_id = d.id AND o.user_id = %s
+                WHERE (d.hidden = 'N' OR o.user_id IS NOT NULL)""" % USER_ID
+
+def python_page(conn, page_start):
+    return conn.execute(JOINED_QRY).fetchall()[page_start:page_start + PAGE_SIZE]
+
+def offset_page(conn, page_start):
+    qry = "%s LIMIT %s OFFSET %s" % (JOINED_QRY, PAGE_SIZE, page_start)
+    return conn.execute(qry).fetchall()
+
+def keyset_page(conn, after_id, extra_where=""):
+    qry = """SELECT d.id, d.type, d.unit_id, d.name, d.hidden, d.cr_date, d.created_by
+             FROM tDataset d
+             WHERE %s %s AND d.id > ?
+             ORDER BY d.id LIMIT %s""" % (OWNER_FILTER, extra_where, PAGE_SIZE + 1)
+    return conn.execute(qry, (after_id,)).fetchall()
+
+def count_matches(conn, extra_where=""):
+    qry = "SELECT count(d.id) FROM tDataset d WHERE %s %s" % (OWNER_FILTER, extra_where)
+    return conn.execute(qry).fetchone()[0]
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    elapsed = time.perf_counter() - start
+    print("%-60s %8.3fs" % (label, elapsed))
+    return res, elapsed
+
+def main():
+    num_datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+    else:
+        _, elapsed = timed("Building DB with %s datasets" % num_datasets,
+                           build_db, path, num_datasets)
+        conn = sqlite3.connect(path)
+
+    visible = count_matches(conn)
+    last_page_start = ((visible - 1) // PAGE_SIZE) * PAGE_SIZE
+
+    #The cursor a client would hold when asking for the last page.
+    cursor = conn.execute("SELECT d.id FROM tDataset d WHERE %s ORDER BY d.id"
+                          " LIMIT 1 OFFSET %s" % (OWNER_FILTER, last_page_start - 1)).fetchone()[0]
+
+    print("\n%s visible datasets, page size %s" % (visible, PAGE_SIZE))
+    timed("count_only", count_matches, conn)
+    timed("load all and slice, last page", python_page, conn, last_page_start)
+    timed("offset paging, first page", offset_page, conn, 0)
+    timed("offset paging, last page (offset %s)" % last_page_start, offset_page, conn, last_page_start)
+    timed("keyset paging, first page", keyset_page, conn, 0)
+    _, keyset_elapsed = timed("keyset paging, last page (after_id %s)" % cursor,
+                              keyset_page, conn, cursor)
+
+    metadata_where = """AND d.id IN (SELECT m.dataset_id FROM tMetadata m
+                                 WHERE m.key = 'source' AND m.value = 'model_7')"""
+
+    conn.execute("DROP INDEX IF EXISTS idx_metadata_key_value")
+    timed("metadata filter, count, no index", count_matches, conn, metadata_where)
+    timed("metadata filter, keyset deep page, no index",
+          keyset_page, conn, cursor // 2, metadata_where)
+
+    conn.execute("CREATE INDEX idx_metadata_key_value ON tMetadata (key, value, dataset_id)")
+    conn.execute("ANALYZE")
+    timed("metadata filter, count, with index", count_matches, conn, metadata_where)
+    _, metadata_elapsed = timed("metadata filter, keyset deep page, with index",
+                                keyset_page, conn, cursor // 2, metadata_where)
+
+    print("\nDeep keyset page under a second: %s" % (max(keyset_elapsed, metadata_elapsed) < 1))
+
+if __name__ == '__main__':
+    main()
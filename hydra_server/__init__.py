@@ -90,6 +90,8 @@ from hydra_server.server.service import AuthenticationService,\
     HydraServiceError,\
     HydraDocument
 from hydra_server.server.sharing import SharingService
+from hydra_server.lib import datasearch, validationstate, networkupload
+from hydra_server.lib.cache import run_pending_invalidations, discard_pending_updates
 from spyne.util.wsgi_wrapper import WsgiMounter
 import socket
 
@@ -159,6 +161,8 @@ def _on_method_context_closed(ctx):
     log.info("Closing session")
     close_session()
 
+    run_pending_invalidations()
+
 class HydraSoapApplication(Application):
     """
         Subclass of the base spyne Application class.
@@ -190,21 +194,25 @@ class HydraSoapApplication(Application):
         except ObjectNotFoundError as e:
             log.critical(e)
             rollback_transaction()
+            discard_pending_updates()
             raise
         except HydraError as e:
             log.critical(e)
             rollback_transaction()
+            discard_pending_updates()
             traceback.print_exc(file=sys.stdout)
             code = "HydraError %s"%e.code
             raise HydraServiceError(e.message, code)
         except Fault as e:
             log.critical(e)
             rollback_transaction()
+            discard_pending_updates()
             raise
         except Exception as e:
             log.critical(e)
             traceback.print_exc(file=sys.stdout)
             rollback_transaction()
+            discard_pending_updates()
             raise Fault('Server', e)
 
 class HydraServer():
@@ -213,6 +221,10 @@ class HydraServer():
 
         hb.connect(db_uri)
 
+        datasearch.create_indexes(hb.db.engine)
+        validationstate.create_tables(hb.db.engine)
+        networkupload.create_tables(hb.db.engine)
+
         #hdb.create_default_users_and_perms()
         #hdb.create_default_units_and_dimensions()
         #hdb.make_root_user()
@@ -0,0 +1,243 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    In-memory index of attributes, by ID and by name and dimension.
+
+    Importers resolve thousands of attributes by name, so rather than
+    one query per lookup, all the attributes are loaded in one query and
+    kept until an attribute is added, updated or deleted through the
+    attribute service.
+
+    Attributes can also be created elsewhere (template imports, cloning),
+    so a lookup which misses the index is checked against the DB, and if
+    the attribute is there, the index is reloaded.
+"""
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from hydra_base import db
+from hydra_base.db.model import Attr, Dimension
+from hydra_base.lib import attributes
+from hydra_base.lib.objects import JSONObject
+from hydra_base.exceptions import ResourceNotFoundError
+
+from .cache import Catalogue
+from .util import chunked
+from . import unitcatalogue
+
+log = logging.getLogger(__name__)
+
+#A plain tuple rather than a JSONObject, as JSONObject turns
+#numeric-looking names into numbers.
+AttrRow = namedtuple('AttrRow', ['id',
+                                 'name',
+                                 'dimension_id',
+                                 'dimension',
+                                 'description',
+                                 'cr_date',
+                                 'network_id',
+                                 'project_id'])
+
+def _get_key(name, dimension_id, network_id=None, project_id=None):
+    """
+        Attribute names are compared case-insensitively, as in hydra_base.
+    """
+    return (name.strip().lower(), dimension_id, network_id, project_id)
+
+class AttrIndex(object):
+    """
+        All the attributes, indexed for lookups.
+    """
+    def __init__(self, attrs):
+        self.attrs_by_id = {}
+        self.attrs_by_key = {}
+        for attr in attrs:
+            self.attrs_by_id[attr.id] = attr
+            #Lowest ID wins if names only differ by case, as with the
+            #.first() used by hydra_base.
+            self.attrs_by_key.setdefault(_get_key(attr.name,
+                                                  attr.dimension_id,
+                                                  attr.network_id,
+                                                  attr.project_id), attr)
+
+    @property
+    def global_attrs(self):
+        """
+            The attributes not scoped to a network or project, sorted by name.
+        """
+        global_attrs = [a for a in self.attrs_by_id.values()
+                        if a.network_id is None and a.project_id is None]
+        return sorted(global_attrs, key=lambda a: a.name)
+
+def _query_attrs():
+    return db.DBSession.query(Attr.id,
+                              Attr.name,
+                              Attr.dimension_id,
+                              Dimension.name.label('dimension'),
+                              Attr.description,
+                              Attr.cr_date,
+                              Attr.network_id,
+                              Attr.project_id).outerjoin(
+                                  Dimension, Dimension.id == Attr.dimension_id)
+
+def _make_row(row):
+    return AttrRow(row.id,
+                   row.name,
+                   row.dimension_id,
+                   row.dimension,
+                   row.description,
+                   str(row.cr_date),
+                   row.network_id,
+                   row.project_id)
+
+def _load():
+    attrs = [_make_row(row) for row in _query_attrs().order_by(Attr.id).all()]
+    log.info("Loaded %s attributes", len(attrs))
+    return AttrIndex(attrs)
+
+catalogue = Catalogue(_load)
+
+def get_index():
+    return catalogue.get()
+
+def invalidate():
+    catalogue.invalidate()
+
+def get_all_attributes():
+    return get_index().global_attrs
+
+def get_attributes_by_id(attr_ids):
+    """
+        Get attributes by ID, in the order requested.
+        IDs which don't exist are skipped.
+    """
+    index = get_index()
+    missing = set(a_id for a_id in attr_ids if a_id not in index.attrs_by_id)
+    for id_chunk in chunked(list(missing)):
+        found = db.DBSession.query(Attr.id).filter(Attr.id.in_(id_chunk)).first()
+        if found is not None:
+            log.info("Attributes missing from the index found in the DB. Reloading.")
+            invalidate()
+            index = get_index()
+            break
+
+    return [index.attrs_by_id[a_id] for a_id in attr_ids if a_id in index.attrs_by_id]
+
+def get_attribute_by_id(attr_id):
+    attrs = get_attributes_by_id([attr_id])
+    if len(attrs) == 0:
+        raise ResourceNotFoundError("Attribute (attribute id=%s) does not exist"%(attr_id))
+    return attrs[0]
+
+def _find_missing_keys(keys):
+    """
+        Check whether any of the keys which aren't in the index are in the DB,
+        using one query per chunk of names.
+    """
+    names = set(k[0] for k in keys)
+    for name_chunk in chunked(list(names)):
+        rows = db.DBSession.query(Attr.name,
+                                  Attr.dimension_id,
+                                  Attr.network_id,
+                                  Attr.project_id).filter(
+                                      func.lower(Attr.name).in_(name_chunk)).all()
+        for row in rows:
+            if _get_key(row.name, row.dimension_id, row.network_id, row.project_id) in keys:
+                return True
+    return False
+
+def resolve_keys(keys):
+    """
+        Look up attributes by (name, dimension_id, network_id, project_id).
+
+        Returns:
+            list: The AttrRow for each key, or None if there is no such attribute.
+    """
+    keys = [_get_key(*k) for k in keys]
+    index = get_index()
+    missing = set(k for k in keys if k not in index.attrs_by_key)
+    if missing and _find_missing_keys(missing):
+        log.info("Attributes missing from the index found in the DB. Reloading.")
+        invalidate()
+        index = get_index()
+
+    return [index.attrs_by_key.get(k) for k in keys]
+
+def get_attribute_by_name_and_dimension(name, dimension_id):
+    """
+        Get a global attribute by name and dimension.
+        Returns None if there is no such attribute.
+    """
+    return resolve_keys([(name, dimension_id)])[0]
+
+def _get_dimension_id(attr):
+    if attr.dimension_id is not None:
+        return attr.dimension_id
+    if attr.dimension is not None and attr.dimension.strip() != '':
+        return unitcatalogue.get_dimension_by_name(attr.dimension).id
+    return None
+
+def resolve_attributes(attrs, create_missing=False, **kwargs):
+    """
+        Resolve a list of attributes, identified by name and dimension
+        (as an ID or a dimension name), and optionally a network or project scope.
+
+        Args:
+            attrs (list): Objects with name, dimension_id or dimension,
+                network_id and project_id.
+            create_missing (bool): Add attributes which don't exist, using
+                hydra_base's add_attributes, so the usual permission checks apply.
+
+        Returns:
+            list: An AttrRow for each of the attributes, in the order given.
+                None for the ones which don't exist, if create_missing is False.
+    """
+    keys = []
+    for attr in attrs:
+        keys.append(_get_key(attr.name,
+                             _get_dimension_id(attr),
+                             attr.network_id,
+                             attr.project_id))
+
+    resolved = resolve_keys(keys)
+
+    if not create_missing or None not in resolved:
+        return resolved
+
+    #hydra_base can only add attributes for one scope at a time.
+    to_add = {}
+    for attr, key, attr_row in zip(attrs, keys, resolved):
+        if attr_row is not None:
+            continue
+        scope = (key[2], key[3])
+        scope_attrs = to_add.setdefault(scope, {})
+        if key not in scope_attrs:
+            scope_attrs[key] = JSONObject({'name'         : attr.name.strip(),
+                                           'dimension_id' : key[1],
+                                           'description'  : attr.description,
+                                           'network_id'   : key[2],
+                                           'project_id'   : key[3]})
+
+    for scope, scope_attrs in to_add.items():
+        log.info("Adding %s attributes", len(scope_attrs))
+        attributes.add_attributes(list(scope_attrs.values()), **kwargs)
+
+    invalidate()
+
+    return resolve_keys(keys)
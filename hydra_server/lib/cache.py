@@ -0,0 +1,212 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Process-wide caches used by the server.
+
+    The server handles requests on several threads, so everything here
+    is protected by a lock.
+
+    Caches of data which is changed by write RPCs must be invalidated with
+    invalidate_after_commit, rather than just cleared: another request may
+    reload the cache before the write is committed, which would put the
+    old data back in the cache.
+"""
+
+import uuid
+import threading
+from collections import OrderedDict
+
+_pending = threading.local()
+
+def invalidate_after_commit(callback):
+    """
+        Call 'callback' now, so the rest of this request sees the change,
+        and again once the request's transaction has been committed.
+    """
+    callback()
+    if not hasattr(_pending, 'callbacks'):
+        _pending.callbacks = []
+    _pending.callbacks.append(callback)
+
+def update_after_commit(callback):
+    """
+        Call 'callback' once the request's transaction has been committed,
+        but not if it is rolled back. For caches which are changed in place
+        rather than invalidated, where applying a change which was rolled
+        back would leave the cache wrong.
+    """
+    if not hasattr(_pending, 'updates'):
+        _pending.updates = []
+    _pending.updates.append(callback)
+
+def discard_pending_updates():
+    """
+        Forget the callbacks registered by update_after_commit during this
+        request. Called when the request's transaction is rolled back.
+    """
+    _pending.updates = []
+
+def run_pending_invalidations():
+    """
+        Run the callbacks registered by invalidate_after_commit and
+        update_after_commit during this request. Called after the request's
+        transaction has been closed.
+    """
+    callbacks = getattr(_pending, 'callbacks', []) + getattr(_pending, 'updates', [])
+    _pending.callbacks = []
+    _pending.updates = []
+    for callback in callbacks:
+        callback()
+
+class LRUCache(object):
+    """
+        A dictionary holding at most 'maxsize' items. When it is full, the
+        least recently used item is dropped.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+#Makes catalogue versions unique to this process, so a client holding a
+#version from before a restart doesn't match the reloaded catalogue.
+_process_token = uuid.uuid4().hex[:8]
+
+class Catalogue(object):
+    """
+        Data loaded from the DB in one go by 'loader' and kept until it is
+        invalidated. Every invalidation changes the version, so clients can
+        check whether their copy is out of date.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._data = None
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    @property
+    def version(self):
+        with self._lock:
+            return "%s.%s" % (_process_token, self._counter)
+
+    def get(self):
+        """
+            Get the data, loading it if necessary.
+        """
+        with self._lock:
+            if self._data is None:
+                self._data = self._loader()
+            return self._data
+
+    def get_with_version(self):
+        with self._lock:
+            return self.get(), self.version
+
+    def invalidate(self):
+        """
+            Drop the data and change the version, now and again after the
+            current transaction is committed.
+        """
+        invalidate_after_commit(self._invalidate)
+
+    def _invalidate(self):
+        with self._lock:
+            self._data = None
+            self._counter += 1
+
+class VersionedCache(object):
+    """
+        An LRUCache of items loaded by 'loader', one key at a time. As with
+        Catalogue, all the items are dropped when it is invalidated, and
+        every invalidation changes the version.
+    """
+
+    def __init__(self, loader, maxsize=128):
+        self._loader = loader
+        self._items = LRUCache(maxsize)
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    @property
+    def version(self):
+        with self._lock:
+            return "%s.%s" % (_process_token, self._counter)
+
+    def get(self, key):
+        """
+            Get an item, loading it if necessary.
+        """
+        item = self._items.get(key)
+        if item is not None:
+            return item
+
+        with self._lock:
+            counter = self._counter
+
+        #Load without holding the lock, so a slow load doesn't hold up
+        #requests for other items.
+        item = self._loader(key)
+
+        with self._lock:
+            #Don't keep an item loaded before an invalidation.
+            if counter == self._counter:
+                self._items.set(key, item)
+        return item
+
+    def invalidate(self):
+        """
+            Drop all the items and change the version, now and again after
+            the current transaction is committed.
+        """
+        invalidate_after_commit(self._invalidate)
+
+    def _invalidate(self):
+        with self._lock:
+            self._items.clear()
+            self._counter += 1
@@ -0,0 +1,305 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Content-addressed bulk insert of datasets.
+
+    Datasets are identified by their hash, so identical datasets only need
+    to be stored once. Model results contain lots of identical datasets
+    (zeros, flat timeseries), so the incoming datasets are de-duplicated
+    before they are parsed, all the hashes are resolved against the DB with
+    a few IN queries and only the new datasets are inserted, in a single
+    executemany. Values over hydra_base's size threshold go to external
+    storage first, as they do in hydra_base's bulk_insert_data.
+"""
+
+import copy
+import json
+import logging
+import datetime
+
+from sqlalchemy import and_
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Dataset, Metadata, DatasetOwner
+from hydra_base.util import generate_data_hash
+from hydra_base.lib.storage import MongoStorageAdapter
+
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+def _get_metadata_dict(dataset, user_id=None, source=None):
+    """
+        Get the metadata of an incoming dataset as a dict, with the user_id
+        and source added, exactly as hydra_base does when hashing.
+    """
+    if dataset.metadata is None or dataset.metadata == "":
+        metadata_dict = {}
+    elif isinstance(dataset.metadata, dict):
+        metadata_dict = dict(dataset.metadata)
+    else:
+        metadata_dict = json.loads(dataset.metadata)
+
+    metadata_keys = [k.lower() for k in metadata_dict]
+    if user_id is not None and 'user_id' not in metadata_keys:
+        metadata_dict[u'user_id'] = str(user_id)
+    if source is not None and 'source' not in metadata_keys:
+        metadata_dict[u'source'] = str(source)
+
+    return metadata_dict
+
+def _get_payload_key(dataset):
+    """
+        A key identifying the incoming dataset exactly as it was sent, so
+        repeated datasets can be recognised before they are parsed.
+    """
+    metadata = dataset.metadata
+    if isinstance(metadata, dict):
+        metadata = json.dumps(metadata, sort_keys=True)
+
+    return (dataset.type, dataset.unit_id, dataset.value, metadata)
+
+def _get_existing_data(hashes, user_id):
+    """
+        Find which of the given hashes are already in the DB.
+
+        Returns:
+            tuple(dict, set): {hash: dataset_id} of the datasets this user
+            can use and the set of hashes of the hidden datasets they cannot.
+    """
+    hash_id_map = {}
+    hidden = {}
+
+    for chunk in chunked(hashes):
+        rows = db.DBSession.query(Dataset.id,
+                                  Dataset.hash,
+                                  Dataset.hidden,
+                                  Dataset.created_by).filter(
+                                      Dataset.hash.in_(chunk)).all()
+        for r in rows:
+            if r.hidden == 'Y' and str(r.created_by) != str(user_id):
+                hidden[r.id] = r.hash
+            else:
+                hash_id_map[r.hash] = r.id
+
+    #Hidden datasets can still be used by users they've been shared with.
+    for chunk in chunked(hidden.keys()):
+        rows = db.DBSession.query(DatasetOwner.dataset_id).filter(
+                    and_(DatasetOwner.dataset_id.in_(chunk),
+                         DatasetOwner.user_id == user_id,
+                         DatasetOwner.view == 'Y')).all()
+        for r in rows:
+            dataset_hash = hidden.pop(r.dataset_id)
+            hash_id_map[dataset_hash] = r.dataset_id
+
+    return hash_id_map, set(hidden.values())
+
+def _get_ids_by_hash(hashes):
+    hash_id_map = {}
+    for chunk in chunked(hashes):
+        rows = db.DBSession.query(Dataset.id, Dataset.hash).filter(
+                    Dataset.hash.in_(chunk)).all()
+        for r in rows:
+            hash_id_map[r.hash] = r.id
+    return hash_id_map
+
+def get_value_location_key():
+    """
+        The metadata key which marks a dataset whose value is kept in
+        external storage rather than in tDataset.
+    """
+    return MongoStorageAdapter.get_mongo_config()["value_location_key"]
+
+def strip_storage_metadata(metadata):
+    """
+        Get a copy of a dataset's metadata without the external storage
+        location, for making a new dataset from an existing one. Whether the
+        new value is stored externally is decided when it's inserted.
+    """
+    loc_key = get_value_location_key()
+    return dict((k, v) for k, v in metadata.items() if k != loc_key)
+
+def _store_large_values(datasets):
+    """
+        Put the values which are over the size threshold in external storage,
+        as hydra_base's bulk_insert_data does, replacing each value with the
+        ID of the stored value and marking its location in the metadata.
+        The hashes are left as they are, as hydra_base does.
+
+        Returns:
+            list(dict): The datasets, with the large ones copied and changed
+    """
+    mongo_config = MongoStorageAdapter.get_mongo_config()
+    threshold_sz = mongo_config["threshold"]
+    loc_key = mongo_config["value_location_key"]
+    mongo_location_token = mongo_config["direct_location_token"]
+
+    large = [idx for idx, d in enumerate(datasets) if len(d['value']) > threshold_sz]
+    if len(large) == 0:
+        return datasets
+
+    mongo = MongoStorageAdapter()
+    inserted = mongo.bulk_insert_values([datasets[idx]['value'] for idx in large])
+
+    datasets = list(datasets)
+    for idx, object_id in zip(large, inserted.inserted_ids):
+        d = dict(datasets[idx])
+        d['value'] = str(object_id)
+        d['metadata'] = dict(d['metadata'])
+        d['metadata'][loc_key] = mongo_location_token
+        datasets[idx] = d
+
+    log.info("%s large values put in external storage", len(large))
+
+    return datasets
+
+def bulk_ingest_datasets(bulk_data, user_id=None, source=None):
+    """
+        Insert lots of datasets at once, re-using the datasets which are
+        already in the DB.
+
+        Args:
+            bulk_data (list(Dataset)): Incoming dataset complex models
+            user_id (int): The user adding the data. Added to the metadata.
+            source (string): The app adding the data. Added to the metadata.
+
+        Returns:
+            list(int): The dataset ID of each incoming dataset, in input order.
+            The entry is None if the dataset has no value.
+    """
+    start_time = datetime.datetime.now()
+
+    #payload key -> hash, so each distinct payload is parsed and hashed once
+    payload_hashes = {}
+    #hash -> the dataset to insert if it's not in the DB already
+    new_data = {}
+    input_hashes = []
+
+    for d in bulk_data:
+        payload_key = _get_payload_key(d)
+
+        if payload_key in payload_hashes:
+            input_hashes.append(payload_hashes[payload_key])
+            continue
+
+        val = d.parse_value()
+        if val is None:
+            log.info("Cannot parse data (dataset_id=%s). Value not available.", d.id)
+            payload_hashes[payload_key] = None
+            input_hashes.append(None)
+            continue
+
+        data_dict = {
+            'type'       : d.type,
+            'name'       : d.name[0:200] if d.name is not None else None,
+            'unit_id'    : d.unit_id,
+            'created_by' : user_id,
+            'value'      : val,
+            'metadata'   : _get_metadata_dict(d, user_id, source),
+        }
+        data_hash = generate_data_hash(data_dict)
+        data_dict['hash'] = data_hash
+
+        payload_hashes[payload_key] = data_hash
+        new_data.setdefault(data_hash, data_dict)
+        input_hashes.append(data_hash)
+
+    log.info("%s datasets reduced to %s distinct datasets in %s",
+             len(input_hashes), len(new_data), datetime.datetime.now() - start_time)
+
+    new_ids = insert_datasets(list(new_data.values()), user_id=user_id)
+    hash_id_map = dict(zip(new_data.keys(), new_ids))
+
+    return [hash_id_map.get(h) for h in input_hashes]
+
+def insert_datasets(data_dicts, user_id=None):
+    """
+        Insert datasets whose values have already been parsed, re-using the
+        datasets which are already in the DB.
+
+        Args:
+            data_dicts (list(dict)): The datasets, as dicts with 'type', 'name',
+                                     'unit_id', 'created_by', 'value' and 'metadata'.
+                                     The 'hash' is calculated if it's not there.
+            user_id (int): The user adding the data.
+
+        Returns:
+            list(int): The dataset ID of each dataset, in input order.
+    """
+    start_time = datetime.datetime.now()
+
+    new_data = {}
+    input_hashes = []
+    for data_dict in data_dicts:
+        if data_dict.get('hash') is None:
+            data_dict['hash'] = generate_data_hash(data_dict)
+        new_data.setdefault(data_dict['hash'], data_dict)
+        input_hashes.append(data_dict['hash'])
+
+    hash_id_map, unreadable = _get_existing_data(list(new_data.keys()), user_id)
+
+    #hash of the incoming dataset -> hash of the row to insert for it
+    insert_hashes = {}
+    to_insert = []
+    for data_hash, data_dict in new_data.items():
+        if data_hash in hash_id_map:
+            continue
+
+        if data_hash in unreadable:
+            #The user can't use the existing dataset, so make a new one with
+            #a unique hash by adding a unique piece of metadata.
+            data_dict = copy.deepcopy(data_dict)
+            data_dict['metadata']['created_at'] = datetime.datetime.now()
+            data_dict['hash'] = generate_data_hash(data_dict)
+
+        insert_hashes[data_hash] = data_dict['hash']
+        to_insert.append(data_dict)
+
+    if len(to_insert) > 0:
+        to_insert = _store_large_values(to_insert)
+
+        db.DBSession.execute(Dataset.__table__.insert(),
+                             [{'type'       : d['type'],
+                               'name'       : d['name'],
+                               'unit_id'    : d['unit_id'],
+                               'created_by' : d['created_by'],
+                               'value'      : d['value'],
+                               'hash'       : d['hash']} for d in to_insert])
+
+        new_ids = _get_ids_by_hash([d['hash'] for d in to_insert])
+
+        metadata_rows = []
+        for d in to_insert:
+            for k, v in d['metadata'].items():
+                metadata_rows.append({'dataset_id' : new_ids[d['hash']],
+                                      'key'        : str(k),
+                                      'value'      : str(v)})
+        if len(metadata_rows) > 0:
+            db.DBSession.execute(Metadata.__table__.insert(), metadata_rows)
+
+        #The transaction manager only commits sessions it knows have changed
+        mark_changed(db.DBSession())
+
+        for data_hash, inserted_hash in insert_hashes.items():
+            hash_id_map[data_hash] = new_ids[inserted_hash]
+
+    log.info("%s new datasets inserted, %s re-used in %s",
+             len(to_insert), len(new_data) - len(to_insert),
+             datetime.datetime.now() - start_time)
+
+    return [hash_id_map.get(h) for h in input_hashes]
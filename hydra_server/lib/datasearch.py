@@ -0,0 +1,267 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Keyset-paginated dataset search.
+
+    The search in hydra_base joins the filter tables onto tDataset, loads
+    every matching row and then slices the requested page out in python, so
+    the cost of a page grows with its offset. Here every filter is a
+    sub-query (so no duplicate rows are produced) and pages are
+    selected with 'id > cursor ORDER BY id LIMIT n', which the primary key
+    index answers directly however deep the page is.
+"""
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import and_, or_, not_, exists, select, func, Index
+
+from hydra_base import db
+from hydra_base import config
+from hydra_base.db.model import Dataset, Metadata, DatasetOwner,\
+        DatasetCollection, DatasetCollectionItem, ResourceScenario,\
+        ResourceAttr, TypeAttr
+
+from . import dataingest, metadatacache
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#Index used by the metadata filters: key -> value -> dataset id.
+#The value column is too wide for a full MySQL index, so use a prefix there.
+metadata_index = Index('idx_metadata_key_value',
+                       Metadata.key,
+                       Metadata.value,
+                       Metadata.dataset_id,
+                       mysql_length={'value': 255})
+
+DatasetRow = namedtuple('DatasetRow', ['id', 'type', 'unit_id', 'name',
+                                       'hidden', 'cr_date', 'created_by',
+                                       'hash', 'value', 'metadata'])
+
+def create_indexes(engine):
+    """
+        Create the indexes needed by the dataset search if they are not
+        already in the DB. Safe to call on every startup.
+    """
+    metadata_index.create(engine, checkfirst=True)
+
+def _get_filters(user_id,
+                 dataset_name=None,
+                 collection_name=None,
+                 data_type=None,
+                 unit_id=None,
+                 scenario_id=None,
+                 metadata_key=None,
+                 metadata_val=None,
+                 attr_id=None,
+                 type_id=None,
+                 unconnected=None):
+    """
+        Build the list of WHERE clauses for a dataset search.
+    """
+
+    filters = []
+
+    if dataset_name is not None:
+        filters.append(func.lower(Dataset.name).like("%%%s%%"%dataset_name.lower()))
+
+    if collection_name is not None:
+        filters.append(exists().where(and_(
+            DatasetCollectionItem.dataset_id == Dataset.id,
+            DatasetCollection.id == DatasetCollectionItem.collection_id,
+            func.lower(DatasetCollection.name).like("%%%s%%"%collection_name.lower()))))
+
+    if data_type is not None:
+        filters.append(func.lower(Dataset.type) == data_type.lower())
+
+    if unit_id is not None:
+        filters.append(Dataset.unit_id == unit_id)
+
+    if scenario_id is not None:
+        filters.append(exists().where(and_(
+            ResourceScenario.dataset_id == Dataset.id,
+            ResourceScenario.scenario_id == scenario_id)))
+
+    if attr_id is not None:
+        filters.append(exists().where(and_(
+            ResourceScenario.dataset_id == Dataset.id,
+            ResourceAttr.id == ResourceScenario.resource_attr_id,
+            ResourceAttr.attr_id == attr_id)))
+
+    if type_id is not None:
+        filters.append(exists().where(and_(
+            ResourceScenario.dataset_id == Dataset.id,
+            ResourceAttr.id == ResourceScenario.resource_attr_id,
+            TypeAttr.attr_id == ResourceAttr.attr_id,
+            TypeAttr.type_id == type_id)))
+
+    if unconnected == 'Y':
+        filters.append(not_(exists().where(ResourceScenario.dataset_id == Dataset.id)))
+    elif unconnected == 'N':
+        filters.append(exists().where(ResourceScenario.dataset_id == Dataset.id))
+
+    #Metadata filters are exact matches so the dataset IDs can be read
+    #straight out of metadata_index.
+    if metadata_key is not None or metadata_val is not None:
+        metadata_filters = []
+        if metadata_key is not None:
+            metadata_filters.append(Metadata.key == metadata_key)
+        if metadata_val is not None:
+            metadata_filters.append(Metadata.value == metadata_val)
+        filters.append(Dataset.id.in_(
+            select(Metadata.dataset_id).where(and_(*metadata_filters))))
+
+    #Only return datasets the user is allowed to see.
+    filters.append(or_(Dataset.hidden == 'N',
+                       exists().where(and_(DatasetOwner.dataset_id == Dataset.id,
+                                           DatasetOwner.user_id == user_id))))
+
+    return filters
+
+def _get_external_values(dataset_ids):
+    """
+        Get the values of those datasets which are held in external storage.
+        tDataset only holds a reference to where these are, so they are
+        loaded through the ORM, which resolves them.
+
+        Returns:
+            dict: The value of each externally stored dataset, keyed on ID
+    """
+    loc_key = dataingest.get_value_location_key()
+    values = {}
+    for chunk in chunked(dataset_ids):
+        external_ids = [r.dataset_id for r in db.DBSession.query(Metadata.dataset_id).filter(
+            Metadata.key == loc_key,
+            Metadata.dataset_id.in_(chunk))]
+        if len(external_ids) == 0:
+            continue
+        for dataset_i in db.DBSession.query(Dataset).filter(Dataset.id.in_(external_ids)):
+            values[dataset_i.id] = dataset_i.value
+    return values
+
+def search_datasets(user_id,
+                    dataset_name=None,
+                    collection_name=None,
+                    data_type=None,
+                    unit_id=None,
+                    scenario_id=None,
+                    metadata_key=None,
+                    metadata_val=None,
+                    attr_id=None,
+                    type_id=None,
+                    unconnected=None,
+                    inc_metadata='N',
+                    inc_val='N',
+                    after_id=None,
+                    page_size=None,
+                    count_only=False):
+    """
+        Search for datasets, one page at a time.
+
+        Args:
+            user_id (int): The user doing the search. Hidden datasets are only
+                           returned if this user owns them.
+            after_id (int): The cursor. Only datasets with an ID greater than
+                            this are returned. None for the first page.
+            page_size (int): The maximum number of datasets to return.
+            count_only (bool): Return only the number of matching datasets.
+
+            See search_datasets in hydra_base for the other filters.
+            metadata_key and metadata_val must match exactly.
+
+        Returns:
+            tuple(list(DatasetRow), int, int): The datasets in the page, the
+            cursor for the next page (None if this is the last page) and the
+            number of matching datasets (None unless count_only is set)
+    """
+
+    filters = _get_filters(int(user_id),
+                           dataset_name=dataset_name,
+                           collection_name=collection_name,
+                           data_type=data_type,
+                           unit_id=unit_id,
+                           scenario_id=scenario_id,
+                           metadata_key=metadata_key,
+                           metadata_val=metadata_val,
+                           attr_id=attr_id,
+                           type_id=type_id,
+                           unconnected=unconnected)
+
+    if count_only is True:
+        count = db.DBSession.query(func.count(Dataset.id)).filter(*filters).scalar()
+        log.info("%s datasets match the search", count)
+        return [], None, count
+
+    if page_size is None:
+        page_size = config.getint('SEARCH', 'page_size', 2000)
+
+    columns = [Dataset.id,
+               Dataset.type,
+               Dataset.unit_id,
+               Dataset.name,
+               Dataset.hidden,
+               Dataset.cr_date,
+               Dataset.created_by,
+               Dataset.hash]
+
+    if inc_val == 'Y':
+        columns.append(Dataset.value.label('value'))
+
+    dataset_qry = db.DBSession.query(*columns).filter(*filters)
+
+    if after_id is not None:
+        dataset_qry = dataset_qry.filter(Dataset.id > after_id)
+
+    #Fetch one extra row to find out whether there is another page.
+    rows = dataset_qry.order_by(Dataset.id).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = rows[-1].id
+
+    metadata = {}
+    if inc_metadata == 'Y':
+        metadata = metadatacache.get_metadata([r.id for r in rows],
+                                               dict((r.id, r.hash) for r in rows))
+
+    external_values = {}
+    if inc_val == 'Y':
+        external_values = _get_external_values([r.id for r in rows])
+
+    datasets = []
+    for r in rows:
+        value = None
+        if inc_val == 'Y':
+            value = external_values.get(r.id, r.value)
+            if value is not None:
+                value = str(value)
+        datasets.append(DatasetRow(id=r.id,
+                                   type=r.type,
+                                   unit_id=r.unit_id,
+                                   name=r.name,
+                                   hidden=r.hidden,
+                                   cr_date=r.cr_date,
+                                   created_by=r.created_by,
+                                   hash=r.hash,
+                                   value=value,
+                                   metadata=metadata.get(r.id)))
+
+    log.info("Retrieved %s datasets after cursor %s", len(datasets), after_id)
+
+    return datasets, next_cursor, None
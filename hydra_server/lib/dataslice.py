@@ -0,0 +1,224 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Retrieval of parts of large array, dataframe and timeseries datasets.
+
+    Values are stored as JSON, so the whole value has to be decoded once to
+    get any part of it. The decoded value is kept in a cache keyed on the
+    dataset ID and hash (the hash changes whenever the value does), so
+    subsequent slices of the same dataset don't touch the value in the DB.
+"""
+
+import json
+import logging
+import collections
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import and_, or_, exists
+
+from hydra_base import db
+from hydra_base import config
+from hydra_base.db.model import Dataset, DatasetOwner
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import LRUCache
+from .datasearch import DatasetRow
+
+log = logging.getLogger(__name__)
+
+#(dataset_id, hash) -> decoded value
+decoded_values = LRUCache(config.getint('hydra_server', 'dataset_cache_size', 16))
+
+def _get_dataset_row(dataset_id, user_id):
+    """
+        Get everything but the value of a dataset, checking that the
+        user is allowed to see it.
+    """
+    row = db.DBSession.query(Dataset.id,
+                             Dataset.type,
+                             Dataset.unit_id,
+                             Dataset.name,
+                             Dataset.hidden,
+                             Dataset.cr_date,
+                             Dataset.created_by,
+                             Dataset.hash).filter(
+                                 Dataset.id == dataset_id,
+                                 or_(Dataset.hidden == 'N',
+                                     Dataset.created_by == user_id,
+                                     exists().where(and_(DatasetOwner.dataset_id == Dataset.id,
+                                                         DatasetOwner.user_id == user_id,
+                                                         DatasetOwner.view == 'Y')))).first()
+    if row is None:
+        raise ResourceNotFoundError("Dataset %s not found"%(dataset_id,))
+
+    return row
+
+def _decode_value(data_type, value):
+    """
+        Decode a JSON value into a numpy array (arrays) or a dataframe
+        (dataframes and timeseries). Other types are returned as they are.
+    """
+    data_type = data_type.lower()
+
+    if data_type == 'array':
+        #Newer versions of numpy refuse to make an array from ragged lists,
+        #while older ones make an array of objects.
+        try:
+            arr = np.array(json.loads(value))
+        except ValueError:
+            raise HydraError("Array is not rectangular, so cannot be sliced.")
+        if arr.dtype == object:
+            raise HydraError("Array is not rectangular, so cannot be sliced.")
+        return arr
+    elif data_type in ('timeseries', 'dataframe'):
+        jo = json.loads(value, object_pairs_hook=collections.OrderedDict)
+        df = pd.DataFrame.from_dict(jo)
+        df.index = df.index.astype(str)
+        if data_type == 'timeseries':
+            #A parallel index of real timestamps, to select date windows with.
+            #Seasonal timeseries use a year pandas can't handle, so swap it.
+            seasonal_year = config.get('DEFAULT', 'seasonal_year', '1678')
+            seasonal_key = config.get('DEFAULT', 'seasonal_key', '9999')
+            times = pd.to_datetime([t.replace(seasonal_key, seasonal_year) for t in df.index])
+            return df, times
+        return df, None
+
+    return value
+
+def _get_decoded_value(dataset_row):
+    key = (dataset_row.id, dataset_row.hash)
+    decoded = decoded_values.get(key)
+    if decoded is None:
+        #Load the value through the ORM so values held in external
+        #storage are resolved as usual.
+        dataset_i = db.DBSession.query(Dataset).filter(Dataset.id == dataset_row.id).one()
+        decoded = _decode_value(dataset_row.type, dataset_i.value)
+        decoded_values.set(key, decoded)
+    return decoded
+
+def _parse_index_slice(index_slice):
+    """
+        Turn a numpy-style index string, such as '0:10' or '2, 5:, ::2',
+        into something which can be used to index an array.
+    """
+    index = []
+    for part in index_slice.split(','):
+        part = part.strip()
+        if part.find(':') >= 0:
+            bounds = [int(b) if b.strip() != '' else None for b in part.split(':')]
+            if len(bounds) > 3:
+                raise HydraError("Invalid index slice: %s"%(index_slice,))
+            index.append(slice(*bounds))
+        else:
+            index.append(int(part))
+    return tuple(index)
+
+def _get_timestamp(time):
+    seasonal_year = config.get('DEFAULT', 'seasonal_year', '1678')
+    seasonal_key = config.get('DEFAULT', 'seasonal_key', '9999')
+    return pd.Timestamp(time.replace(seasonal_key, seasonal_year))
+
+def get_slice(decoded, data_type, columns=None, start=None, end=None, index_slice=None):
+    """
+        Get part of a decoded value, as a JSON string in the same format as
+        the dataset value.
+    """
+    data_type = data_type.lower()
+
+    if data_type == 'array':
+        if index_slice is None:
+            return json.dumps(decoded.tolist())
+        try:
+            sliced = decoded[_parse_index_slice(index_slice)]
+        except (IndexError, ValueError) as e:
+            raise HydraError("Invalid index slice %s: %s"%(index_slice, e))
+        if isinstance(sliced, np.ndarray):
+            return json.dumps(sliced.tolist())
+        return json.dumps(sliced.item())
+
+    if data_type not in ('timeseries', 'dataframe'):
+        #Scalars and descriptors are small, so there's nothing to slice.
+        return decoded
+
+    df, times = decoded
+
+    if columns:
+        missing = [c for c in columns if c not in df.columns]
+        if len(missing) > 0:
+            raise HydraError("Columns %s not found."%(missing,))
+        df = df[columns]
+
+    if times is not None and (start is not None or end is not None):
+        mask = np.ones(len(df.index), dtype=bool)
+        if start is not None:
+            mask &= np.asarray(times >= _get_timestamp(start))
+        if end is not None:
+            mask &= np.asarray(times <= _get_timestamp(end))
+        df = df[mask]
+
+    if index_slice is not None:
+        try:
+            rows = _parse_index_slice(index_slice)
+        except (IndexError, ValueError) as e:
+            raise HydraError("Invalid index slice %s: %s"%(index_slice, e))
+        if len(rows) != 1 or not isinstance(rows[0], slice):
+            raise HydraError("Only a single row slice, such as '0:10', can be used on a %s"%(data_type,))
+        try:
+            df = df.iloc[rows[0]]
+        except (IndexError, ValueError) as e:
+            raise HydraError("Invalid index slice %s: %s"%(index_slice, e))
+
+    return df.to_json()
+
+def get_dataset_slice(dataset_id, user_id, columns=None, start=None, end=None, index_slice=None):
+    """
+        Get part of a dataset.
+
+        Args:
+            dataset_id (int): The dataset
+            user_id (int): The user requesting it
+            columns (list(string)): Dataframe and timeseries columns to return
+            start (string): Timeseries only. Return values from this time onwards
+            end (string): Timeseries only. Return values up to and including this time.
+            index_slice (string): For arrays, a numpy-style index such as '0:10, 2'.
+                                  For dataframes and timeseries, a row range such as '0:10'
+
+        Returns:
+            DatasetRow: The dataset, with the slice as its value.
+    """
+    dataset_row = _get_dataset_row(dataset_id, user_id)
+
+    decoded = _get_decoded_value(dataset_row)
+
+    value = get_slice(decoded, dataset_row.type,
+                      columns=columns,
+                      start=start,
+                      end=end,
+                      index_slice=index_slice)
+
+    return DatasetRow(id=dataset_row.id,
+                      type=dataset_row.type,
+                      unit_id=dataset_row.unit_id,
+                      name=dataset_row.name,
+                      hidden=dataset_row.hidden,
+                      cr_date=dataset_row.cr_date,
+                      created_by=dataset_row.created_by,
+                      hash=dataset_row.hash,
+                      value=value,
+                      metadata=None)
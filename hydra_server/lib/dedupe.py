@@ -0,0 +1,620 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Jobs to clean up duplicate attributes and duplicate resource attributes.
+
+    The duplicates are found with GROUP BY queries, then dealt with a
+    batch of duplicate groups at a time, using set-based updates and
+    deletes. The transaction is committed after each batch, so locks on
+    tResourceAttr are only held for the length of a batch, and a job
+    which is stopped part way through keeps the batches it has done.
+    Running a job again picks up whatever is left.
+
+    With dry_run, the same plan is made for each batch but nothing is
+    changed, so the report shows what would be done.
+"""
+
+import logging
+import datetime
+
+import transaction
+from sqlalchemy import and_, or_, func, bindparam, select
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Attr, AttrMap, AttrGroupItem, ResourceAttr, ResourceAttrMap,\
+                                ResourceScenario, ResourceType, TypeAttr, Network, Node, Link, ResourceGroup
+from hydra_base.exceptions import ResourceNotFoundError
+from hydra_base.lib.cache import cache as hydra_cache
+from hydra_base.util.permissions import required_perms
+
+from .util import chunked
+from .resourceattrs import ref_key_columns, network_resources
+from . import attrindex
+from . import mappinggraph
+from . import templatecache
+
+log = logging.getLogger(__name__)
+
+ra_table = ResourceAttr.__table__
+rs_table = ResourceScenario.__table__
+
+#The columns identifying the resource a resource attribute is on
+_ra_key_columns = [ResourceAttr.ref_key] + [getattr(ResourceAttr, c) for c in ref_key_columns.values()]
+
+class CleanupReport(object):
+    """
+        Progress of a cleanup job, returned to the client as a dict.
+    """
+    def __init__(self, job, dry_run, groups_found):
+        self.job = job
+        self.dry_run = dry_run
+        self.groups_found = groups_found
+        self.groups_processed = 0
+        self.batches = 0
+        self.rows = {}
+        self.groups = []
+        self.start_time = datetime.datetime.now()
+
+    def add_rows(self, counts):
+        for k, v in counts.items():
+            self.rows[k] = self.rows.get(k, 0) + v
+
+    def batch_done(self, groups):
+        self.batches += 1
+        self.groups_processed += len(groups)
+        log.info("%s: batch %s done. %s of %s duplicate groups processed in %s",
+                 self.job, self.batches, self.groups_processed, self.groups_found,
+                 datetime.datetime.now() - self.start_time)
+
+    def as_dict(self):
+        return {'job'              : self.job,
+                'dry_run'          : 'Y' if self.dry_run else 'N',
+                'groups_found'     : self.groups_found,
+                'groups_processed' : self.groups_processed,
+                'remaining_groups' : self.groups_found - self.groups_processed,
+                'complete'         : 'Y' if self.groups_processed == self.groups_found else 'N',
+                'batches'          : self.batches,
+                'rows'             : self.rows,
+                'groups'           : self.groups}
+
+def _commit_batch():
+    """
+        Commit the batch, so its locks are released. transaction.commit() is
+        used rather than hydra_base's commit_transaction, as that hides errors.
+    """
+    mark_changed(db.DBSession())
+    transaction.commit()
+
+def _run_batches(report, groups, batch_size, max_batches, plan_batch, apply_plan):
+    """
+        Plan each batch of groups and, unless this is a dry run, apply
+        the plan and commit.
+    """
+    for batch_num, batch in enumerate(chunked(groups, batch_size)):
+        if max_batches is not None and batch_num >= max_batches:
+            break
+        plan = plan_batch(batch)
+        report.add_rows(plan['counts'])
+        report.groups.extend(plan['groups'])
+        if not report.dry_run:
+            apply_plan(plan)
+            _commit_batch()
+        report.batch_done(batch)
+
+    return report.as_dict()
+
+def _get_ref_id(ra):
+    return getattr(ra, ref_key_columns[ra.ref_key])
+
+def _clear_network_caches(ref_ids_by_key):
+    """
+        hydra_base caches the resource attributes of each network, so clear
+        the cache of every network containing the resources.
+    """
+    network_ids = set(ref_ids_by_key.get('NETWORK', []))
+    for ref_key, resource_class in network_resources.items():
+        for id_chunk in chunked(ref_ids_by_key.get(ref_key, [])):
+            rows = db.DBSession.query(resource_class.network_id).filter(
+                resource_class.id.in_(id_chunk)).distinct().all()
+            network_ids.update(r.network_id for r in rows)
+
+    for network_id in network_ids:
+        hydra_cache.delete('network_resource_attributes_%s'%(network_id))
+
+def _get_scenario_ids(ra_ids):
+    """
+        Returns:
+            dict: The IDs of the scenarios with data for each resource attribute.
+    """
+    scenario_ids = {}
+    for id_chunk in chunked(ra_ids):
+        rows = db.DBSession.query(ResourceScenario.resource_attr_id,
+                                  ResourceScenario.scenario_id).filter(
+                                      ResourceScenario.resource_attr_id.in_(id_chunk)).all()
+        for row in rows:
+            scenario_ids.setdefault(row.resource_attr_id, set()).add(row.scenario_id)
+    return scenario_ids
+
+def _plan_merge(merges, scenario_ids):
+    """
+        Work out which resource scenarios move when resource attribute 'old'
+        is merged into 'new': the ones in scenarios which 'new' has no data for.
+        The rest are deleted with the old resource attribute.
+
+        Args:
+            merges (list): (old_ra_id, new_ra_id) tuples
+            scenario_ids (dict): As returned by _get_scenario_ids, for old and new
+
+        Returns:
+            list: dicts for the resource scenario update
+    """
+    rs_moves = []
+    for old_ra_id, new_ra_id in merges:
+        new_scenarios = scenario_ids.setdefault(new_ra_id, set())
+        for scenario_id in scenario_ids.get(old_ra_id, set()):
+            if scenario_id not in new_scenarios:
+                rs_moves.append({'b_scenario_id' : scenario_id,
+                                 'b_old_ra_id'   : old_ra_id,
+                                 'b_new_ra_id'   : new_ra_id})
+                new_scenarios.add(scenario_id)
+    return rs_moves
+
+def _delete_resource_attributes(ra_ids, rs_moves):
+    """
+        Move the resource scenarios in 'rs_moves', then delete the resource
+        attributes along with their remaining data and mappings.
+    """
+    if len(rs_moves) > 0:
+        db.DBSession.execute(rs_table.update().where(and_(
+            rs_table.c.scenario_id == bindparam('b_scenario_id'),
+            rs_table.c.resource_attr_id == bindparam('b_old_ra_id'))).values(
+                resource_attr_id=bindparam('b_new_ra_id')), rs_moves)
+
+    map_table = ResourceAttrMap.__table__
+    for id_chunk in chunked(ra_ids):
+        db.DBSession.execute(map_table.delete().where(or_(
+            map_table.c.resource_attr_id_a.in_(id_chunk),
+            map_table.c.resource_attr_id_b.in_(id_chunk))))
+        db.DBSession.execute(rs_table.delete().where(rs_table.c.resource_attr_id.in_(id_chunk)))
+        db.DBSession.execute(ra_table.delete().where(ra_table.c.id.in_(id_chunk)))
+
+    if len(ra_ids) > 0:
+        mappinggraph.invalidate()
+
+#
+# Duplicate attributes
+#
+
+def find_duplicate_attributes():
+    """
+        Find attributes with the same name, dimension and scope. These
+        can be added because MySQL's unique constraints allow repeated
+        NULLs, and the dimension, network and project can all be NULL.
+
+        Returns:
+            list: A dict for each set of duplicates, with the ID of the attribute
+                to keep (the oldest) and the IDs of the ones to remove.
+    """
+    dupe_names = db.DBSession.query(Attr.name).group_by(
+        Attr.name, Attr.dimension_id, Attr.network_id, Attr.project_id).having(
+            func.count(Attr.id) > 1).distinct().all()
+
+    attrs_by_key = {}
+    for name_chunk in chunked([n.name for n in dupe_names]):
+        rows = db.DBSession.query(Attr.id,
+                                  Attr.name,
+                                  Attr.dimension_id,
+                                  Attr.network_id,
+                                  Attr.project_id).filter(Attr.name.in_(name_chunk)).all()
+        for row in rows:
+            key = (row.name, row.dimension_id, row.network_id, row.project_id)
+            attrs_by_key.setdefault(key, []).append(row.id)
+
+    groups = []
+    for key, attr_ids in attrs_by_key.items():
+        if len(attr_ids) < 2:
+            continue
+        attr_ids = sorted(attr_ids)
+        groups.append({'name'         : key[0],
+                       'dimension_id' : key[1],
+                       'network_id'   : key[2],
+                       'project_id'   : key[3],
+                       'keep'         : attr_ids[0],
+                       'remove'       : attr_ids[1:]})
+
+    return sorted(groups, key=lambda g: g['keep'])
+
+def _plan_resource_attr_remap(remap):
+    """
+        Resource attributes of the attributes being removed are pointed at
+        the attribute being kept, unless the resource already has that
+        attribute, in which case the two are merged.
+    """
+    old_ras = []
+    for id_chunk in chunked(list(remap.keys())):
+        old_ras.extend(db.DBSession.query(ResourceAttr.id, ResourceAttr.attr_id, *_ra_key_columns).filter(
+            ResourceAttr.attr_id.in_(id_chunk)).order_by(ResourceAttr.id).all())
+
+    ref_ids_by_key = {}
+    for ra in old_ras:
+        ref_ids_by_key.setdefault(ra.ref_key, set()).add(_get_ref_id(ra))
+
+    keeper_ids = list(set(remap.values()))
+    existing = {}
+    for ref_key, ref_ids in ref_ids_by_key.items():
+        ref_col = getattr(ResourceAttr, ref_key_columns[ref_key])
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(ResourceAttr.id, ResourceAttr.attr_id, *_ra_key_columns).filter(
+                ResourceAttr.ref_key == ref_key,
+                ref_col.in_(id_chunk),
+                ResourceAttr.attr_id.in_(keeper_ids)).all()
+            for ra in rows:
+                existing[(ref_key, _get_ref_id(ra), ra.attr_id)] = ra.id
+
+    updates = []
+    merges = []
+    for ra in old_ras:
+        key = (ra.ref_key, _get_ref_id(ra), remap[ra.attr_id])
+        if key in existing:
+            merges.append((ra.id, existing[key]))
+        else:
+            updates.append({'b_id' : ra.id, 'b_attr_id' : remap[ra.attr_id]})
+            existing[key] = ra.id
+
+    scenario_ids = _get_scenario_ids([m[0] for m in merges] + [m[1] for m in merges])
+    rs_moves = _plan_merge(merges, scenario_ids)
+
+    return {'ra_updates'     : updates,
+            'ra_deletes'     : [m[0] for m in merges],
+            'rs_moves'       : rs_moves,
+            'rs_deletes'     : sum(len(scenario_ids.get(m[0], [])) for m in merges) - len(rs_moves),
+            'ref_ids_by_key' : ref_ids_by_key}
+
+def _plan_type_attr_remap(remap):
+    """
+        Type attributes of the attributes being removed are pointed at the
+        attribute being kept, unless the type already has it, in which case
+        they are deleted, and any child type attributes are re-parented.
+    """
+    old_tas = []
+    for id_chunk in chunked(list(remap.keys())):
+        old_tas.extend(db.DBSession.query(TypeAttr.id, TypeAttr.type_id, TypeAttr.attr_id).filter(
+            TypeAttr.attr_id.in_(id_chunk)).order_by(TypeAttr.id).all())
+
+    existing = {}
+    for id_chunk in chunked(list(set(ta.type_id for ta in old_tas))):
+        rows = db.DBSession.query(TypeAttr.id, TypeAttr.type_id, TypeAttr.attr_id).filter(
+            TypeAttr.type_id.in_(id_chunk),
+            TypeAttr.attr_id.in_(list(set(remap.values())))).all()
+        for ta in rows:
+            existing[(ta.type_id, ta.attr_id)] = ta.id
+
+    updates = []
+    deletes = []
+    reparents = []
+    for ta in old_tas:
+        key = (ta.type_id, remap[ta.attr_id])
+        if key in existing:
+            deletes.append(ta.id)
+            reparents.append({'b_old_parent_id' : ta.id, 'b_new_parent_id' : existing[key]})
+        else:
+            updates.append({'b_id' : ta.id, 'b_attr_id' : remap[ta.attr_id]})
+            existing[key] = ta.id
+
+    return {'ta_updates' : updates, 'ta_deletes' : deletes, 'ta_reparents' : reparents}
+
+def _plan_small_table_remap(remap):
+    """
+        Attribute group items and attribute maps. These tables are small,
+        so they are remapped row by row.
+    """
+    item_updates = []
+    item_deletes = []
+    old_items = db.DBSession.query(AttrGroupItem.group_id,
+                                   AttrGroupItem.attr_id,
+                                   AttrGroupItem.network_id).filter(
+                                       AttrGroupItem.attr_id.in_(list(remap.keys()))).all()
+    existing_items = set(db.DBSession.query(AttrGroupItem.group_id,
+                                            AttrGroupItem.attr_id,
+                                            AttrGroupItem.network_id).filter(
+                                                AttrGroupItem.attr_id.in_(list(set(remap.values())))).all())
+    for item in old_items:
+        old_key = (item.group_id, item.attr_id, item.network_id)
+        new_key = (item.group_id, remap[item.attr_id], item.network_id)
+        if new_key in existing_items:
+            item_deletes.append(old_key)
+        else:
+            item_updates.append((old_key, new_key))
+            existing_items.add(new_key)
+
+    map_updates = []
+    map_deletes = []
+    old_maps = db.DBSession.query(AttrMap.attr_id_a, AttrMap.attr_id_b).filter(or_(
+        AttrMap.attr_id_a.in_(list(remap.keys())),
+        AttrMap.attr_id_b.in_(list(remap.keys())))).all()
+    existing_maps = set(tuple(m) for m in db.DBSession.query(AttrMap.attr_id_a, AttrMap.attr_id_b).filter(or_(
+        AttrMap.attr_id_a.in_(list(set(remap.values()))),
+        AttrMap.attr_id_b.in_(list(set(remap.values()))))).all())
+    for attr_map in old_maps:
+        old_key = (attr_map.attr_id_a, attr_map.attr_id_b)
+        new_key = (remap.get(old_key[0], old_key[0]), remap.get(old_key[1], old_key[1]))
+        if new_key in existing_maps or new_key[0] == new_key[1]:
+            map_deletes.append(old_key)
+        else:
+            map_updates.append((old_key, new_key))
+            existing_maps.add(new_key)
+
+    return {'item_updates' : item_updates, 'item_deletes' : item_deletes,
+            'map_updates'  : map_updates,  'map_deletes'  : map_deletes}
+
+def _plan_attribute_batch(groups):
+    remap = {}
+    for group in groups:
+        for attr_id in group['remove']:
+            remap[attr_id] = group['keep']
+
+    plan = {'attr_deletes' : list(remap.keys()), 'groups' : groups}
+    plan.update(_plan_resource_attr_remap(remap))
+    plan.update(_plan_type_attr_remap(remap))
+    plan.update(_plan_small_table_remap(remap))
+
+    plan['counts'] = {
+        'attributes_deleted'             : len(plan['attr_deletes']),
+        'resource_attributes_remapped'   : len(plan['ra_updates']),
+        'resource_attributes_merged'     : len(plan['ra_deletes']),
+        'resource_scenarios_moved'       : len(plan['rs_moves']),
+        'resource_scenarios_deleted'     : plan['rs_deletes'],
+        'type_attributes_remapped'       : len(plan['ta_updates']),
+        'type_attributes_deleted'        : len(plan['ta_deletes']),
+        'attribute_group_items_remapped' : len(plan['item_updates']) + len(plan['item_deletes']),
+        'attribute_maps_remapped'        : len(plan['map_updates']) + len(plan['map_deletes']),
+    }
+    return plan
+
+def _apply_attribute_plan(plan):
+    if len(plan['ra_updates']) > 0:
+        db.DBSession.execute(ra_table.update().where(ra_table.c.id == bindparam('b_id')).values(
+            attr_id=bindparam('b_attr_id')), plan['ra_updates'])
+    _delete_resource_attributes(plan['ra_deletes'], plan['rs_moves'])
+
+    ta_table = TypeAttr.__table__
+    if len(plan['ta_reparents']) > 0:
+        db.DBSession.execute(ta_table.update().where(ta_table.c.parent_id == bindparam('b_old_parent_id')).values(
+            parent_id=bindparam('b_new_parent_id')), plan['ta_reparents'])
+    if len(plan['ta_updates']) > 0:
+        db.DBSession.execute(ta_table.update().where(ta_table.c.id == bindparam('b_id')).values(
+            attr_id=bindparam('b_attr_id')), plan['ta_updates'])
+    for id_chunk in chunked(plan['ta_deletes']):
+        db.DBSession.execute(ta_table.delete().where(ta_table.c.id.in_(id_chunk)))
+
+    item_table = AttrGroupItem.__table__
+    for old_key in plan['item_deletes'] + [u[0] for u in plan['item_updates']]:
+        db.DBSession.execute(item_table.delete().where(and_(item_table.c.group_id == old_key[0],
+                                                            item_table.c.attr_id == old_key[1],
+                                                            item_table.c.network_id == old_key[2])))
+    if len(plan['item_updates']) > 0:
+        db.DBSession.execute(item_table.insert(), [{'group_id'   : new_key[0],
+                                                    'attr_id'    : new_key[1],
+                                                    'network_id' : new_key[2]}
+                                                   for _, new_key in plan['item_updates']])
+
+    map_table = AttrMap.__table__
+    for old_key in plan['map_deletes'] + [u[0] for u in plan['map_updates']]:
+        db.DBSession.execute(map_table.delete().where(and_(map_table.c.attr_id_a == old_key[0],
+                                                           map_table.c.attr_id_b == old_key[1])))
+    if len(plan['map_updates']) > 0:
+        db.DBSession.execute(map_table.insert(), [{'attr_id_a' : new_key[0],
+                                                   'attr_id_b' : new_key[1]}
+                                                  for _, new_key in plan['map_updates']])
+
+    attr_table = Attr.__table__
+    for id_chunk in chunked(plan['attr_deletes']):
+        db.DBSession.execute(attr_table.delete().where(attr_table.c.id.in_(id_chunk)))
+
+    _clear_network_caches(plan['ref_ids_by_key'])
+    attrindex.invalidate()
+    if len(plan['ta_updates']) > 0 or len(plan['ta_deletes']) > 0:
+        templatecache.invalidate()
+
+@required_perms('delete_attribute')
+def delete_duplicate_attributes(dry_run=False, batch_size=100, max_batches=None, **kwargs):
+    """
+        Merge each set of duplicate attributes into the oldest one.
+        Everything referring to a duplicate is pointed at the attribute
+        being kept, and the duplicates are deleted.
+
+        Args:
+            dry_run (bool): Report what would be done without changing anything
+            batch_size (int): The number of duplicate sets to deal with between commits
+            max_batches (int): Stop after this many batches. None to do them all.
+
+        Returns:
+            dict: A report of the duplicates found and the rows changed.
+    """
+    groups = find_duplicate_attributes()
+    log.info("Found %s sets of duplicate attributes", len(groups))
+    report = CleanupReport('delete_duplicate_attributes', dry_run, len(groups))
+    return _run_batches(report, groups, batch_size, max_batches,
+                        _plan_attribute_batch, _apply_attribute_plan)
+
+#
+# Duplicate resource attributes
+#
+
+def _get_network_filter(network_id):
+    """
+        Filter resource attributes to those on a network and its resources.
+    """
+    return or_(ResourceAttr.network_id == network_id,
+               ResourceAttr.node_id.in_(select(Node.id).where(Node.network_id == network_id)),
+               ResourceAttr.link_id.in_(select(Link.id).where(Link.network_id == network_id)),
+               ResourceAttr.group_id.in_(select(ResourceGroup.id).where(ResourceGroup.network_id == network_id)))
+
+def find_duplicate_resourceattributes(network_id=None):
+    """
+        Find resources with more than one resource attribute for attributes
+        of the same name, e.g. 'max_flow' with no dimension and 'max_flow'
+        with a dimension of 'Volumetric flow rate'.
+
+        Returns:
+            list: A dict for each set of duplicates, with the resource and the attribute name.
+    """
+    qry = db.DBSession.query(*(_ra_key_columns + [Attr.name])).join(
+        Attr, Attr.id == ResourceAttr.attr_id).group_by(
+            *(_ra_key_columns + [Attr.name])).having(func.count(ResourceAttr.id) > 1)
+
+    if network_id is None:
+        #As in hydra_base, only inputs are considered across the whole DB
+        qry = qry.filter(ResourceAttr.attr_is_var == 'N')
+    else:
+        qry = qry.filter(_get_network_filter(network_id))
+
+    groups = []
+    for row in qry.all():
+        groups.append({'ref_key' : row.ref_key,
+                       'ref_id'  : _get_ref_id(row),
+                       'name'    : row.name})
+
+    return sorted(groups, key=lambda g: (g['ref_key'], g['ref_id'], g['name']))
+
+def _get_type_attr_ids(ref_ids_by_key):
+    """
+        Returns:
+            dict: The IDs of the attributes defined by the types of each resource.
+    """
+    type_attr_ids = {}
+    for ref_key, ref_ids in ref_ids_by_key.items():
+        ref_col = getattr(ResourceType, ref_key_columns[ref_key])
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(ref_col.label('ref_id'), TypeAttr.attr_id).join(
+                TypeAttr, TypeAttr.type_id == ResourceType.type_id).filter(
+                    ResourceType.ref_key == ref_key,
+                    ref_col.in_(id_chunk)).all()
+            for row in rows:
+                type_attr_ids.setdefault((ref_key, row.ref_id), set()).add(row.attr_id)
+    return type_attr_ids
+
+def _plan_resourceattribute_batch(groups):
+    """
+        In each set of duplicates, the resource attributes whose attribute
+        is defined by one of the resource's types are kept, and the others
+        are merged into the first of those.
+        If none are defined by a type, the ones without data are deleted,
+        keeping the oldest if none have data. The others are left for the
+        user to deal with.
+    """
+    ref_ids_by_key = {}
+    names = set()
+    for group in groups:
+        ref_ids_by_key.setdefault(group['ref_key'], set()).add(group['ref_id'])
+        names.add(group['name'])
+
+    members = {}
+    for ref_key, ref_ids in ref_ids_by_key.items():
+        ref_col = getattr(ResourceAttr, ref_key_columns[ref_key])
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(ResourceAttr.id,
+                                      ResourceAttr.attr_id,
+                                      ref_col.label('ref_id'),
+                                      Attr.name).join(
+                                          Attr, Attr.id == ResourceAttr.attr_id).filter(
+                                              ResourceAttr.ref_key == ref_key,
+                                              ref_col.in_(id_chunk),
+                                              Attr.name.in_(list(names))).order_by(ResourceAttr.id).all()
+            for row in rows:
+                members.setdefault((ref_key, row.ref_id, row.name), []).append(row)
+
+    type_attr_ids = _get_type_attr_ids(ref_ids_by_key)
+    scenario_ids = _get_scenario_ids([m.id for group_members in members.values() for m in group_members])
+
+    merges = []
+    deletes = []
+    reported_groups = []
+    for group in groups:
+        group_members = members.get((group['ref_key'], group['ref_id'], group['name']), [])
+        if len(group_members) < 2:
+            continue
+        typed_attr_ids = type_attr_ids.get((group['ref_key'], group['ref_id']), set())
+        typed = [m for m in group_members if m.attr_id in typed_attr_ids]
+
+        group_merges = []
+        group_deletes = []
+        if len(typed) > 0:
+            keeper = typed[0]
+            group_merges = [(m.id, keeper.id) for m in group_members if m.attr_id not in typed_attr_ids]
+        else:
+            with_data = [m for m in group_members if scenario_ids.get(m.id)]
+            keeper = with_data[0] if len(with_data) > 0 else group_members[0]
+            group_deletes = [m.id for m in group_members
+                             if m.id != keeper.id and not scenario_ids.get(m.id)]
+
+        merges.extend(group_merges)
+        deletes.extend(group_deletes)
+        reported_groups.append(dict(group,
+                                    keep=keeper.id,
+                                    merge=[m[0] for m in group_merges],
+                                    delete=group_deletes,
+                                    leave=[m.id for m in group_members if m.id != keeper.id
+                                           and m.id not in group_deletes
+                                           and m.id not in [g[0] for g in group_merges]]))
+
+    rs_moves = _plan_merge(merges, scenario_ids)
+
+    return {'ra_deletes'     : [m[0] for m in merges] + deletes,
+            'rs_moves'       : rs_moves,
+            'ref_ids_by_key' : ref_ids_by_key,
+            'groups'         : reported_groups,
+            'counts'         : {
+                'resource_attributes_merged'  : len(merges),
+                'resource_attributes_deleted' : len(deletes),
+                'resource_scenarios_moved'    : len(rs_moves),
+                'resource_scenarios_deleted'  : sum(len(scenario_ids.get(m[0], [])) for m in merges) - len(rs_moves),
+            }}
+
+def _apply_resourceattribute_plan(plan):
+    _delete_resource_attributes(plan['ra_deletes'], plan['rs_moves'])
+    _clear_network_caches(plan['ref_ids_by_key'])
+
+@required_perms('delete_attribute', 'edit_network')
+def delete_duplicate_resourceattributes(network_id=None, dry_run=False, batch_size=1000,
+                                        max_batches=None, **kwargs):
+    """
+        For every resource, find attributes with the same name but different
+        IDs, and remove the ones not used by the resource's types, moving
+        their data to the one which is.
+
+        Args:
+            network_id (int): Only look in this network. If None, look at
+                all the input resource attributes in the DB.
+            dry_run (bool): Report what would be done without changing anything
+            batch_size (int): The number of duplicate sets to deal with between commits
+            max_batches (int): Stop after this many batches. None to do them all.
+
+        Returns:
+            dict: A report of the duplicates found and the rows changed.
+    """
+    if network_id is not None:
+        network_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+        if network_i is None:
+            raise ResourceNotFoundError("Network %s not found"%(network_id))
+        network_i.check_write_permission(kwargs.get('user_id'))
+
+    groups = find_duplicate_resourceattributes(network_id)
+    log.info("Found %s sets of duplicate resource attributes", len(groups))
+    report = CleanupReport('delete_duplicate_resourceattributes', dry_run, len(groups))
+    return _run_batches(report, groups, batch_size, max_batches,
+                        _plan_resourceattribute_batch, _apply_resourceattribute_plan)
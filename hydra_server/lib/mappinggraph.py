@@ -0,0 +1,254 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Resource attribute mappings as a graph, for copying values along them.
+
+    A mapping says a resource attribute in one network is the same as one
+    in another network. As with update_value_from_mapping, a mapping works
+    in both directions. Mappings can be chained (A to B in one network,
+    B to C in another), so a value set on A applies to everything it is
+    connected to.
+
+    The mappings of each network are loaded in one query the first time they
+    are needed and kept until a mapping is added or deleted.
+"""
+
+import logging
+from collections import deque
+
+from sqlalchemy import or_, and_, bindparam
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import ResourceAttr, ResourceAttrMap, ResourceScenario, Scenario
+from hydra_base import config
+from hydra_base.exceptions import HydraError, ResourceNotFoundError, PermissionError
+
+from .cache import LRUCache, invalidate_after_commit
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#The mapping graph of each network, keyed on network ID.
+network_graphs = LRUCache(config.getint('hydra_server', 'mapping_graph_cache_size', 100))
+
+def invalidate():
+    """
+        Mappings can join any number of networks, so drop all the graphs.
+    """
+    invalidate_after_commit(network_graphs.clear)
+
+def _load_graph(network_id):
+    """
+        The mappings to and from a network, as returned by get_mappings_in_network.
+
+        Returns:
+            dict: The resource attributes each resource attribute in the network is
+                mapped to, as (resource_attr_id, network_id) tuples.
+    """
+    rows = db.DBSession.query(ResourceAttrMap.resource_attr_id_a,
+                              ResourceAttrMap.network_a_id,
+                              ResourceAttrMap.resource_attr_id_b,
+                              ResourceAttrMap.network_b_id).filter(or_(
+                                  ResourceAttrMap.network_a_id == network_id,
+                                  ResourceAttrMap.network_b_id == network_id)).all()
+
+    graph = {}
+    for ra_a, net_a, ra_b, net_b in rows:
+        if net_a == network_id:
+            graph.setdefault(ra_a, set()).add((ra_b, net_b))
+        if net_b == network_id:
+            graph.setdefault(ra_b, set()).add((ra_a, net_a))
+
+    log.info("Loaded %s mappings for network %s", len(rows), network_id)
+    return graph
+
+def get_graph(network_id):
+    graph = network_graphs.get(network_id)
+    if graph is None:
+        graph = _load_graph(network_id)
+        network_graphs.set(network_id, graph)
+    return graph
+
+def find_mapped(network_id, source_resource_attr_ids):
+    """
+        Walk the mappings out from each source, following chains across
+        networks, breadth first.
+
+        A resource attribute reachable from more than one source takes its
+        value from the nearest one, or the first listed if they are equally
+        near. Sources are never targets.
+
+        Returns:
+            dict: The source and network of each target resource attribute,
+                as {target_ra_id: (source_ra_id, target_network_id)}
+    """
+    sources = set(source_resource_attr_ids)
+    targets = {}
+    queue = deque((ra_id, network_id, ra_id) for ra_id in source_resource_attr_ids)
+    while queue:
+        ra_id, ra_network_id, source_id = queue.popleft()
+        for mapped_ra_id, mapped_network_id in get_graph(ra_network_id).get(ra_id, ()):
+            if mapped_ra_id in sources or mapped_ra_id in targets:
+                continue
+            targets[mapped_ra_id] = (source_id, mapped_network_id)
+            queue.append((mapped_ra_id, mapped_network_id, source_id))
+
+    return targets
+
+def _get_target_scenarios(scenario_i, target_scenario_ids, network_ids, user_id):
+    """
+        Work out which scenario to write to in each network, checking the
+        user can write to them.
+
+        Returns:
+            dict: The scenario ID for each network which has one
+    """
+    scenarios = [scenario_i]
+    other_ids = [s_id for s_id in (target_scenario_ids or []) if s_id != scenario_i.id]
+    if len(other_ids) > 0:
+        scenarios.extend(db.DBSession.query(Scenario).filter(Scenario.id.in_(other_ids)).all())
+        missing = set(other_ids) - set(s.id for s in scenarios)
+        if missing:
+            raise ResourceNotFoundError("Scenario(s) %s not found"%(sorted(missing)))
+
+    scenario_by_network = {}
+    for s in scenarios:
+        if s.network_id in scenario_by_network:
+            raise HydraError("More than one target scenario given for network %s"%(s.network_id))
+        scenario_by_network[s.network_id] = s
+
+    target_scenarios = {}
+    for network_id in network_ids:
+        s = scenario_by_network.get(network_id)
+        if s is None:
+            continue
+        s.network.check_write_permission(user_id)
+        if s.locked == 'Y':
+            raise PermissionError('Cannot update scenario %s as it is locked.'%(s.id))
+        target_scenarios[network_id] = s.id
+
+    return target_scenarios
+
+def _get_dataset_ids(scenario_id, ra_ids):
+    dataset_ids = {}
+    for id_chunk in chunked(ra_ids):
+        rows = db.DBSession.query(ResourceScenario.resource_attr_id,
+                                  ResourceScenario.dataset_id).filter(
+                                      ResourceScenario.scenario_id == scenario_id,
+                                      ResourceScenario.resource_attr_id.in_(id_chunk)).all()
+        for row in rows:
+            dataset_ids[row.resource_attr_id] = row.dataset_id
+    return dataset_ids
+
+def propagate_mapped_values(scenario_id, source_resource_attr_ids, target_scenario_ids=None, **kwargs):
+    """
+        Copy the values of the source resource attributes in a scenario to
+        everything they are mapped to, directly or through a chain of mappings.
+
+        Targets in the scenario's network are written in that scenario.
+        Targets in other networks are written in the scenario given for
+        that network in target_scenario_ids, and are skipped if there isn't one.
+
+        As with update_value_from_mapping, a target's value is removed if
+        its source has no value.
+
+        Returns:
+            dict: The number of resource scenarios created, updated, deleted and unchanged,
+                and the number of targets skipped for lack of a scenario.
+    """
+    user_id = kwargs.get('user_id')
+
+    scenario_i = db.DBSession.query(Scenario).filter(Scenario.id == scenario_id).first()
+    if scenario_i is None:
+        raise ResourceNotFoundError("Scenario %s does not exist."%(scenario_id))
+    scenario_i.network.check_read_permission(user_id)
+
+    source_resource_attr_ids = list(dict.fromkeys(source_resource_attr_ids))
+    targets = find_mapped(scenario_i.network_id, source_resource_attr_ids)
+
+    summary = {'targets'   : len(targets),
+               'created'   : 0,
+               'updated'   : 0,
+               'deleted'   : 0,
+               'unchanged' : 0,
+               'skipped'   : 0}
+
+    if len(targets) == 0:
+        return summary
+
+    target_scenarios = _get_target_scenarios(scenario_i,
+                                             target_scenario_ids,
+                                             set(t[1] for t in targets.values()),
+                                             user_id)
+
+    #Mappings are kept when resource attributes are deleted, so check the targets exist.
+    existing_ras = set()
+    for id_chunk in chunked(list(targets.keys())):
+        existing_ras.update(r.id for r in db.DBSession.query(ResourceAttr.id).filter(
+            ResourceAttr.id.in_(id_chunk)).all())
+
+    source_datasets = _get_dataset_ids(scenario_id, source_resource_attr_ids)
+
+    targets_by_scenario = {}
+    for target_id, (source_id, network_id) in targets.items():
+        if network_id not in target_scenarios or target_id not in existing_ras:
+            summary['skipped'] += 1
+            continue
+        targets_by_scenario.setdefault(target_scenarios[network_id], {})[target_id] = source_datasets.get(source_id)
+
+    rs_table = ResourceScenario.__table__
+    for target_scenario_id, target_datasets in targets_by_scenario.items():
+        current_datasets = _get_dataset_ids(target_scenario_id, list(target_datasets.keys()))
+
+        inserts = []
+        updates = []
+        deletes = []
+        for ra_id, dataset_id in target_datasets.items():
+            current_dataset_id = current_datasets.get(ra_id)
+            if dataset_id == current_dataset_id:
+                summary['unchanged'] += 1
+            elif dataset_id is None:
+                deletes.append(ra_id)
+            elif current_dataset_id is None:
+                inserts.append({'scenario_id'      : target_scenario_id,
+                                'resource_attr_id' : ra_id,
+                                'dataset_id'       : dataset_id})
+            else:
+                updates.append({'b_resource_attr_id' : ra_id,
+                                'b_dataset_id'       : dataset_id})
+
+        if len(inserts) > 0:
+            db.DBSession.execute(rs_table.insert(), inserts)
+        if len(updates) > 0:
+            db.DBSession.execute(rs_table.update().where(and_(
+                rs_table.c.scenario_id == target_scenario_id,
+                rs_table.c.resource_attr_id == bindparam('b_resource_attr_id'))).values(
+                    dataset_id=bindparam('b_dataset_id')), updates)
+        for id_chunk in chunked(deletes):
+            db.DBSession.execute(rs_table.delete().where(and_(
+                rs_table.c.scenario_id == target_scenario_id,
+                rs_table.c.resource_attr_id.in_(id_chunk))))
+
+        summary['created'] += len(inserts)
+        summary['updated'] += len(updates)
+        summary['deleted'] += len(deletes)
+
+    mark_changed(db.DBSession())
+
+    log.info("Propagated %s values from scenario %s: %s", len(source_resource_attr_ids), scenario_id, summary)
+
+    return summary
@@ -0,0 +1,137 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Cache of dataset metadata, shared by the metadata RPCs and the Dataset
+    complex model.
+
+    Entries are stored with the hash of the dataset. The hash includes the
+    metadata, so when the hash of a dataset is known, a stale entry is
+    recognised and ignored, even if the dataset was changed by another
+    process. Entries are also dropped when a dataset is
+    updated or deleted through the server.
+"""
+
+import logging
+
+from hydra_base import db
+from hydra_base import config
+from hydra_base.db.model import Dataset, Metadata
+
+from .cache import LRUCache, invalidate_after_commit
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#dataset_id -> (hash, {key: value})
+metadata_cache = LRUCache(config.getint('hydra_server', 'metadata_cache_size', 100000))
+
+def get_cached_metadata(dataset_id, dataset_hash=None):
+    """
+        Get the metadata of a dataset from the cache, or None if it's not
+        there or is out of date.
+    """
+    entry = metadata_cache.get(dataset_id)
+    if entry is None:
+        return None
+
+    cached_hash, metadata = entry
+    #An entry cached without a hash can't be checked, so it's reloaded
+    if dataset_hash is not None and str(cached_hash) != str(dataset_hash):
+        metadata_cache.pop(dataset_id)
+        return None
+
+    return metadata
+
+def set_cached_metadata(dataset_id, metadata, dataset_hash=None):
+    metadata_cache.set(dataset_id, (dataset_hash, metadata))
+
+def _invalidate(dataset_ids):
+    for dataset_id in dataset_ids:
+        metadata_cache.pop(dataset_id)
+
+def invalidate(dataset_ids):
+    #Drop the entries again after the commit, in case another request
+    #cached the old metadata in the meantime.
+    dataset_ids = list(dataset_ids)
+    invalidate_after_commit(lambda: _invalidate(dataset_ids))
+
+def get_dataset_hashes(dataset_ids):
+    """
+        Returns:
+            dict: {dataset_id: hash} of the datasets in the DB
+    """
+    dataset_hashes = {}
+    for chunk in chunked(list(set(dataset_ids))):
+        rows = db.DBSession.query(Dataset.id, Dataset.hash).filter(
+            Dataset.id.in_(chunk)).all()
+        for dataset_id, dataset_hash in rows:
+            dataset_hashes[dataset_id] = dataset_hash
+    return dataset_hashes
+
+def get_metadata(dataset_ids, dataset_hashes=None):
+    """
+        Get the metadata of several datasets, loading all the ones which are
+        not in the cache with a single (chunked) query.
+
+        Args:
+            dataset_ids (list(int)): The datasets
+            dataset_hashes (dict): Optional. {dataset_id: hash}, used to
+                                   spot out-of-date entries in the cache.
+
+        Returns:
+            dict: {dataset_id: {key: value}}
+    """
+    if dataset_hashes is None:
+        dataset_hashes = {}
+
+    metadata = {}
+    missing = []
+    for dataset_id in set(dataset_ids):
+        cached = get_cached_metadata(dataset_id, dataset_hashes.get(dataset_id))
+        if cached is None:
+            missing.append(dataset_id)
+        else:
+            metadata[dataset_id] = cached
+
+    if len(missing) > 0:
+        loaded = dict((dataset_id, {}) for dataset_id in missing)
+        for chunk in chunked(missing):
+            rows = db.DBSession.query(Metadata.dataset_id,
+                                      Metadata.key,
+                                      Metadata.value).filter(
+                                          Metadata.dataset_id.in_(chunk)).all()
+            for dataset_id, key, value in rows:
+                loaded[dataset_id][key] = str(value)
+
+        for dataset_id, dataset_metadata in loaded.items():
+            set_cached_metadata(dataset_id, dataset_metadata, dataset_hashes.get(dataset_id))
+            metadata[dataset_id] = dataset_metadata
+
+        log.info("Loaded the metadata of %s datasets (%s were cached)",
+                 len(missing), len(metadata) - len(missing))
+
+    return metadata
+
+def prefetch(datasets):
+    """
+        Make sure the metadata of a list of datasets (ORM objects or rows
+        with an id and hash) is in the cache, so the Dataset complex models
+        can be built without loading metadata one dataset at a time.
+    """
+    dataset_hashes = dict((d.id, getattr(d, 'hash', None)) for d in datasets)
+    if len(dataset_hashes) > 0:
+        get_metadata(list(dataset_hashes.keys()), dataset_hashes)
@@ -0,0 +1,425 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Adding and updating many nodes, links and groups at once.
+
+    hydra_base's add_nodes and add_links reload every node or link in the
+    network after inserting, and the server then matched them back to the
+    request by comparing names in a nested loop. Here the nodes and links
+    are inserted with one executemany each, the new IDs are looked up by
+    name in dictionaries, and the client's IDs (negative, for new
+    resources, as in add_network) are mapped to the new ones.
+
+    Updates take partial payloads: only the fields which are sent are
+    changed, with one executemany per set of fields.
+"""
+
+import logging
+
+from sqlalchemy import bindparam, or_
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Network, Node, Link, ResourceGroup
+from hydra_base.lib.objects import JSONObject
+from hydra_base.util import get_json_as_string
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .util import chunked
+from .resourceattrs import bulk_add_resource_attributes
+from . import typeassign, topology, spatial
+
+log = logging.getLogger(__name__)
+
+def get_network(network_id, user_id):
+    """
+        Get a network, after checking the user can write to it.
+    """
+    net_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if net_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id))
+    net_i.check_write_permission(user_id)
+    return net_i
+
+def _check_names(resource_class, network_id, resources, active_only):
+    """
+        Check the names of new resources are unique, among themselves and
+        in the network.
+    """
+    ref_key = resource_class.ref_key.lower()
+    names = set()
+    for resource in resources:
+        if resource.name is None:
+            raise HydraError("A new %s has no name"%(ref_key))
+        name = str(resource.name)
+        if name in names:
+            raise HydraError("Duplicate %s name: %s"%(ref_key, name))
+        names.add(name)
+
+    for name_chunk in chunked(names):
+        qry = db.DBSession.query(resource_class.name).filter(
+            resource_class.network_id == network_id,
+            resource_class.name.in_(name_chunk))
+        if active_only is True:
+            qry = qry.filter(resource_class.status == 'A')
+        existing = [r.name for r in qry.all()]
+        if len(existing) > 0:
+            raise HydraError("The network already has %s(s) called %s"%(ref_key, sorted(existing)))
+
+def _get_ids_by_name(resource_class, network_id, names, active_only):
+    ids_by_name = {}
+    for name_chunk in chunked(names):
+        qry = db.DBSession.query(resource_class.id, resource_class.name).filter(
+            resource_class.network_id == network_id,
+            resource_class.name.in_(name_chunk))
+        if active_only is True:
+            qry = qry.filter(resource_class.status == 'A')
+        for row in qry.all():
+            ids_by_name[row.name] = row.id
+    return ids_by_name
+
+def _insert_nodes(network_id, nodes):
+    """
+        Returns:
+            list: The IDs of the new nodes, in the same order
+    """
+    _check_names(Node, network_id, nodes, True)
+
+    rows = [{'network_id'  : network_id,
+             'name'        : str(node.name),
+             'description' : node.description,
+             'layout'      : node.get_layout(),
+             'x'           : node.x,
+             'y'           : node.y} for node in nodes]
+    db.DBSession.execute(Node.__table__.insert(), rows)
+
+    ids_by_name = _get_ids_by_name(Node, network_id, [r['name'] for r in rows], True)
+    return [ids_by_name[r['name']] for r in rows]
+
+def _get_node_ids(network_id, links, node_id_map):
+    """
+        Map the node IDs of links to real node IDs: negative IDs are the
+        new nodes in the same request, others must be nodes in the network.
+    """
+    existing_ids = set(node_id for link in links for node_id in (link.node_1_id, link.node_2_id)
+                       if node_id is not None and node_id not in node_id_map)
+    found = set()
+    for id_chunk in chunked(existing_ids):
+        rows = db.DBSession.query(Node.id).filter(Node.network_id == network_id,
+                                                  Node.id.in_(id_chunk)).all()
+        found.update(r.id for r in rows)
+    missing = existing_ids - found
+    if len(missing) > 0:
+        raise HydraError("Node(s) %s are not in network %s"%(sorted(missing), network_id))
+
+    return lambda node_id: node_id_map.get(node_id, node_id)
+
+def _insert_links(network_id, links, node_id_map):
+    """
+        Returns:
+            list: The IDs of the new links, in the same order
+    """
+    _check_names(Link, network_id, links, False)
+    get_node_id = _get_node_ids(network_id, links, node_id_map)
+
+    rows = []
+    for link in links:
+        if link.node_1_id is None or link.node_2_id is None:
+            raise HydraError("Link %s must have two nodes"%(link.name))
+        rows.append({'network_id'  : network_id,
+                     'name'        : str(link.name),
+                     'description' : link.description,
+                     'layout'      : link.get_layout(),
+                     'node_1_id'   : get_node_id(link.node_1_id),
+                     'node_2_id'   : get_node_id(link.node_2_id)})
+    db.DBSession.execute(Link.__table__.insert(), rows)
+
+    ids_by_name = _get_ids_by_name(Link, network_id, [r['name'] for r in rows], False)
+    return [ids_by_name[r['name']] for r in rows]
+
+def _insert_groups(network_id, groups):
+    """
+        Returns:
+            list: The IDs of the new groups, in the same order
+    """
+    _check_names(ResourceGroup, network_id, groups, False)
+
+    rows = [{'network_id'  : network_id,
+             'name'        : str(group.name),
+             'description' : group.description} for group in groups]
+    db.DBSession.execute(ResourceGroup.__table__.insert(), rows)
+
+    ids_by_name = _get_ids_by_name(ResourceGroup, network_id, [r['name'] for r in rows], False)
+    return [ids_by_name[r['name']] for r in rows]
+
+def _add_attributes_and_types(ref_key, resources, new_ids, **kwargs):
+    """
+        Add the resource attributes and types of new resources.
+
+        Returns:
+            list: The client's ID and the new ID of each resource attribute
+                which was given an ID, in the order they appear in the request
+    """
+    resource_attributes = []
+    temp_ra_ids = []
+    resource_types = []
+    for resource, ref_id in zip(resources, new_ids):
+        for ra in resource.attributes or []:
+            resource_attributes.append((ref_key, ref_id, ra.attr_id, ra.attr_is_var))
+            temp_ra_ids.append(ra.id)
+        for rtype in resource.types or []:
+            resource_types.append(JSONObject({'ref_key'     : ref_key,
+                                              'ref_id'      : ref_id,
+                                              'type_id'     : rtype.id,
+                                              'template_id' : rtype.template_id}))
+
+    ra_ids = bulk_add_resource_attributes(resource_attributes, kwargs.get('user_id'))
+    if len(resource_types) > 0:
+        typeassign.assign_types_to_resources(resource_types, **kwargs)
+
+    return [{'temp_id': temp_id, 'id': ra_id}
+            for temp_id, ra_id in zip(temp_ra_ids, ra_ids) if temp_id is not None]
+
+def _id_map(resources, new_ids):
+    return [{'temp_id' : resource.id,
+             'name'    : str(resource.name),
+             'id'      : new_id} for resource, new_id in zip(resources, new_ids)]
+
+@required_perms('edit_network')
+def add_nodes_and_links(network_id, nodes=None, links=None, groups=None, node_id_map=None, **kwargs):
+    """
+        Add nodes, links and resource groups to a network, with their
+        attributes and types. Links can refer to new nodes in the same
+        request by their (negative) IDs, or to nodes already in the network.
+
+        Args:
+            node_id_map (dict): The real IDs of new nodes added before, keyed
+                on their temporary IDs, for links which refer to them
+
+        Returns:
+            dict: 'nodes', 'links' and 'groups', with the temp_id, name and
+                new id of each, in the same order as the request, and
+                'resource_attributes', with the temp_id and new id of each
+                resource attribute which was given an ID.
+    """
+    nodes = nodes or []
+    links = links or []
+    groups = groups or []
+
+    get_network(network_id, kwargs.get('user_id'))
+
+    node_ids = _insert_nodes(network_id, nodes) if len(nodes) > 0 else []
+    node_id_map = dict(node_id_map or {})
+    node_id_map.update((node.id, node_id) for node, node_id in zip(nodes, node_ids)
+                       if node.id is not None)
+
+    link_ids = _insert_links(network_id, links, node_id_map) if len(links) > 0 else []
+    group_ids = _insert_groups(network_id, groups) if len(groups) > 0 else []
+
+    mark_changed(db.DBSession())
+
+    ra_map = _add_attributes_and_types('NODE', nodes, node_ids, **kwargs)
+    ra_map.extend(_add_attributes_and_types('LINK', links, link_ids, **kwargs))
+    ra_map.extend(_add_attributes_and_types('GROUP', groups, group_ids, **kwargs))
+
+    if len(node_ids) > 0 or len(link_ids) > 0:
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, node_ids)
+
+    log.info("Added %s nodes, %s links and %s groups to network %s",
+             len(node_ids), len(link_ids), len(group_ids), network_id)
+
+    return {'nodes'               : _id_map(nodes, node_ids),
+            'links'               : _id_map(links, link_ids),
+            'groups'              : _id_map(groups, group_ids),
+            'resource_attributes' : ra_map}
+
+#The fields of each type of resource which can be updated in bulk
+updatable_fields = {
+    'NODE'  : ('name', 'description', 'x', 'y', 'layout', 'status'),
+    'LINK'  : ('name', 'description', 'layout', 'status'),
+    'GROUP' : ('name', 'description', 'status'),
+}
+
+def _get_updates(ref_key, resources):
+    """
+        Check the partial payloads of resources to update.
+
+        Returns:
+            list: (id, {field: value}) tuples, in the same order
+    """
+    fields = updatable_fields[ref_key]
+    updates = []
+    seen = set()
+    for resource in resources:
+        resource = dict(resource)
+        resource_id = resource.pop('id', None)
+        if resource_id is None:
+            raise HydraError("A %s to update has no id"%(ref_key.lower()))
+        resource_id = int(resource_id)
+        if resource_id in seen:
+            raise HydraError("%s %s is updated twice"%(ref_key.capitalize(), resource_id))
+        seen.add(resource_id)
+
+        unknown = set(resource) - set(fields)
+        if len(unknown) > 0:
+            raise HydraError("Cannot update %s on a %s. Fields which can be updated are: %s"
+                             %(sorted(unknown), ref_key.lower(), ', '.join(fields)))
+
+        if 'name' in resource and resource['name'] is None:
+            raise HydraError("%s %s cannot have no name"%(ref_key.capitalize(), resource_id))
+        if 'status' in resource and resource['status'] not in ('A', 'X'):
+            raise HydraError("Status of %s %s must be A or X"%(ref_key.lower(), resource_id))
+        if resource.get('layout') is not None:
+            resource['layout'] = get_json_as_string(resource['layout'])
+
+        updates.append((resource_id, resource))
+    return updates
+
+def _check_renames(resource_class, updates, network_ids):
+    """
+        Check that renamed resources don't clash with each other or with the
+        other resources in their networks. Nodes only clash with nodes with
+        the same status.
+    """
+    ref_key = resource_class.ref_key
+    with_status = ref_key == 'NODE'
+    renames = dict((resource_id, fields['name']) for resource_id, fields in updates
+                   if 'name' in fields)
+    if len(renames) == 0:
+        return
+
+    updated = dict(updates)
+    columns = (resource_class.id, resource_class.network_id, resource_class.name, resource_class.status)
+    rows = {}
+    for id_chunk in chunked(list(renames)):
+        for row in db.DBSession.query(*columns).filter(resource_class.id.in_(id_chunk)).all():
+            rows[row.id] = row
+    renamed_networks = list(set(network_ids[(ref_key, i)] for i in renames))
+    for name_chunk in chunked(list(set(renames.values()))):
+        for row in db.DBSession.query(*columns).filter(
+                resource_class.network_id.in_(renamed_networks),
+                resource_class.name.in_(name_chunk)).all():
+            rows[row.id] = row
+
+    #The name and status each of these resources will have after the update
+    keys = {}
+    for resource_id, row in rows.items():
+        fields = updated.get(resource_id, {})
+        key = (row.network_id, fields.get('name', row.name))
+        if with_status is True:
+            key = key + (fields.get('status', row.status),)
+        if key in keys:
+            raise HydraError("%s name %s is used more than once in network %s"
+                             %(ref_key.capitalize(), key[1], row.network_id))
+        keys[key] = resource_id
+
+def _update_resources(resource_class, updates):
+    """
+        Apply the updates, with one executemany for each set of fields.
+    """
+    table = resource_class.__table__
+    by_fields = {}
+    for resource_id, fields in updates:
+        if len(fields) == 0:
+            continue
+        row = dict(('b_%s'%(field), value) for field, value in fields.items())
+        row['b_id'] = resource_id
+        by_fields.setdefault(tuple(sorted(fields)), []).append(row)
+
+    for fields, rows in by_fields.items():
+        values = dict((field, bindparam('b_%s'%(field))) for field in fields)
+        db.DBSession.execute(table.update().where(table.c.id == bindparam('b_id')).values(**values),
+                             rows)
+
+def _set_link_status_of_nodes(updates):
+    """
+        Give the links of nodes whose status has changed the same status,
+        as hydra_base's set_node_status does.
+    """
+    node_ids_by_status = {}
+    for node_id, fields in updates:
+        if 'status' in fields:
+            node_ids_by_status.setdefault(fields['status'], []).append(node_id)
+
+    link_table = Link.__table__
+    for status, node_ids in node_ids_by_status.items():
+        #Each ID is used twice in the query
+        for id_chunk in chunked(node_ids, 450):
+            db.DBSession.execute(link_table.update().where(or_(
+                link_table.c.node_1_id.in_(id_chunk),
+                link_table.c.node_2_id.in_(id_chunk))).values(status=status))
+
+def _bulk_update(ref_key, resource_class, resources, **kwargs):
+    updates = _get_updates(ref_key, resources)
+    if len(updates) == 0:
+        return []
+
+    network_ids = typeassign.get_network_ids({ref_key: set(u[0] for u in updates)},
+                                             kwargs.get('user_id'))
+    _check_renames(resource_class, updates, network_ids)
+
+    db.DBSession.flush()
+    _update_resources(resource_class, updates)
+    if ref_key == 'NODE':
+        _set_link_status_of_nodes(updates)
+    mark_changed(db.DBSession())
+
+    changed_networks = {}
+    for resource_id, fields in updates:
+        if ref_key == 'NODE' and len(set(fields) & set(('x', 'y', 'status'))) > 0:
+            changed_networks.setdefault(network_ids[(ref_key, resource_id)], []).append(resource_id)
+        elif ref_key == 'LINK' and 'status' in fields:
+            changed_networks.setdefault(network_ids[(ref_key, resource_id)], [])
+    for network_id, node_ids in changed_networks.items():
+        topology.invalidate(network_id)
+        if len(node_ids) > 0:
+            spatial.nodes_changed(network_id, node_ids)
+
+    log.info("%s %ss updated", len(updates), ref_key.lower())
+
+    return [u[0] for u in updates]
+
+@required_perms('edit_network')
+def update_nodes(nodes, **kwargs):
+    """
+        Update many nodes at once. Only the fields which are present are
+        changed: any of name, description, x, y, layout and status.
+
+        Args:
+            nodes (list): dicts, each with the 'id' of a node and the fields to change
+
+        Returns:
+            list: The IDs of the nodes, in the same order
+    """
+    return _bulk_update('NODE', Node, nodes, **kwargs)
+
+@required_perms('edit_network')
+def update_links(links, **kwargs):
+    """
+        Update many links at once. Only the fields which are present are
+        changed: any of name, description, layout and status.
+    """
+    return _bulk_update('LINK', Link, links, **kwargs)
+
+@required_perms('edit_network')
+def update_groups(groups, **kwargs):
+    """
+        Update many resource groups at once. Only the fields which are
+        present are changed: any of name, description and status.
+    """
+    return _bulk_update('GROUP', ResourceGroup, groups, **kwargs)
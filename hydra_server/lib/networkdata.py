@@ -0,0 +1,158 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Getting the data of a network in a scenario as rows of chosen fields.
+
+    get_all_node_data and friends build a resource attribute and resource
+    scenario complex model for every value, with every field, one type of
+    resource at a time. Here the data of any types of resources comes from
+    one query which selects only the columns of the fields asked for (so
+    the values, which can be large, are only read when they're wanted),
+    and the rows are read from the DB in batches as they're used.
+"""
+
+import logging
+
+from sqlalchemy import and_, or_, exists, func
+
+from hydra_base import db
+from hydra_base.db.model import Scenario, ResourceAttr, ResourceScenario, ResourceType,\
+    Dataset, DatasetOwner, Attr
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .resourceattrs import ref_key_columns
+
+log = logging.getLogger(__name__)
+
+#The column for each field which can be asked for.
+data_fields = {
+    'ref_key'          : ResourceAttr.ref_key,
+    'ref_id'           : func.coalesce(ResourceAttr.node_id,
+                                       ResourceAttr.link_id,
+                                       ResourceAttr.group_id,
+                                       ResourceAttr.network_id),
+    'resource_attr_id' : ResourceScenario.resource_attr_id,
+    'attr_id'          : ResourceAttr.attr_id,
+    'attr_name'        : Attr.name,
+    'attr_is_var'      : ResourceAttr.attr_is_var,
+    'source'           : ResourceScenario.source,
+    'dataset_id'       : ResourceScenario.dataset_id,
+    'type'             : Dataset.type,
+    'unit_id'          : Dataset.unit_id,
+    'name'             : Dataset.name,
+    'hash'             : Dataset.hash,
+    'value'            : Dataset.value,
+}
+
+default_fields = ('ref_key', 'ref_id', 'attr_id', 'value')
+
+network_ref_keys = ('NETWORK', 'NODE', 'LINK', 'GROUP')
+
+#The number of rows read from the DB at a time
+BATCH_SIZE = 1000
+
+def _get_scenario(network_id, scenario_id, user_id):
+    scenario_i = db.DBSession.query(Scenario).filter(Scenario.id == scenario_id).first()
+    if scenario_i is None:
+        raise ResourceNotFoundError("Scenario %s not found"%(scenario_id))
+    if scenario_i.network_id != network_id:
+        raise HydraError("Scenario %s is not in network %s"%(scenario_id, network_id))
+    scenario_i.network.check_read_permission(user_id)
+    return scenario_i
+
+def _type_filter(ref_keys, type_ids):
+    """
+        A filter for the resource attributes of resources with any of the types.
+    """
+    filters = []
+    for ref_key in ref_keys:
+        col_name = ref_key_columns[ref_key]
+        typed_ids = db.DBSession.query(getattr(ResourceType, col_name)).filter(
+            ResourceType.type_id.in_(type_ids),
+            ResourceType.ref_key == ref_key)
+        filters.append(and_(ResourceAttr.ref_key == ref_key,
+                            getattr(ResourceAttr, col_name).in_(typed_ids)))
+    return or_(*filters)
+
+@required_perms('get_network')
+def iter_network_data(network_id,
+                      scenario_id,
+                      ref_keys=None,
+                      attr_ids=None,
+                      type_ids=None,
+                      fields=None,
+                      **kwargs):
+    """
+        Get the data of the resources of a network in a scenario, as
+        tuples of the requested fields.
+
+        Args:
+            ref_keys (list): NETWORK, NODE, LINK and/or GROUP. All of them
+                             if not specified.
+            attr_ids (list): Only get the data of these attributes
+            type_ids (list): Only get the data of resources with these types
+            fields (list): The fields in each row, from data_fields.
+                           ref_key, ref_id, attr_id and value if not specified.
+
+        Returns:
+            tuple: The fields, and an iterator of the rows, ordered by
+                   resource attribute. Hidden datasets which the user can't
+                   see are left out.
+    """
+    user_id = kwargs.get('user_id')
+
+    fields = list(fields or default_fields)
+    unknown = [f for f in fields if f not in data_fields]
+    if len(unknown) > 0:
+        raise HydraError("Unknown fields %s. The fields are: %s"%(unknown, sorted(data_fields)))
+
+    ref_keys = [k.upper() for k in ref_keys] if ref_keys else list(network_ref_keys)
+    unknown = [k for k in ref_keys if k not in network_ref_keys]
+    if len(unknown) > 0:
+        raise HydraError('Resource type(s) %s not recognised.'%(unknown,))
+
+    _get_scenario(network_id, scenario_id, user_id)
+
+    #The resource scenarios of a scenario are all in its network, so
+    #there's no need to join the resources to filter on the network.
+    qry = db.DBSession.query(*[data_fields[f].label(f) for f in fields]).select_from(
+        ResourceScenario).join(
+            ResourceAttr, ResourceAttr.id == ResourceScenario.resource_attr_id).join(
+                Dataset, Dataset.id == ResourceScenario.dataset_id)
+
+    if 'attr_name' in fields:
+        qry = qry.join(Attr, Attr.id == ResourceAttr.attr_id)
+
+    qry = qry.filter(ResourceScenario.scenario_id == scenario_id,
+                     ResourceAttr.ref_key.in_(ref_keys),
+                     or_(Dataset.hidden == 'N',
+                         Dataset.created_by == user_id,
+                         exists().where(and_(DatasetOwner.dataset_id == Dataset.id,
+                                             DatasetOwner.user_id == user_id))))
+
+    if attr_ids:
+        qry = qry.filter(ResourceAttr.attr_id.in_(attr_ids))
+
+    if type_ids:
+        qry = qry.filter(_type_filter(ref_keys, type_ids))
+
+    qry = qry.order_by(ResourceScenario.resource_attr_id).yield_per(BATCH_SIZE)
+
+    log.info("Getting the %s of the %s data in scenario %s",
+             fields, ref_keys, scenario_id)
+
+    return fields, (tuple(row) for row in qry)
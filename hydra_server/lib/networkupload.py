@@ -0,0 +1,377 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Uploading a network in pieces, for networks too big to send to
+    add_network in one request.
+
+    An upload is started with the network's own details. Its nodes, links,
+    groups and scenarios are then sent in numbered chunks, each of which is
+    stored in a table as it arrives, so a failed upload can be carried on
+    by sending only the chunks which are missing. Sending a chunk again
+    replaces it. Once every chunk is there, the upload is committed: the
+    network is created and the chunks are inserted in bulk, in order, one
+    chunk at a time. If the commit fails, nothing is saved and the chunks
+    are kept, so it can be tried again.
+
+    As in add_network, new nodes, links, groups and resource attributes
+    have negative IDs, which other chunks can refer to.
+"""
+
+import json
+import logging
+import datetime
+
+from sqlalchemy import Table, Column, Integer, String, Text, DateTime, MetaData, and_
+from sqlalchemy.dialects import mysql
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Project, Network, ResourceAttr, ResourceScenario, ResourceGroupItem
+from hydra_base.lib.objects import JSONObject
+from hydra_base.lib import network as network_lib
+from hydra_base.lib import scenario as scenario_lib
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError, PermissionError
+
+from .util import chunked
+from . import dataingest, networkbulk
+
+log = logging.getLogger(__name__)
+
+#The kinds of chunk, in the order they are committed
+CHUNK_KINDS = ('nodes', 'links', 'resourcegroups', 'scenarios')
+
+_metadata = MetaData()
+
+network_uploads = Table('tNetworkUpload', _metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('user_id', Integer, nullable=False),
+                        Column('project_id', Integer, nullable=False),
+                        Column('network', Text().with_variant(mysql.LONGTEXT, 'mysql'), nullable=False),
+                        Column('status', String(1), nullable=False),
+                        Column('network_id', Integer, nullable=True),
+                        Column('cr_date', DateTime, nullable=False))
+
+upload_chunks = Table('tNetworkUploadChunk', _metadata,
+                      Column('upload_id', Integer, primary_key=True, autoincrement=False),
+                      Column('kind', String(20), primary_key=True),
+                      Column('chunk_index', Integer, primary_key=True, autoincrement=False),
+                      Column('data', Text().with_variant(mysql.LONGTEXT, 'mysql'), nullable=False))
+
+def create_tables(engine):
+    """
+        Create the upload tables if they are not already in the DB.
+        Safe to call on every startup.
+    """
+    _metadata.create_all(engine, checkfirst=True)
+
+def _get_upload(upload_id, user_id):
+    upload = db.DBSession.execute(network_uploads.select().where(
+        network_uploads.c.id == upload_id)).first()
+    if upload is None:
+        raise ResourceNotFoundError("Network upload %s not found"%(upload_id))
+    if upload.user_id != int(user_id):
+        raise PermissionError("Network upload %s was started by another user"%(upload_id))
+    return upload
+
+def _get_open_upload(upload_id, user_id):
+    upload = _get_upload(upload_id, user_id)
+    if upload.status != 'O':
+        raise HydraError("Network upload %s has already been committed, as network %s"
+                         %(upload_id, upload.network_id))
+    return upload
+
+def _get_chunk_indexes(upload_id):
+    rows = db.DBSession.query(upload_chunks.c.kind, upload_chunks.c.chunk_index).filter(
+        upload_chunks.c.upload_id == upload_id).all()
+    indexes = dict((kind, []) for kind in CHUNK_KINDS)
+    for row in rows:
+        indexes[row.kind].append(row.chunk_index)
+    for kind in indexes:
+        indexes[kind].sort()
+    return indexes
+
+def _iter_chunks(upload_id, kind):
+    """
+        Load the chunks of one kind one at a time, in order.
+    """
+    indexes = _get_chunk_indexes(upload_id)[kind]
+    for chunk_index in indexes:
+        row = db.DBSession.execute(upload_chunks.select().where(and_(
+            upload_chunks.c.upload_id == upload_id,
+            upload_chunks.c.kind == kind,
+            upload_chunks.c.chunk_index == chunk_index))).first()
+        yield [JSONObject(item) for item in json.loads(row.data)]
+
+@required_perms('add_network')
+def begin_network_upload(network, **kwargs):
+    """
+        Start uploading a network.
+
+        Args:
+            network (dict): The network, as for add_network, but without its
+                nodes, links, groups or scenarios.
+
+        Returns:
+            int: The ID of the upload
+    """
+    user_id = kwargs.get('user_id')
+
+    network = dict(network)
+    for kind in CHUNK_KINDS:
+        if network.pop(kind, None):
+            raise HydraError("Send the %s of the network with upload_network_chunk"%(kind))
+
+    project_id = network.get('project_id')
+    proj_i = db.DBSession.query(Project).filter(Project.id == project_id).first()
+    if proj_i is None:
+        raise HydraError("Project ID is none. A project ID must be specified on the Network")
+    proj_i.check_write_permission(user_id)
+
+    existing = db.DBSession.query(Network.id).filter(Network.project_id == project_id,
+                                                     Network.name == network.get('name')).first()
+    if existing is not None:
+        raise HydraError("A network with the name %s is already in project %s"
+                         %(network.get('name'), project_id))
+
+    result = db.DBSession.execute(network_uploads.insert().values(
+        user_id    = user_id,
+        project_id = project_id,
+        network    = json.dumps(network, default=str),
+        status     = 'O',
+        cr_date    = datetime.datetime.now()))
+    mark_changed(db.DBSession())
+
+    upload_id = result.inserted_primary_key[0]
+    log.info("Network upload %s started for network %s", upload_id, network.get('name'))
+    return upload_id
+
+def upload_network_chunk(upload_id, kind, chunk_index, items, **kwargs):
+    """
+        Store a chunk of an upload, replacing any chunk sent before with
+        the same kind and index.
+
+        Args:
+            kind (string): nodes, links, resourcegroups or scenarios
+            chunk_index (int): The position of the chunk among the chunks of
+                its kind. Chunks are committed in order of index.
+            items (list): The nodes, links, groups or scenarios, as dicts.
+                The data of a scenario can be split across chunks by sending
+                parts of it, each with the scenario's name.
+
+        Returns:
+            dict: The status of the upload, as get_network_upload_status
+    """
+    if kind not in CHUNK_KINDS:
+        raise HydraError("Chunk kind must be one of %s, not %s"%(', '.join(CHUNK_KINDS), kind))
+    if chunk_index is None or chunk_index < 0:
+        raise HydraError("Chunk index must be 0 or more")
+
+    _get_open_upload(upload_id, kwargs.get('user_id'))
+
+    db.DBSession.execute(upload_chunks.delete().where(and_(
+        upload_chunks.c.upload_id == upload_id,
+        upload_chunks.c.kind == kind,
+        upload_chunks.c.chunk_index == chunk_index)))
+    db.DBSession.execute(upload_chunks.insert().values(
+        upload_id   = upload_id,
+        kind        = kind,
+        chunk_index = chunk_index,
+        data        = json.dumps([dict(item) for item in items or []], default=str)))
+    mark_changed(db.DBSession())
+
+    return get_network_upload_status(upload_id, **kwargs)
+
+def get_network_upload_status(upload_id, **kwargs):
+    """
+        Returns:
+            dict: The 'status' of the upload (O for open, C for committed),
+                the 'network_id' once it is committed and the indexes of the
+                'chunks' of each kind which have been received.
+    """
+    upload = _get_upload(upload_id, kwargs.get('user_id'))
+    return {'upload_id'  : upload.id,
+            'status'     : upload.status,
+            'network_id' : upload.network_id,
+            'chunks'     : _get_chunk_indexes(upload_id)}
+
+def delete_network_upload(upload_id, **kwargs):
+    """
+        Abandon an upload, removing its chunks.
+    """
+    _get_upload(upload_id, kwargs.get('user_id'))
+    db.DBSession.execute(upload_chunks.delete().where(upload_chunks.c.upload_id == upload_id))
+    db.DBSession.execute(network_uploads.delete().where(network_uploads.c.id == upload_id))
+    mark_changed(db.DBSession())
+
+def _map_ids(mapping, id_map):
+    for item in mapping:
+        if item['temp_id'] is not None:
+            id_map[item['temp_id']] = item['id']
+
+def _map_id(id_map, temp_id, what):
+    """
+        Map an ID in the upload to the real ID of what was created for it.
+        The network is new, so there is nothing else its data or groups
+        can refer to: any other ID (such as that of a resource attribute in
+        another network) is rejected.
+    """
+    if temp_id is None:
+        return None
+    if temp_id not in id_map:
+        raise HydraError("%s %s is not in the upload"%(what, temp_id))
+    return id_map[temp_id]
+
+def _add_scenarios(network_id, upload_id, **kwargs):
+    """
+        Create the scenarios, without their data, so the default values of
+        types are added to them as the resources are added.
+
+        Returns:
+            dict: The ID of each scenario, keyed on name
+    """
+    scenario_ids = {}
+    for scenarios in _iter_chunks(upload_id, 'scenarios'):
+        for scenario in scenarios:
+            if scenario.name is None:
+                raise HydraError("A scenario in the upload has no name")
+            if scenario.name in scenario_ids:
+                continue
+            shell = JSONObject(scenario)
+            shell.resourcescenarios = None
+            shell.resourcegroupitems = None
+            scen_i = scenario_lib.add_scenario(network_id, shell, **kwargs)
+            scenario_ids[scenario.name] = scen_i.id
+    return scenario_ids
+
+def _add_scenario_data(scenario_id, scenario, ra_id_map, resource_id_maps, **kwargs):
+    """
+        Add the data and group items of part of a scenario. Data sent for a
+        resource attribute replaces its default value.
+    """
+    rscens = scenario.resourcescenarios or []
+    if len(rscens) > 0:
+        dataset_ids = dataingest.bulk_ingest_datasets([rs.dataset for rs in rscens],
+                                                      user_id=kwargs.get('user_id'),
+                                                      source=kwargs.get('app_name'))
+        rows = {}
+        for rs, dataset_id in zip(rscens, dataset_ids):
+            ra_id = _map_id(ra_id_map, rs.resource_attr_id, 'Resource attribute')
+            if dataset_id is None:
+                raise HydraError("The value of resource attribute %s in scenario %s can't be read"
+                                 %(rs.resource_attr_id, scenario.name))
+            rows[ra_id] = {'scenario_id'      : scenario_id,
+                           'resource_attr_id' : ra_id,
+                           'dataset_id'       : dataset_id,
+                           'source'           : kwargs.get('app_name')}
+
+        for id_chunk in chunked(list(rows)):
+            db.DBSession.execute(ResourceScenario.__table__.delete().where(and_(
+                ResourceScenario.__table__.c.scenario_id == scenario_id,
+                ResourceScenario.__table__.c.resource_attr_id.in_(id_chunk))))
+        db.DBSession.execute(ResourceScenario.__table__.insert(), list(rows.values()))
+
+    items = scenario.resourcegroupitems or []
+    if len(items) > 0:
+        ref_columns = {'NODE': 'node_id', 'LINK': 'link_id', 'GROUP': 'subgroup_id'}
+        rows = []
+        for item in items:
+            ref_key = (item.ref_key or '').upper()
+            if ref_key not in ref_columns:
+                raise HydraError('Resource type "%s" not recognised.'%(item.ref_key))
+            row = {'scenario_id' : scenario_id,
+                   'ref_key'     : ref_key,
+                   'group_id'    : _map_id(resource_id_maps['GROUP'], item.group_id, 'Group'),
+                   'node_id'     : None,
+                   'link_id'     : None,
+                   'subgroup_id' : None}
+            row[ref_columns[ref_key]] = _map_id(resource_id_maps[ref_key], item.ref_id,
+                                                ref_key.capitalize())
+            rows.append(row)
+        db.DBSession.execute(ResourceGroupItem.__table__.insert(), rows)
+
+    mark_changed(db.DBSession())
+
+@required_perms('add_network')
+def commit_network_upload(upload_id, **kwargs):
+    """
+        Create the network from the upload's chunks.
+
+        Returns:
+            dict: The 'network_id' and the number of nodes, links, groups
+                and scenarios added.
+    """
+    start_time = datetime.datetime.now()
+    upload = _get_open_upload(upload_id, kwargs.get('user_id'))
+
+    header = JSONObject(json.loads(upload.network))
+    for kind in CHUNK_KINDS:
+        header[kind] = []
+    net_i = network_lib.add_network(header, **kwargs)
+    network_id = net_i.id
+
+    #Resource attribute IDs, keyed on the IDs in the upload
+    ra_id_map = {}
+    network_ras = db.DBSession.query(ResourceAttr.id, ResourceAttr.attr_id).filter(
+        ResourceAttr.network_id == network_id).all()
+    ra_ids_by_attr = dict((ra.attr_id, ra.id) for ra in network_ras)
+    for ra in header.attributes or []:
+        if ra.id is not None and ra.attr_id in ra_ids_by_attr:
+            ra_id_map[ra.id] = ra_ids_by_attr[ra.attr_id]
+
+    scenario_ids = _add_scenarios(network_id, upload_id, **kwargs)
+
+    resource_id_maps = {'NODE': {}, 'LINK': {}, 'GROUP': {}}
+    counts = {'nodes': 0, 'links': 0, 'resourcegroups': 0}
+    for nodes in _iter_chunks(upload_id, 'nodes'):
+        result = networkbulk.add_nodes_and_links(network_id, nodes=nodes, **kwargs)
+        _map_ids(result['nodes'], resource_id_maps['NODE'])
+        counts['nodes'] += len(result['nodes'])
+        _map_ids(result['resource_attributes'], ra_id_map)
+
+    for links in _iter_chunks(upload_id, 'links'):
+        result = networkbulk.add_nodes_and_links(network_id,
+                                                 links=links,
+                                                 node_id_map=resource_id_maps['NODE'],
+                                                 **kwargs)
+        _map_ids(result['links'], resource_id_maps['LINK'])
+        counts['links'] += len(result['links'])
+        _map_ids(result['resource_attributes'], ra_id_map)
+
+    for groups in _iter_chunks(upload_id, 'resourcegroups'):
+        result = networkbulk.add_nodes_and_links(network_id, groups=groups, **kwargs)
+        _map_ids(result['groups'], resource_id_maps['GROUP'])
+        counts['resourcegroups'] += len(result['groups'])
+        _map_ids(result['resource_attributes'], ra_id_map)
+
+    for scenarios in _iter_chunks(upload_id, 'scenarios'):
+        for scenario in scenarios:
+            _add_scenario_data(scenario_ids[scenario.name], scenario, ra_id_map,
+                               resource_id_maps, **kwargs)
+
+    db.DBSession.execute(upload_chunks.delete().where(upload_chunks.c.upload_id == upload_id))
+    db.DBSession.execute(network_uploads.update().where(network_uploads.c.id == upload_id).values(
+        status='C', network_id=network_id))
+    mark_changed(db.DBSession())
+
+    log.info("Network upload %s committed as network %s in %s",
+             upload_id, network_id, datetime.datetime.now() - start_time)
+
+    return {'network_id'     : network_id,
+            'nodes'          : counts['nodes'],
+            'links'          : counts['links'],
+            'resourcegroups' : counts['resourcegroups'],
+            'scenarios'      : len(scenario_ids)}
@@ -0,0 +1,222 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Bulk creation of resource attributes.
+
+    Adding resource attributes one resource at a time means one query per
+    resource to look for existing ones. Here the requested
+    (ref_key, ref_id, attr_id) keys are put in a temporary table, and
+    the existing resource attributes are found by joining it to
+    tResourceAttr.
+"""
+
+import logging
+
+from sqlalchemy import Table, Column, Integer, String, MetaData, bindparam, select
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import ResourceAttr, Network, Project, Node, Link, ResourceGroup
+from hydra_base.lib.cache import cache as hydra_cache
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .util import chunked
+from . import attrindex
+
+log = logging.getLogger(__name__)
+
+#The column of tResourceAttr holding the ID of each type of resource.
+ref_key_columns = {
+    'NETWORK' : 'network_id',
+    'PROJECT' : 'project_id',
+    'NODE'    : 'node_id',
+    'LINK'    : 'link_id',
+    'GROUP'   : 'group_id',
+}
+
+#Resources which belong to a network.
+network_resources = {
+    'NODE'  : Node,
+    'LINK'  : Link,
+    'GROUP' : ResourceGroup,
+}
+
+resource_classes = {
+    'NETWORK' : Network,
+    'PROJECT' : Project,
+    'NODE'    : Node,
+    'LINK'    : Link,
+    'GROUP'   : ResourceGroup,
+}
+
+_keys_table = Table('tmp_resource_attr_keys', MetaData(),
+                    Column('idx', Integer, primary_key=True),
+                    Column('ref_key', String(60)),
+                    Column('ref_id', Integer),
+                    Column('attr_id', Integer),
+                    prefixes=['TEMPORARY'])
+
+def _check_permissions(ref_ids_by_key, user_id):
+    """
+        Check that all the resources exist and that the user can write to
+        the networks and projects they are in.
+
+        Returns:
+            set: The IDs of the networks containing the resources
+    """
+    network_ids = set(ref_ids_by_key.get('NETWORK', []))
+
+    for ref_key, resource_class in network_resources.items():
+        ref_ids = ref_ids_by_key.get(ref_key, set())
+        found = set()
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(resource_class.id, resource_class.network_id).filter(
+                resource_class.id.in_(id_chunk)).all()
+            for row in rows:
+                found.add(row.id)
+                network_ids.add(row.network_id)
+        if found != ref_ids:
+            raise ResourceNotFoundError("%s(s) %s not found"%(ref_key.lower(), sorted(ref_ids - found)))
+
+    for owner_class, owner_ids in ((Network, network_ids),
+                                   (Project, set(ref_ids_by_key.get('PROJECT', [])))):
+        found = set()
+        for id_chunk in chunked(list(owner_ids)):
+            for owner_i in db.DBSession.query(owner_class).filter(owner_class.id.in_(id_chunk)).all():
+                owner_i.check_write_permission(user_id)
+                found.add(owner_i.id)
+        if found != owner_ids:
+            raise ResourceNotFoundError("%s(s) %s not found"%(owner_class.__name__.lower(),
+                                                              sorted(owner_ids - found)))
+
+    return network_ids
+
+def _get_existing(connection, ref_keys):
+    """
+        Join the keys table to tResourceAttr to find the resource attributes
+        which are already there. One query per type of resource, as MySQL
+        can't use a temporary table twice in one query.
+
+        Returns:
+            dict: The resource attribute ID and attr_is_var for each key index
+    """
+    ra = ResourceAttr.__table__
+    keys = _keys_table
+    existing = {}
+    for ref_key in ref_keys:
+        ref_col = ra.c[ref_key_columns[ref_key]]
+        qry = keys.join(ra, (ref_col == keys.c.ref_id) & (ra.c.attr_id == keys.c.attr_id))
+        rows = connection.execute(
+            select(keys.c.idx, ra.c.id, ra.c.attr_is_var).select_from(qry).where(
+                keys.c.ref_key == ref_key)).fetchall()
+        for idx, ra_id, attr_is_var in rows:
+            existing[idx] = (ra_id, attr_is_var)
+    return existing
+
+def bulk_add_resource_attributes(resource_attributes, user_id):
+    """
+        Add resource attributes which are not already there, and update
+        attr_is_var on the ones which are.
+
+        Args:
+            resource_attributes (list): (ref_key, ref_id, attr_id, is_var) tuples.
+                is_var is 'Y', 'N', or None to leave existing resource attributes alone.
+            user_id (int): The user making the request
+
+        Returns:
+            list: The ID of the resource attribute for each input tuple, in the same order.
+    """
+    if len(resource_attributes) == 0:
+        return []
+
+    #Give each distinct key an index, so repeated keys get the same resource attribute.
+    key_idx = {}
+    is_var_by_idx = {}
+    ref_ids_by_key = {}
+    attr_ids = set()
+    for ref_key, ref_id, attr_id, is_var in resource_attributes:
+        ref_key = ref_key.upper()
+        if ref_key not in ref_key_columns:
+            raise HydraError('Resource type "%s" not recognised.'%(ref_key))
+        key = (ref_key, ref_id, attr_id)
+        idx = key_idx.setdefault(key, len(key_idx))
+        if is_var is not None:
+            is_var_by_idx[idx] = 'Y' if is_var in (True, 'Y') else 'N'
+        ref_ids_by_key.setdefault(ref_key, set()).add(ref_id)
+        attr_ids.add(attr_id)
+
+    found_attr_ids = set(a.id for a in attrindex.get_attributes_by_id(list(attr_ids)))
+    if found_attr_ids != attr_ids:
+        raise ResourceNotFoundError("Attribute(s) %s not found"%(sorted(attr_ids - found_attr_ids)))
+
+    network_ids = _check_permissions(ref_ids_by_key, user_id)
+
+    db.DBSession.flush()
+    connection = db.DBSession.connection()
+    _keys_table.drop(bind=connection, checkfirst=True)
+    _keys_table.create(bind=connection)
+    try:
+        connection.execute(_keys_table.insert(),
+                           [{'idx'     : idx,
+                             'ref_key' : key[0],
+                             'ref_id'  : key[1],
+                             'attr_id' : key[2]} for key, idx in key_idx.items()])
+
+        existing = _get_existing(connection, ref_ids_by_key.keys())
+
+        to_update = [{'b_id'     : existing[idx][0],
+                      'b_is_var' : is_var}
+                     for idx, is_var in is_var_by_idx.items()
+                     if idx in existing and existing[idx][1] != is_var]
+
+        to_insert = []
+        for key, idx in key_idx.items():
+            if idx in existing:
+                continue
+            ref_key, ref_id, attr_id = key
+            row = {'ref_key'     : ref_key,
+                   'attr_id'     : attr_id,
+                   'attr_is_var' : is_var_by_idx.get(idx, 'N')}
+            for col in ref_key_columns.values():
+                row[col] = None
+            row[ref_key_columns[ref_key]] = ref_id
+            to_insert.append(row)
+
+        log.info("%s resource attributes requested. %s exist, %s to add, %s to update",
+                 len(resource_attributes), len(existing), len(to_insert), len(to_update))
+
+        if len(to_update) > 0:
+            ra = ResourceAttr.__table__
+            connection.execute(ra.update().where(ra.c.id == bindparam('b_id')).values(
+                attr_is_var=bindparam('b_is_var')), to_update)
+
+        if len(to_insert) > 0:
+            connection.execute(ResourceAttr.__table__.insert(), to_insert)
+            existing = _get_existing(connection, ref_ids_by_key.keys())
+    finally:
+        _keys_table.drop(bind=connection, checkfirst=True)
+
+    mark_changed(db.DBSession())
+
+    #hydra_base caches the resource attributes of each network
+    for network_id in network_ids:
+        hydra_cache.delete('network_resource_attributes_%s'%(network_id))
+
+    ra_ids = []
+    for ref_key, ref_id, attr_id, _ in resource_attributes:
+        ra_ids.append(existing[key_idx[(ref_key.upper(), ref_id, attr_id)]][0])
+
+    return ra_ids
@@ -0,0 +1,124 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Getting many nodes, links or groups at once, with their data.
+
+    get_node and friends load one resource and then its data, and the
+    attributes and types of the resource are lazy-loaded as the complex
+    model is built. Here the resources of each chunk of IDs are loaded with
+    their attributes and types eagerly, in one query each, and their data
+    in one query per chunk of resource attributes, plus one for the metadata.
+"""
+
+import logging
+
+from sqlalchemy.orm import selectinload
+
+from hydra_base import db
+from hydra_base.db.model import Network, Scenario, ResourceAttr, ResourceType, TemplateType
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .util import chunked
+from . import metadatacache
+from .resourceattrs import network_resources
+
+log = logging.getLogger(__name__)
+
+def _check_networks(network_ids, user_id):
+    found = set()
+    for id_chunk in chunked(list(network_ids)):
+        for net_i in db.DBSession.query(Network).filter(Network.id.in_(id_chunk)).all():
+            net_i.check_read_permission(user_id)
+            found.add(net_i.id)
+    missing = set(network_ids) - found
+    if len(missing) > 0:
+        raise ResourceNotFoundError("Network(s) %s not found"%(sorted(missing)))
+
+def get_scenario_data(scenario_id, ra_ids, user_id):
+    """
+        Get the data of resource attributes in a scenario, as
+        hydra_base's get_resource_data does for one resource.
+
+        Returns:
+            dict: The resource scenarios, keyed on resource attribute ID
+    """
+    scenario_i = db.DBSession.query(Scenario).filter(Scenario.id == scenario_id).first()
+    if scenario_i is None:
+        raise ResourceNotFoundError("Scenario %s not found"%(scenario_id))
+    scenario_i.network.check_read_permission(user_id)
+
+    #get_data loads the metadata of the whole scenario each time it's called,
+    #so the metadata of just these datasets is got from the cache instead.
+    rs_by_ra = {}
+    for id_chunk in chunked(ra_ids):
+        for rs in scenario_i.get_data(user_id, ra_ids=id_chunk, include_metadata=False):
+            rs_by_ra[rs.resource_attr_id] = rs
+
+    datasets = [rs.dataset for rs in rs_by_ra.values()]
+    metadata = metadatacache.get_metadata([d.id for d in datasets],
+                                          dict((d.id, d.hash) for d in datasets))
+    for dataset in datasets:
+        if dataset.value is not None:
+            dataset.metadata = metadata.get(dataset.id, {})
+
+    return rs_by_ra
+
+@required_perms('get_network')
+def get_resources(ref_key, ref_ids, scenario_id=None, **kwargs):
+    """
+        Get nodes, links or groups, with their attributes and types, and
+        their data in a scenario if one is given.
+
+        Args:
+            ref_key (string): NODE, LINK or GROUP
+            ref_ids (list): The IDs of the resources
+
+        Returns:
+            tuple: The resources, in the same order as ref_ids (without
+                repeats), and a dict of their resource scenarios, keyed on
+                resource attribute ID (empty if there is no scenario_id)
+    """
+    user_id = kwargs.get('user_id')
+    resource_class = network_resources.get(ref_key)
+    if resource_class is None:
+        raise HydraError('Resource type "%s" not recognised.'%(ref_key))
+
+    ref_ids = list(dict.fromkeys(ref_ids or []))
+
+    resources = {}
+    for id_chunk in chunked(ref_ids):
+        qry = db.DBSession.query(resource_class).filter(resource_class.id.in_(id_chunk)).options(
+            selectinload(resource_class.attributes).joinedload(ResourceAttr.attr),
+            selectinload(resource_class.types).joinedload(ResourceType.templatetype).joinedload(TemplateType.template))
+        for resource_i in qry.all():
+            resources[resource_i.id] = resource_i
+
+    missing = [ref_id for ref_id in ref_ids if ref_id not in resources]
+    if len(missing) > 0:
+        raise ResourceNotFoundError("%s(s) %s not found"%(ref_key.capitalize(), missing))
+
+    _check_networks(set(r.network_id for r in resources.values()), user_id)
+
+    rs_by_ra = {}
+    if scenario_id is not None:
+        ra_ids = [ra.id for resource_i in resources.values() for ra in resource_i.attributes]
+        rs_by_ra = get_scenario_data(scenario_id, ra_ids, user_id)
+
+    log.info("%s %ss loaded, with %s resource scenarios",
+             len(resources), ref_key.lower(), len(rs_by_ra))
+
+    return [resources[ref_id] for ref_id in ref_ids], rs_by_ra
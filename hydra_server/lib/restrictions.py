@@ -0,0 +1,234 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Checking values against the data restrictions of typeattrs.
+
+    The restrictions of a typeattr are compiled into a RestrictionChecker.
+    Range, comparison and increasing / decreasing rules are checked on
+    numeric arrays, timeseries and numbers with numpy. If a value passes
+    all of them, it is valid. Otherwise, or if there are rules which can't
+    be checked with numpy, the value goes through hydra_base's
+    validate_value, so the verdict and error text are the same as hydra_base's.
+
+    Big batches of values are checked over a pool of processes. This module
+    is imported by the worker processes, so only imports what the checks need.
+"""
+
+import logging
+import threading
+import functools
+import multiprocessing
+from decimal import Decimal, InvalidOperation
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from hydra_base.util import dataset_util
+from hydra_base import config
+from hydra_base.exceptions import HydraError
+
+log = logging.getLogger(__name__)
+
+#Integers beyond this can't be compared exactly as floats
+_max_exact_int = 2**53
+
+def _as_numeric_array(value):
+    """
+        The values of a number, array or timeseries as a flat numeric array,
+        in the order hydra_base flattens them, or None if it isn't one.
+    """
+    if isinstance(value, pd.DataFrame):
+        arr = value.values
+    elif isinstance(value, list):
+        try:
+            arr = np.asarray(value)
+        except ValueError:
+            #A ragged array
+            return None
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        arr = np.asarray([value])
+    else:
+        return None
+
+    if arr.dtype.kind not in 'iuf' or arr.size == 0:
+        return None
+    if arr.dtype.kind in 'iu' and np.abs(arr).max() >= _max_exact_int:
+        return None
+
+    return arr.ravel()
+
+def _inner_float(bound, upper):
+    """
+        The float nearest to a bound which is not outside it. hydra_base
+        compares values with bounds as Decimals, so a value which is within
+        the float is also within the bound.
+    """
+    exact = Decimal(bound)
+    inner = float(exact)
+    if upper:
+        while Decimal(inner) > exact:
+            inner = np.nextafter(inner, -np.inf)
+    else:
+        while Decimal(inner) < exact:
+            inner = np.nextafter(inner, np.inf)
+    return inner
+
+def _get_comparable(restriction):
+    #hydra_base uses the first item of a restriction given as a list
+    if isinstance(restriction, list):
+        restriction = restriction[0]
+    if isinstance(restriction, bool) or not isinstance(restriction, (int, float)):
+        return None
+    if isinstance(restriction, int) and abs(restriction) >= _max_exact_int:
+        return None
+    return restriction
+
+def _in_range(low, high, arr, value):
+    return bool(np.all((arr >= low) & (arr <= high)))
+
+def _less_than(limit, arr, value):
+    return bool(np.all(arr < limit))
+
+def _less_than_eq(limit, arr, value):
+    return bool(np.all(arr <= limit))
+
+def _greater_than(limit, arr, value):
+    return bool(np.all(arr > limit))
+
+def _greater_than_eq(limit, arr, value):
+    return bool(np.all(arr >= limit))
+
+def _increasing(arr, value):
+    #hydra_base only accepts arrays and timeseries for this
+    if not isinstance(value, (list, pd.DataFrame)):
+        return False
+    return bool(np.all(np.diff(arr) >= 0))
+
+def _decreasing(arr, value):
+    if not isinstance(value, (list, pd.DataFrame)):
+        return False
+    return bool(np.all(np.diff(arr) <= 0))
+
+def _compile_VALUERANGE(restriction):
+    if not isinstance(restriction, (list, tuple)) or len(restriction) != 2:
+        return None
+    try:
+        low = _inner_float(restriction[0], upper=False)
+        high = _inner_float(restriction[1], upper=True)
+    except (InvalidOperation, ValueError, TypeError, OverflowError):
+        return None
+    return functools.partial(_in_range, low, high)
+
+def _compile_comparison(func):
+    def compile_restriction(restriction):
+        limit = _get_comparable(restriction)
+        if limit is None:
+            return None
+        return functools.partial(func, limit)
+    return compile_restriction
+
+#Restriction types which can be checked with numpy. Each takes the
+#restriction and returns a function of (array, value) which is True if the
+#value definitely passes, or None if this restriction can't be checked with numpy.
+_vector_compilers = {
+    'VALUERANGE'    : _compile_VALUERANGE,
+    'LESSTHAN'      : _compile_comparison(_less_than),
+    'LESSTHANEQ'    : _compile_comparison(_less_than_eq),
+    'GREATERTHAN'   : _compile_comparison(_greater_than),
+    'GREATERTHANEQ' : _compile_comparison(_greater_than_eq),
+    'INCREASING'    : lambda restriction: _increasing,
+    'DECREASING'    : lambda restriction: _decreasing,
+}
+
+class RestrictionChecker(object):
+    """
+        The data restrictions of a typeattr, ready to check any number of values.
+    """
+    def __init__(self, restriction):
+        self.restriction = restriction
+        #None if any of the restrictions can't be checked with numpy
+        self.vector_checks = []
+        for restriction_type, restriction_value in restriction.items():
+            compiler = _vector_compilers.get(restriction_type)
+            check = compiler(restriction_value) if compiler is not None else None
+            if check is None:
+                self.vector_checks = None
+                break
+            self.vector_checks.append(check)
+
+    def check(self, value):
+        """
+            Raises a HydraError if the value doesn't meet the restrictions.
+        """
+        if len(self.restriction) == 0:
+            return
+
+        if self.vector_checks is not None:
+            arr = _as_numeric_array(value)
+            if arr is not None and all(check(arr, value) for check in self.vector_checks):
+                return
+
+        dataset_util.validate_value(self.restriction, value)
+
+def check_values(items):
+    """
+        Check a batch of values.
+
+        Args:
+            items (list): (key, checkers, value) tuples. The checkers of a value
+                are applied in order, and the first failure is reported.
+
+        Returns:
+            list: (key, error text) for each value which fails
+    """
+    failures = []
+    for key, checkers, value in items:
+        try:
+            for checker in checkers:
+                checker.check(value)
+        except HydraError as e:
+            failures.append((key, e.args[0]))
+    return failures
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    workers = config.getint('hydra_server', 'validation_workers', 4)
+    if workers < 2:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            #Forking a process with open DB connections and running threads
+            #isn't safe, so start the workers afresh.
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def check_batches(batches):
+    """
+        Check batches of values, over the process pool if there is more than one.
+
+        Returns:
+            iterator: The failures of each batch, as returned by check_values, in order.
+    """
+    pool = _get_pool() if len(batches) > 1 else None
+    if pool is None:
+        return map(check_values, batches)
+    log.info("Checking %s batches of values over the process pool", len(batches))
+    return pool.map(check_values, batches)
@@ -0,0 +1,329 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    A spatial index of the nodes of each network, for finding the nodes
+    and links inside a rectangle (such as the part of a network shown on
+    a map) without loading the whole network.
+
+    The nodes are put in a grid of square cells, keyed on the cell's
+    column and row, so only the cells which overlap a rectangle are looked
+    in. The index and the network's extents are kept up to date as nodes
+    are added, moved and deleted, rather than being reloaded.
+"""
+
+import math
+import logging
+import threading
+
+from sqlalchemy import or_
+
+from hydra_base import db
+from hydra_base.db.model import Network, Node, Link
+from hydra_base.util.permissions import required_perms
+from hydra_base import config
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import LRUCache, invalidate_after_commit, update_after_commit
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#The average number of nodes in each cell when an index is built
+NODES_PER_CELL = 8
+
+#The index of each network, keyed on network ID
+network_indexes = LRUCache(config.getint('hydra_server', 'spatial_cache_size', 100))
+
+#Counts the changes to each network's nodes, so an index loaded while a
+#change was being committed isn't kept.
+_generations = {}
+_lock = threading.RLock()
+
+def _to_float(value):
+    return float(value) if value is not None else None
+
+class GridIndex(object):
+    """
+        The nodes of a network in a grid. Nodes without an x or y are
+        kept for the extents, but not put in the grid.
+
+        Coordinates are kept as floats: the DB gives them as Decimals,
+        which can't be mixed with the float bounds of a query.
+    """
+    def __init__(self, network_id, nodes):
+        """
+            Args:
+                nodes (list): (node_id, x, y, status) tuples
+        """
+        self.network_id = network_id
+        self.nodes = {}
+        self._lock = threading.RLock()
+        for node_id, x, y, status in nodes:
+            self.nodes[node_id] = (_to_float(x), _to_float(y), status)
+        self._build()
+
+    def _build(self):
+        placed = [(x, y) for x, y, _ in self.nodes.values() if x is not None and y is not None]
+        self.built_size = len(self.nodes)
+
+        self.cell_size = 1.0
+        if len(placed) > 0:
+            width = max(p[0] for p in placed) - min(p[0] for p in placed)
+            height = max(p[1] for p in placed) - min(p[1] for p in placed)
+            cells_per_side = max(1, int(math.sqrt(len(placed) / float(NODES_PER_CELL))))
+            if max(width, height) > 0:
+                self.cell_size = float(max(width, height)) / cells_per_side
+
+        self.cells = {}
+        for node_id, (x, y, _) in self.nodes.items():
+            self._add_to_cell(node_id, x, y)
+        self._extents = None
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def _add_to_cell(self, node_id, x, y):
+        if x is not None and y is not None:
+            self.cells.setdefault(self._cell(x, y), set()).add(node_id)
+
+    def _remove_from_cell(self, node_id, x, y):
+        if x is not None and y is not None:
+            cell = self._cell(x, y)
+            self.cells[cell].discard(node_id)
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def _on_boundary(self, x, y):
+        min_x, max_x, min_y, max_y = self._extents
+        return x in (min_x, max_x) or y in (min_y, max_y)
+
+    def set_node(self, node_id, x, y, status):
+        x, y = _to_float(x), _to_float(y)
+        with self._lock:
+            old = self.nodes.get(node_id)
+            if old is not None:
+                self._remove_from_cell(node_id, old[0], old[1])
+                #Moving a node off the edge of the network can shrink it,
+                #which can only be worked out from all the nodes.
+                if self._extents is not None and self._on_boundary(old[0], old[1]):
+                    self._extents = None
+            self.nodes[node_id] = (x, y, status)
+            self._add_to_cell(node_id, x, y)
+
+            if self._extents is not None:
+                min_x, max_x, min_y, max_y = self._extents
+                if x is not None:
+                    min_x = x if min_x is None else min(min_x, x)
+                    max_x = x if max_x is None else max(max_x, x)
+                if y is not None:
+                    min_y = y if min_y is None else min(min_y, y)
+                    max_y = y if max_y is None else max(max_y, y)
+                self._extents = (min_x, max_x, min_y, max_y)
+
+            #Rebuild the grid when the network has grown a lot, as the
+            #cells will have too many nodes in them.
+            if len(self.nodes) > 4 * self.built_size + 64:
+                self._build()
+
+    def remove_node(self, node_id):
+        with self._lock:
+            old = self.nodes.pop(node_id, None)
+            if old is not None:
+                self._remove_from_cell(node_id, old[0], old[1])
+                if self._extents is not None and self._on_boundary(old[0], old[1]):
+                    self._extents = None
+
+    def get_extents(self):
+        """
+            Returns:
+                tuple: (min_x, max_x, min_y, max_y) of all the nodes, or None
+                    for any of them without an x or y
+        """
+        with self._lock:
+            if self._extents is None:
+                x = [n[0] for n in self.nodes.values() if n[0] is not None]
+                y = [n[1] for n in self.nodes.values() if n[1] is not None]
+                self._extents = (min(x) if x else None,
+                                 max(x) if x else None,
+                                 min(y) if y else None,
+                                 max(y) if y else None)
+            return self._extents
+
+    def get_node_ids(self, min_x, min_y, max_x, max_y, status='A'):
+        """
+            Returns:
+                list: The IDs of the nodes with the given status inside the
+                    rectangle (including its edges), in ascending order
+        """
+        min_x, min_y, max_x, max_y = [float(v) for v in (min_x, min_y, max_x, max_y)]
+        with self._lock:
+            min_col, min_row = self._cell(min_x, min_y)
+            max_col, max_row = self._cell(max_x, max_y)
+            num_cells = (max_col - min_col + 1) * (max_row - min_row + 1)
+
+            #For a large rectangle it's quicker to go through the cells
+            #there are than all the cells there could be.
+            if num_cells > len(self.cells):
+                candidates = [self.cells[c] for c in self.cells
+                              if min_col <= c[0] <= max_col and min_row <= c[1] <= max_row]
+            else:
+                candidates = [self.cells[(col, row)]
+                              for col in range(min_col, max_col + 1)
+                              for row in range(min_row, max_row + 1)
+                              if (col, row) in self.cells]
+
+            node_ids = []
+            for cell in candidates:
+                for node_id in cell:
+                    x, y, node_status = self.nodes[node_id]
+                    if node_status == status and min_x <= x <= max_x and min_y <= y <= max_y:
+                        node_ids.append(node_id)
+            return sorted(node_ids)
+
+def _load_index(network_id):
+    nodes = db.DBSession.query(Node.id, Node.x, Node.y, Node.status).filter(
+        Node.network_id == network_id).all()
+    index = GridIndex(network_id, nodes)
+    log.info("Built the spatial index of network %s: %s nodes in %s cells",
+             network_id, len(index.nodes), len(index.cells))
+    return index
+
+def get_index(network_id):
+    index = network_indexes.get(network_id)
+    if index is not None:
+        return index
+
+    with _lock:
+        generation = _generations.get(network_id, 0)
+
+    index = _load_index(network_id)
+
+    with _lock:
+        #Don't keep an index loaded before a change was applied
+        if _generations.get(network_id, 0) == generation:
+            network_indexes.set(network_id, index)
+    return index
+
+def _apply_changes(network_id, changes):
+    with _lock:
+        _generations[network_id] = _generations.get(network_id, 0) + 1
+        index = network_indexes.get(network_id)
+        if index is None:
+            return
+        for node_id, node in changes.items():
+            if node is None:
+                index.remove_node(node_id)
+            else:
+                index.set_node(node_id, node.x, node.y, node.status)
+
+def _invalidate(network_id):
+    with _lock:
+        _generations[network_id] = _generations.get(network_id, 0) + 1
+        network_indexes.pop(network_id)
+
+def invalidate(network_id):
+    """
+        Drop the index of a network, for changes which aren't made one node
+        at a time, such as updating or purging a whole network.
+    """
+    invalidate_after_commit(lambda: _invalidate(network_id))
+
+def get_node_network_id(node_id):
+    """
+        Get the network of a node, before the node is deleted.
+    """
+    row = db.DBSession.query(Node.network_id).filter(Node.id == node_id).first()
+    if row is None:
+        raise ResourceNotFoundError("Node %s not found"%(node_id))
+    return row.network_id
+
+def nodes_changed(network_id, node_ids):
+    """
+        Update the index of a network with the nodes as they are now in the
+        DB, once they are committed. Nodes no longer in the DB are removed.
+    """
+    changes = dict((node_id, None) for node_id in node_ids)
+    for id_chunk in chunked(list(changes)):
+        rows = db.DBSession.query(Node.id, Node.x, Node.y, Node.status).filter(
+            Node.network_id == network_id, Node.id.in_(id_chunk)).all()
+        for row in rows:
+            changes[row.id] = row
+    update_after_commit(lambda: _apply_changes(network_id, changes))
+
+def _check_network(network_id, user_id):
+    net_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if net_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id))
+    net_i.check_read_permission(user_id)
+
+def get_network_extents(network_id, **kwargs):
+    """
+        Get the extents of a network from its index, as hydra_base's
+        get_network_extents does: the x extent is 0 to 1 if none of the
+        nodes have an x, and likewise for y.
+    """
+    index = get_index(network_id)
+    if len(index.nodes) == 0:
+        return dict(network_id=network_id, min_x=None, max_x=None, min_y=None, max_y=None)
+
+    min_x, max_x, min_y, max_y = index.get_extents()
+    if min_x is None:
+        min_x, max_x = 0, 1
+    if min_y is None:
+        min_y, max_y = 0, 1
+
+    return dict(network_id=network_id, min_x=min_x, max_x=max_x, min_y=min_y, max_y=max_y)
+
+@required_perms('get_network')
+def get_resources_in_extent(network_id, min_x, min_y, max_x, max_y, include_links=True, **kwargs):
+    """
+        Get the active nodes inside a rectangle and, if include_links is
+        set, the active links with at least one end inside it.
+
+        Returns:
+            dict: 'nodes', with the id, name, x and y of each node, and
+                'links', with the id, name, node_1_id and node_2_id of each link
+    """
+    if min_x > max_x or min_y > max_y:
+        raise HydraError("Invalid extent: the minimum must not be more than the maximum")
+
+    _check_network(network_id, kwargs.get('user_id'))
+
+    node_ids = get_index(network_id).get_node_ids(min_x, min_y, max_x, max_y)
+
+    nodes = []
+    for id_chunk in chunked(node_ids):
+        rows = db.DBSession.query(Node.id, Node.name, Node.x, Node.y).filter(
+            Node.id.in_(id_chunk)).all()
+        nodes.extend({'id': r.id, 'name': r.name, 'x': _to_float(r.x), 'y': _to_float(r.y)} for r in rows)
+    nodes.sort(key=lambda n: n['id'])
+
+    links = {}
+    if include_links is True:
+        #Each ID is used twice in the query
+        for id_chunk in chunked(node_ids, 450):
+            rows = db.DBSession.query(Link.id, Link.name, Link.node_1_id, Link.node_2_id).filter(
+                Link.network_id == network_id,
+                Link.status == 'A',
+                or_(Link.node_1_id.in_(id_chunk), Link.node_2_id.in_(id_chunk))).all()
+            for r in rows:
+                links[r.id] = {'id'        : r.id,
+                               'name'      : r.name,
+                               'node_1_id' : r.node_1_id,
+                               'node_2_id' : r.node_2_id}
+
+    return {'nodes' : nodes,
+            'links' : [links[link_id] for link_id in sorted(links)]}
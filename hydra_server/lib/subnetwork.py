@@ -0,0 +1,355 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Getting part of a network: the nodes in some groups, of some types
+    or inside a rectangle, the links between them and their data.
+
+    The nodes are chosen with ID-only queries (and the spatial index for
+    a rectangle), and only then are the nodes, links, attributes, types
+    and data of the chosen resources loaded, a chunk of IDs at a time.
+"""
+
+import logging
+
+from hydra_base import db
+from hydra_base.db.model import Network, Scenario, Node, Link, ResourceGroup,\
+    ResourceGroupItem, ResourceAttr, ResourceType, TemplateType, Attr
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .util import chunked
+from .resourceattrs import ref_key_columns
+from .resourcebatch import get_scenario_data
+from . import spatial, topology
+
+log = logging.getLogger(__name__)
+
+def _get_group_items(network_id, group_ids, scenario_ids):
+    """
+        Get the nodes and links in groups, including the ones in their
+        subgroups, in any of the scenarios.
+
+        Returns:
+            tuple: The IDs of the groups (with their subgroups), the nodes
+                and the links in them
+    """
+    group_ids = set(group_ids)
+    node_ids = set()
+    link_ids = set()
+    new_group_ids = set(group_ids)
+    while len(new_group_ids) > 0:
+        subgroup_ids = set()
+        for id_chunk in chunked(list(new_group_ids)):
+            rows = db.DBSession.query(ResourceGroupItem.node_id,
+                                      ResourceGroupItem.link_id,
+                                      ResourceGroupItem.subgroup_id).filter(
+                                          ResourceGroupItem.group_id.in_(id_chunk),
+                                          ResourceGroupItem.scenario_id.in_(scenario_ids)).all()
+            for row in rows:
+                if row.node_id is not None:
+                    node_ids.add(row.node_id)
+                if row.link_id is not None:
+                    link_ids.add(row.link_id)
+                if row.subgroup_id is not None:
+                    subgroup_ids.add(row.subgroup_id)
+        new_group_ids = subgroup_ids - group_ids
+        group_ids.update(new_group_ids)
+
+    #The ends of the links in the groups are needed for the links to be included
+    for id_chunk in chunked(list(link_ids)):
+        rows = db.DBSession.query(Link.node_1_id, Link.node_2_id).filter(
+            Link.network_id == network_id,
+            Link.id.in_(id_chunk)).all()
+        for row in rows:
+            node_ids.add(row.node_1_id)
+            node_ids.add(row.node_2_id)
+
+    return group_ids, node_ids
+
+def _get_typed_node_ids(network_id, type_ids):
+    rows = db.DBSession.query(Node.id).join(ResourceType, ResourceType.node_id == Node.id).filter(
+        Node.network_id == network_id,
+        ResourceType.type_id.in_(type_ids)).all()
+    return set(row.id for row in rows)
+
+def _get_nodes(network_id, node_ids):
+    nodes = []
+    for id_chunk in chunked(sorted(node_ids)):
+        rows = db.DBSession.query(Node.id,
+                                  Node.name,
+                                  Node.description,
+                                  Node.x,
+                                  Node.y,
+                                  Node.layout,
+                                  Node.status).filter(
+                                      Node.network_id == network_id,
+                                      Node.status == 'A',
+                                      Node.id.in_(id_chunk)).all()
+        nodes.extend({'id'          : r.id,
+                      'name'        : r.name,
+                      'description' : r.description,
+                      'x'           : float(r.x) if r.x is not None else None,
+                      'y'           : float(r.y) if r.y is not None else None,
+                      'layout'      : r.layout,
+                      'status'      : r.status} for r in rows)
+    return nodes
+
+def _get_links(network_id, node_ids):
+    """
+        Get the active links with both ends in node_ids.
+    """
+    links = []
+    for id_chunk in chunked(sorted(node_ids)):
+        rows = db.DBSession.query(Link.id,
+                                  Link.name,
+                                  Link.description,
+                                  Link.node_1_id,
+                                  Link.node_2_id,
+                                  Link.layout,
+                                  Link.status).filter(
+                                      Link.network_id == network_id,
+                                      Link.status == 'A',
+                                      Link.node_1_id.in_(id_chunk)).all()
+        links.extend({'id'          : r.id,
+                      'name'        : r.name,
+                      'description' : r.description,
+                      'node_1_id'   : r.node_1_id,
+                      'node_2_id'   : r.node_2_id,
+                      'layout'      : r.layout,
+                      'status'      : r.status} for r in rows if r.node_2_id in node_ids)
+    links.sort(key=lambda l: l['id'])
+    return links
+
+def _get_groups(network_id, group_ids):
+    groups = []
+    for id_chunk in chunked(sorted(group_ids)):
+        rows = db.DBSession.query(ResourceGroup.id,
+                                  ResourceGroup.name,
+                                  ResourceGroup.description,
+                                  ResourceGroup.layout,
+                                  ResourceGroup.status).filter(
+                                      ResourceGroup.network_id == network_id,
+                                      ResourceGroup.status == 'A',
+                                      ResourceGroup.id.in_(id_chunk)).all()
+        groups.extend({'id'          : r.id,
+                       'name'        : r.name,
+                       'description' : r.description,
+                       'layout'      : r.layout,
+                       'status'      : r.status} for r in rows)
+    return groups
+
+def _add_attributes_and_types(ref_key, resources):
+    """
+        Add the 'attributes' and 'types' of each resource.
+
+        Returns:
+            list: The IDs of the resource attributes
+    """
+    col_name = ref_key_columns[ref_key]
+    by_id = {}
+    for resource in resources:
+        resource['attributes'] = []
+        resource['types'] = []
+        by_id[resource['id']] = resource
+
+    ra_ids = []
+    for id_chunk in chunked(list(by_id)):
+        ra_col = getattr(ResourceAttr, col_name)
+        rows = db.DBSession.query(ra_col.label('ref_id'),
+                                  ResourceAttr.id,
+                                  ResourceAttr.attr_id,
+                                  ResourceAttr.attr_is_var,
+                                  Attr.name).join(Attr, Attr.id == ResourceAttr.attr_id).filter(
+                                      ra_col.in_(id_chunk)).all()
+        for r in rows:
+            by_id[r.ref_id]['attributes'].append({'id'          : r.id,
+                                                  'attr_id'     : r.attr_id,
+                                                  'attr_is_var' : r.attr_is_var,
+                                                  'name'        : r.name})
+            ra_ids.append(r.id)
+
+        rt_col = getattr(ResourceType, col_name)
+        rows = db.DBSession.query(rt_col.label('ref_id'),
+                                  TemplateType.id,
+                                  TemplateType.name,
+                                  TemplateType.template_id).join(
+                                      TemplateType, TemplateType.id == ResourceType.type_id).filter(
+                                          rt_col.in_(id_chunk)).all()
+        for r in rows:
+            by_id[r.ref_id]['types'].append({'id'          : r.id,
+                                             'name'        : r.name,
+                                             'template_id' : r.template_id})
+
+    return ra_ids
+
+def _get_group_item_rows(scenario_id, group_ids, node_ids, link_ids):
+    """
+        Get the items of the groups in a scenario which are in the subnetwork.
+    """
+    items = []
+    for id_chunk in chunked(sorted(group_ids)):
+        rows = db.DBSession.query(ResourceGroupItem.id,
+                                  ResourceGroupItem.group_id,
+                                  ResourceGroupItem.ref_key,
+                                  ResourceGroupItem.node_id,
+                                  ResourceGroupItem.link_id,
+                                  ResourceGroupItem.subgroup_id).filter(
+                                      ResourceGroupItem.scenario_id == scenario_id,
+                                      ResourceGroupItem.group_id.in_(id_chunk)).all()
+        for r in rows:
+            if r.node_id is not None and r.node_id not in node_ids:
+                continue
+            if r.link_id is not None and r.link_id not in link_ids:
+                continue
+            if r.subgroup_id is not None and r.subgroup_id not in group_ids:
+                continue
+            items.append({'id'          : r.id,
+                          'group_id'    : r.group_id,
+                          'ref_key'     : r.ref_key,
+                          'node_id'     : r.node_id,
+                          'link_id'     : r.link_id,
+                          'subgroup_id' : r.subgroup_id})
+    return items
+
+def _get_resourcescenarios(scenario_id, ra_ids, user_id):
+    resourcescenarios = []
+    rs_by_ra = get_scenario_data(scenario_id, ra_ids, user_id)
+    for ra_id in sorted(rs_by_ra):
+        dataset = rs_by_ra[ra_id].dataset
+        resourcescenarios.append({'resource_attr_id' : ra_id,
+                                  'dataset'          : {'id'       : dataset.id,
+                                                        'type'     : dataset.type,
+                                                        'unit_id'  : dataset.unit_id,
+                                                        'name'     : dataset.name,
+                                                        'hash'     : dataset.hash,
+                                                        'hidden'   : dataset.hidden,
+                                                        'value'    : dataset.value,
+                                                        'metadata' : dataset.metadata}})
+    return resourcescenarios
+
+@required_perms('get_network')
+def get_subnetwork(network_id,
+                   group_ids=None,
+                   type_ids=None,
+                   extent=None,
+                   include_connected=False,
+                   scenario_ids=None,
+                   include_data=True,
+                   **kwargs):
+    """
+        Get the active nodes of a network which are in any of the groups,
+        have any of the types and/or are inside the extent (if more than one
+        of these is given, the nodes must match all of them), with the links
+        between those nodes.
+
+        Args:
+            group_ids (list): The groups. Their items are taken from all the
+                scenarios in scenario_ids. A link in a group brings in both
+                of its nodes.
+            type_ids (list): The node types
+            extent (list): min_x, min_y, max_x, max_y
+            include_connected (bool): Also include the nodes linked to the
+                chosen nodes, so none of their links are left out
+            scenario_ids (list): The scenarios to return. All of the
+                network's active scenarios if not specified.
+            include_data (bool): Include the data of the resources in each scenario
+
+        Returns:
+            dict: The network's id and name, its 'nodes', 'links' and
+                'resourcegroups', with their attributes and types, and its
+                'scenarios', with the group items and data of the subnetwork.
+    """
+    user_id = kwargs.get('user_id')
+
+    if not group_ids and not type_ids and extent is None:
+        raise HydraError("A subnetwork needs group IDs, type IDs or an extent")
+
+    net_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if net_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id))
+    net_i.check_read_permission(user_id)
+
+    scenario_qry = db.DBSession.query(Scenario.id, Scenario.name).filter(
+        Scenario.network_id == network_id)
+    if scenario_ids:
+        scenario_rows = scenario_qry.filter(Scenario.id.in_(scenario_ids)).all()
+        missing = set(scenario_ids) - set(r.id for r in scenario_rows)
+        if len(missing) > 0:
+            raise ResourceNotFoundError("Scenario(s) %s not found in network %s"%
+                                        (sorted(missing), network_id))
+    else:
+        scenario_rows = scenario_qry.filter(Scenario.status == 'A').all()
+    scenario_rows = sorted(scenario_rows, key=lambda s: s.id)
+
+    node_ids = None
+    group_ids = set(group_ids or [])
+
+    if len(group_ids) > 0:
+        group_ids, node_ids = _get_group_items(network_id,
+                                               group_ids,
+                                               [s.id for s in scenario_rows])
+
+    if type_ids:
+        typed_node_ids = _get_typed_node_ids(network_id, type_ids)
+        node_ids = typed_node_ids if node_ids is None else node_ids & typed_node_ids
+
+    if extent is not None:
+        if len(extent) != 4:
+            raise HydraError("An extent must be min_x, min_y, max_x and max_y")
+        min_x, min_y, max_x, max_y = extent
+        if min_x > max_x or min_y > max_y:
+            raise HydraError("Invalid extent: the minimum must not be more than the maximum")
+        extent_node_ids = set(spatial.get_index(network_id).get_node_ids(min_x, min_y, max_x, max_y))
+        node_ids = extent_node_ids if node_ids is None else node_ids & extent_node_ids
+
+    if include_connected is True and len(node_ids) > 0:
+        graph = topology.get_graph(network_id, user_id)
+        node_ids = node_ids | graph.get_neighbours(node_ids)
+
+    nodes = _get_nodes(network_id, node_ids)
+    node_ids = set(n['id'] for n in nodes)
+    links = _get_links(network_id, node_ids)
+    link_ids = set(l['id'] for l in links)
+    groups = _get_groups(network_id, group_ids)
+    group_ids = set(g['id'] for g in groups)
+
+    ra_ids = []
+    ra_ids.extend(_add_attributes_and_types('NODE', nodes))
+    ra_ids.extend(_add_attributes_and_types('LINK', links))
+    ra_ids.extend(_add_attributes_and_types('GROUP', groups))
+
+    scenarios = []
+    for scenario_row in scenario_rows:
+        scenario = {'id'                 : scenario_row.id,
+                    'name'               : scenario_row.name,
+                    'network_id'         : network_id,
+                    'resourcegroupitems' : _get_group_item_rows(scenario_row.id,
+                                                                group_ids,
+                                                                node_ids,
+                                                                link_ids)}
+        if include_data is True:
+            scenario['resourcescenarios'] = _get_resourcescenarios(scenario_row.id, ra_ids, user_id)
+        scenarios.append(scenario)
+
+    log.info("Subnetwork of network %s: %s nodes, %s links, %s groups",
+             network_id, len(nodes), len(links), len(groups))
+
+    return {'id'             : network_id,
+            'name'           : net_i.name,
+            'nodes'          : nodes,
+            'links'          : links,
+            'resourcegroups' : groups,
+            'scenarios'      : scenarios}
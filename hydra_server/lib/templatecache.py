@@ -0,0 +1,189 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Templates with the types and typeattrs they inherit merged in.
+
+    Building a template walks up its chain of parent templates through the
+    ORM (Template.get_types), which is slow for big templates. The result
+    is kept here, keyed on template ID.
+
+    A change to one template can change the templates which inherit from
+    it, so every template write drops all of them. The version changes at
+    the same time, so things built from the templates can tell they are
+    out of date.
+
+    The cached objects are shared between requests, so must not be modified.
+"""
+
+import logging
+
+from hydra_base import db
+from hydra_base.db.model import Template, TemplateType, TypeAttr
+from hydra_base.lib import template
+from hydra_base.lib.objects import JSONObject
+from hydra_base.util.permissions import required_perms
+from hydra_base import config
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import VersionedCache
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+class ResolvedTemplate(object):
+    """
+        A template, as returned by hydra_base's get_template,
+        with its types and typeattrs indexed by ID.
+    """
+    def __init__(self, template_j):
+        self.template = template_j
+        self.types_by_id = {}
+        self.typeattrs_by_id = {}
+        for ttype in template_j.templatetypes:
+            self.types_by_id[ttype.id] = ttype
+            for typeattr in ttype.typeattrs:
+                self.typeattrs_by_id.setdefault(typeattr.id, typeattr)
+        #Built on first use by typeindex
+        self.type_index = None
+
+def _load(template_id):
+    tmpl_i = db.DBSession.query(Template).filter(Template.id == template_id).first()
+    if tmpl_i is None:
+        raise ResourceNotFoundError("Template %s not found"%(template_id))
+
+    tmpl_j = JSONObject(tmpl_i)
+    tmpl_j.templatetypes = tmpl_i.get_types()
+
+    log.info("Loaded template %s with %s types", template_id, len(tmpl_j.templatetypes))
+
+    return ResolvedTemplate(tmpl_j)
+
+templates = VersionedCache(_load, config.getint('hydra_server', 'template_cache_size', 100))
+
+def invalidate():
+    templates.invalidate()
+
+def get_version():
+    return templates.version
+
+def get_resolved_template(template_id):
+    return templates.get(template_id)
+
+def _get_template_ids(type_ids):
+    """
+        Returns:
+            dict: The ID of the template of each type
+    """
+    template_ids = {}
+    for id_chunk in chunked(list(set(type_ids))):
+        rows = db.DBSession.query(TemplateType.id, TemplateType.template_id).filter(
+            TemplateType.id.in_(id_chunk)).all()
+        for row in rows:
+            template_ids[row.id] = row.template_id
+
+    missing = set(type_ids) - set(template_ids)
+    if missing:
+        raise ResourceNotFoundError("Template type(s) %s not found"%(sorted(missing)))
+
+    return template_ids
+
+def _get_type(template_id, type_id):
+    ttype = get_resolved_template(template_id).types_by_id.get(type_id)
+    if ttype is None:
+        #A type which is the parent of another type in the same template
+        #is merged into its child by get_types, so build it separately.
+        tmpl_i = db.DBSession.query(Template).filter(Template.id == template_id).one()
+        ttype = tmpl_i.get_type(type_id)
+    return ttype
+
+def get_types_by_id(type_ids):
+    """
+        Get template types, with their inherited data, with one query to
+        find their templates.
+
+        Returns:
+            dict: The types, keyed on ID
+    """
+    return dict((type_id, _get_type(template_id, type_id))
+                for type_id, template_id in _get_template_ids(type_ids).items())
+
+@required_perms("get_template")
+def get_template(template_id, **kwargs):
+    return get_resolved_template(template_id).template
+
+@required_perms("get_template")
+def get_templates(load_all=True, include_inactive=False, **kwargs):
+    """
+        Get all the templates, with their types and typeattrs if 'load_all' is True.
+        Only active templates are returned unless 'include_inactive' is True.
+    """
+    if load_all is True:
+        qry = db.DBSession.query(Template.id)
+    else:
+        qry = db.DBSession.query(Template)
+
+    if include_inactive is False:
+        qry = qry.filter(Template.status == 'A')
+
+    if load_all is True:
+        return [get_resolved_template(t.id).template for t in qry.all()]
+
+    return [JSONObject(t) for t in qry.all()]
+
+@required_perms("get_template")
+def get_template_by_name(name, **kwargs):
+    tmpl = db.DBSession.query(Template.id).filter(Template.name == name).first()
+    if tmpl is None:
+        log.info("%s is not a valid identifier for a template", name)
+        raise HydraError('Template "%s" not found'%name)
+    return get_resolved_template(tmpl.id).template
+
+@required_perms("get_template")
+def get_templatetype(type_id, **kwargs):
+    """
+        Get a template type, including the data it inherits from its parents.
+    """
+    return get_types_by_id([type_id])[type_id]
+
+@required_perms("get_template")
+def get_templatetype_by_name(template_id, type_name, **kwargs):
+    """
+        Get a type defined in a template, by name.
+    """
+    for ttype in get_resolved_template(template_id).template.templatetypes:
+        if ttype.template_id == template_id and ttype.name == type_name:
+            return ttype
+    raise HydraError("%s is not a valid identifier for a type"%(type_name))
+
+@required_perms("get_template")
+def get_typeattr(typeattr_id, include_parent_data=True, **kwargs):
+    """
+        Get a typeattr. Unless 'include_parent_data' is False, this
+        includes the data it inherits from its parents.
+    """
+    if include_parent_data is False:
+        return template.get_typeattr(typeattr_id, include_parent_data=False, **kwargs)
+
+    row = db.DBSession.query(TemplateType.template_id).join(
+        TypeAttr, TypeAttr.type_id == TemplateType.id).filter(
+            TypeAttr.id == typeattr_id).first()
+    if row is None:
+        raise ResourceNotFoundError("Type attribute %s not found"%(typeattr_id))
+
+    typeattr = get_resolved_template(row.template_id).typeattrs_by_id.get(typeattr_id)
+    if typeattr is None:
+        return template.get_typeattr(typeattr_id, **kwargs)
+    return typeattr
@@ -0,0 +1,464 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Streaming import of template XML.
+
+    hydra_base's import_template_xml parses the whole document into a tree,
+    then adds or updates each type and typeattr through the ORM, one at a
+    time. Here the document is parsed incrementally with iterparse (and
+    validated against the template schema as it is parsed). Each <resource>
+    is turned into a plain dict and dropped from the tree as soon as it has
+    been read, and the types and typeattrs are written in batches.
+
+    The result is the same as hydra_base's import: types and typeattrs
+    not in the document are deleted, the rest are added or updated.
+"""
+
+import json
+import logging
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from lxml import etree
+from sqlalchemy import bindparam
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Template, TemplateType, TypeAttr
+from hydra_base.lib.data import add_dataset
+from hydra_base.lib.objects import JSONObject
+from hydra_base.lib.template.xml import get_etree_layout_as_dict
+from hydra_base.util import dataset_util
+from hydra_base.util.permissions import required_perms
+from hydra_base import config
+from hydra_base.exceptions import HydraError
+
+from .util import chunked
+from . import attrindex, unitcatalogue
+
+log = logging.getLogger(__name__)
+
+#The elements handled as they are parsed. <layout> is also inside <resource>,
+#but those are read with their resource.
+_tags = ('template_name', 'template_description', 'layout', 'resource')
+
+#Stands in for a typeattr added in the current batch
+_AddedTypeAttr = namedtuple('_AddedTypeAttr', ['id', 'unit_id'])
+
+class _ChunkReader(object):
+    """
+        A file-like object reading from an iterable of byte strings,
+        such as the chunks of an uploaded file.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _get_text(elem, tag):
+    child = elem.find(tag)
+    if child is None:
+        return None
+    return child.text
+
+def _get_layout(elem):
+    layout = elem.find('layout')
+    if layout is None or layout.text is None:
+        return None
+    return json.dumps(get_etree_layout_as_dict(layout))
+
+def _parse_attribute(attribute):
+    """
+        Read an <attribute> as _parse_xml_typeattr does.
+    """
+    attr = {'name'        : attribute.find('name').text.strip(),
+            'dimension'   : None,
+            'unit'        : None,
+            'restriction' : None,
+            'default'     : None}
+
+    dimension = _get_text(attribute, 'dimension')
+    if dimension is not None and dimension.strip() != '':
+        attr['dimension'] = dimension.strip()
+    #The unit only decides the dimension if there is no <dimension>
+    attr['has_dimension'] = attribute.find('dimension') is not None
+
+    unit = _get_text(attribute, 'unit')
+    if unit not in ('', None):
+        attr['unit'] = unit
+
+    #Only the fields in the document are set on existing typeattrs
+    attr['fields'] = {}
+    if attribute.find('description') is not None:
+        attr['fields']['description'] = attribute.find('description').text
+    if attribute.find('properties') is not None:
+        attr['fields']['properties'] = str(get_etree_layout_as_dict(attribute.find('properties')))
+    if attribute.find('is_var') is not None:
+        attr['fields']['attr_is_var'] = attribute.find('is_var').text
+    if attribute.find('data_type') is not None:
+        attr['fields']['data_type'] = attribute.find('data_type').text
+
+    default = attribute.find('default')
+    if default is not None:
+        default_unit = _get_text(default, 'unit')
+        attr['default'] = {'value' : _get_text(default, 'value'),
+                           'unit'  : default_unit if default_unit not in ('', None) else None}
+
+    if attribute.find('restrictions') is not None:
+        attr['restriction'] = str(dataset_util.get_restriction_as_dict(attribute.find('restrictions')))
+
+    return attr
+
+def _parse_resource(resource):
+    return {'name'            : resource.find('name').text,
+            'alias'           : _get_text(resource, 'alias'),
+            'has_alias'       : resource.find('alias') is not None,
+            'description'     : _get_text(resource, 'description'),
+            'has_description' : resource.find('description') is not None,
+            'resource_type'   : _get_text(resource, 'type'),
+            'layout'          : _get_layout(resource),
+            'attributes'      : [_parse_attribute(a) for a in resource.findall('attribute')]}
+
+class TemplateImport(object):
+    """
+        The types of a template being imported, written in batches.
+    """
+    def __init__(self, tmpl_i, batch_size, user_id):
+        self.tmpl_i = tmpl_i
+        self.batch_size = batch_size
+        self.user_id = user_id
+        self.batch = []
+        self.batches = 0
+        self.seen_type_names = set()
+        self.start_time = datetime.datetime.now()
+        self.counts = {'types_added'       : 0,
+                       'types_updated'     : 0,
+                       'types_deleted'     : 0,
+                       'typeattrs_added'   : 0,
+                       'typeattrs_updated' : 0,
+                       'typeattrs_deleted' : 0}
+
+        self.type_ids = {}
+        if tmpl_i.id is not None:
+            rows = db.DBSession.query(TemplateType.id, TemplateType.name).filter(
+                TemplateType.template_id == tmpl_i.id).all()
+            self.type_ids = dict((row.name, row.id) for row in rows)
+
+    def add_resource(self, resource):
+        if resource['name'] in self.seen_type_names:
+            raise HydraError("Type %s is defined more than once"%(resource['name']))
+        self.seen_type_names.add(resource['name'])
+        self.batch.append(resource)
+        if len(self.batch) == self.batch_size:
+            self.write_batch()
+
+    def _resolve_attributes(self):
+        attrs = []
+        for resource in self.batch:
+            for attr in resource['attributes']:
+                dimension_id = None
+                if attr['dimension'] is not None:
+                    dimension_id = unitcatalogue.get_dimension_by_name(attr['dimension']).id
+                elif attr['unit'] is not None and not attr['has_dimension']:
+                    unit_id = unitcatalogue.get_unit_by_abbreviation(attr['unit']).id
+                    dimension_id = unitcatalogue.get_dimension_by_unit_id(unit_id).id
+                attrs.append(JSONObject({'name'         : attr['name'],
+                                         'dimension_id' : dimension_id,
+                                         'dimension'    : None,
+                                         'description'  : None,
+                                         'network_id'   : None,
+                                         'project_id'   : None}))
+        resolved = attrindex.resolve_attributes(attrs, create_missing=True, user_id=self.user_id)
+        return iter(resolved)
+
+    def _write_types(self):
+        """
+            Add or update the types in the batch.
+
+            Returns:
+                list: The ID of the type of each resource in the batch
+        """
+        new_types = []
+        updates = []
+        for resource in self.batch:
+            type_id = self.type_ids.get(resource['name'])
+            if type_id is None:
+                type_i = TemplateType(template_id=self.tmpl_i.id,
+                                      name=resource['name'],
+                                      alias=resource['alias'],
+                                      description=resource['description'],
+                                      resource_type=resource['resource_type'],
+                                      layout=resource['layout'])
+                db.DBSession.add(type_i)
+                new_types.append((resource, type_i))
+            else:
+                updates.append((resource, type_id))
+
+        #Types are few compared to typeattrs, so one update per type is fine.
+        for resource, type_id in updates:
+            values = {}
+            if resource['has_alias']:
+                values['alias'] = resource['alias']
+            if resource['has_description']:
+                values['description'] = resource['description']
+            if resource['resource_type'] is not None:
+                values['resource_type'] = resource['resource_type']
+            if resource['layout'] is not None:
+                values['layout'] = resource['layout']
+            if len(values) > 0:
+                db.DBSession.execute(TemplateType.__table__.update().where(
+                    TemplateType.__table__.c.id == type_id).values(**values))
+
+        if len(new_types) > 0:
+            db.DBSession.flush()
+            for resource, type_i in new_types:
+                self.type_ids[resource['name']] = type_i.id
+
+        self.counts['types_added'] += len(new_types)
+        self.counts['types_updated'] += len(updates)
+
+        return [self.type_ids[resource['name']] for resource in self.batch]
+
+    def _get_existing_typeattrs(self, type_ids):
+        """
+            Returns:
+                dict: The ID and unit of each typeattr of the types, keyed on (type_id, attr_id)
+        """
+        existing = {}
+        for id_chunk in chunked(type_ids):
+            rows = db.DBSession.query(TypeAttr.id, TypeAttr.type_id, TypeAttr.attr_id, TypeAttr.unit_id).filter(
+                TypeAttr.type_id.in_(id_chunk)).all()
+            for row in rows:
+                existing[(row.type_id, row.attr_id)] = row
+        return existing
+
+    def _get_default_dataset_id(self, attr, attr_row, unit_id):
+        default = attr['default']
+        dataset_unit_id = None
+        if default['unit'] is not None:
+            dataset_unit_id = unitcatalogue.get_unit_by_abbreviation(default['unit']).id
+
+        if dataset_unit_id is not None and unit_id is not None and dataset_unit_id != unit_id:
+            raise HydraError("Default value has a unit of %s but the attribute"
+                             " says the unit should be: %s"%(dataset_unit_id, unit_id))
+
+        try:
+            Decimal(default['value'])
+            data_type = 'scalar'
+        except Exception:
+            data_type = 'descriptor'
+
+        dataset = add_dataset(data_type,
+                              default['value'],
+                              dataset_unit_id,
+                              name="%s Default"%attr_row.name,
+                              user_id=self.user_id)
+        return dataset.id
+
+    def _check_dimension(self, attr_row, unit_id):
+        if unit_id is None:
+            return
+        unit_dimension_id = unitcatalogue.get_dimension_by_unit_id(unit_id).id
+        if unit_dimension_id != attr_row.dimension_id:
+            raise HydraError("Unit %s has dimension %s, but attribute %s has dimension %s"%
+                             (unit_id, unit_dimension_id, attr_row.name, attr_row.dimension_id))
+
+    def write_batch(self):
+        if len(self.batch) == 0:
+            return
+
+        attr_rows = self._resolve_attributes()
+        type_ids = self._write_types()
+        existing = self._get_existing_typeattrs(type_ids)
+
+        inserts = []
+        updates = {}
+        kept_ids = set()
+        for resource, type_id in zip(self.batch, type_ids):
+            for attr in resource['attributes']:
+                attr_row = next(attr_rows)
+                row = existing.get((type_id, attr_row.id))
+
+                unit_id = None
+                if attr['unit'] is not None:
+                    unit_id = unitcatalogue.get_unit_by_abbreviation(attr['unit']).id
+                elif row is not None:
+                    unit_id = row.unit_id
+                self._check_dimension(attr_row, unit_id)
+
+                values = dict(attr['fields'])
+                values['unit_id'] = unit_id
+                values['data_restriction'] = attr['restriction']
+                if attr['default'] is not None:
+                    values['default_dataset_id'] = self._get_default_dataset_id(attr, attr_row, unit_id)
+
+                if row is None:
+                    values['type_id'] = type_id
+                    values['attr_id'] = attr_row.id
+                    inserts.append(values)
+                    #An attribute listed twice in a type is only added once
+                    existing[(type_id, attr_row.id)] = _AddedTypeAttr(None, unit_id)
+                else:
+                    if row.id is not None:
+                        kept_ids.add(row.id)
+                        values['b_id'] = row.id
+                        #Rows are updated together when they set the same columns
+                        updates.setdefault(tuple(sorted(values)), []).append(values)
+
+        deletes = [row.id for row in existing.values() if row.id is not None and row.id not in kept_ids]
+
+        table = TypeAttr.__table__
+        for id_chunk in chunked(deletes):
+            db.DBSession.execute(table.delete().where(table.c.id.in_(id_chunk)))
+        for columns, rows in updates.items():
+            db.DBSession.execute(table.update().where(table.c.id == bindparam('b_id')).values(
+                dict((c, bindparam(c)) for c in columns if c != 'b_id')), rows)
+        if len(inserts) > 0:
+            #Rows inserted together must have the same columns
+            columns = set(c for values in inserts for c in values)
+            for values in inserts:
+                for column in columns:
+                    values.setdefault(column, None)
+            db.DBSession.execute(table.insert(), inserts)
+        mark_changed(db.DBSession())
+
+        self.counts['typeattrs_added'] += len(inserts)
+        self.counts['typeattrs_updated'] += len(kept_ids)
+        self.counts['typeattrs_deleted'] += len(deletes)
+
+        self.batches += 1
+        log.info("Template %s: batch %s written. %s types imported in %s",
+                 self.tmpl_i.name, self.batches, len(self.seen_type_names),
+                 datetime.datetime.now() - self.start_time)
+
+        self.batch = []
+
+    def finish(self):
+        """
+            Write the last batch and delete the types which were not in the document.
+        """
+        self.write_batch()
+
+        for type_name, type_id in self.type_ids.items():
+            if type_name in self.seen_type_names:
+                continue
+            type_i = db.DBSession.query(TemplateType).filter(TemplateType.id == type_id).first()
+            if type_i is not None:
+                log.debug("Deleting type %s", type_i.name)
+                db.DBSession.delete(type_i)
+                self.counts['types_deleted'] += 1
+
+        db.DBSession.flush()
+
+    def as_dict(self):
+        summary = {'template_id'   : self.tmpl_i.id,
+                   'template_name' : self.tmpl_i.name,
+                   'batches'       : self.batches}
+        summary.update(self.counts)
+        return summary
+
+def _get_template(template_name, description, layout, allow_update):
+    tmpl_i = db.DBSession.query(Template).filter(Template.name == template_name).first()
+    if tmpl_i is None:
+        log.debug("Template not found. Creating new one. name=%s", template_name)
+        tmpl_i = Template(name=template_name, description=description, layout=layout)
+        db.DBSession.add(tmpl_i)
+        db.DBSession.flush()
+    elif allow_update is False:
+        raise HydraError("Existing Template Found with name %s"%(template_name,))
+    else:
+        log.debug("Existing template found. name=%s", template_name)
+        tmpl_i.layout = layout
+        tmpl_i.description = description
+    return tmpl_i
+
+@required_perms("add_template")
+def import_template_xml(source, allow_update=True, batch_size=None, **kwargs):
+    """
+        Add or update the template, types and typeattrs described in a
+        template XML document, as hydra_base's import_template_xml does,
+        without holding the whole document in memory.
+
+        Args:
+            source: A file name, a file-like object, or an iterable of byte strings
+            allow_update (bool): Update the template if it already exists
+            batch_size (int): The number of types written at a time
+
+        Returns:
+            dict: The ID and name of the template, and the number of types and
+                typeattrs added, updated and deleted.
+    """
+    if batch_size is None:
+        batch_size = config.getint('hydra_server', 'template_import_batch_size', 100)
+
+    if not isinstance(source, str) and not hasattr(source, 'read'):
+        source = _ChunkReader(source)
+
+    xmlschema = etree.XMLSchema(etree.parse(config.get('templates', 'template_xsd_path')))
+
+    header = {'template_name' : None, 'template_description' : None, 'layout' : None}
+    template_import = None
+
+    for _, elem in etree.iterparse(source, events=('end',), tag=_tags, schema=xmlschema):
+        parent = elem.getparent()
+        if elem.tag != 'resource' and parent is not None and parent.getparent() is not None:
+            #Part of a resource, which is read with it
+            continue
+
+        if elem.tag == 'template_name':
+            header['template_name'] = elem.text
+        elif elem.tag == 'template_description':
+            header['template_description'] = elem.text
+        elif elem.tag == 'layout':
+            if elem.text is not None:
+                header['layout'] = json.dumps(get_etree_layout_as_dict(elem))
+        else:
+            if template_import is None:
+                tmpl_i = _get_template(header['template_name'],
+                                       header['template_description'],
+                                       header['layout'],
+                                       allow_update)
+                template_import = TemplateImport(tmpl_i, batch_size, kwargs.get('user_id'))
+            template_import.add_resource(_parse_resource(elem))
+
+        #Drop what has been read, and anything before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    if template_import is None:
+        tmpl_i = _get_template(header['template_name'],
+                               header['template_description'],
+                               header['layout'],
+                               allow_update)
+        template_import = TemplateImport(tmpl_i, batch_size, kwargs.get('user_id'))
+
+    template_import.finish()
+
+    log.info("Template %s imported: %s", template_import.tmpl_i.name, template_import.counts)
+
+    return template_import.as_dict()
@@ -0,0 +1,360 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    The topology of networks, for traversals on the server.
+
+    The active nodes and links of a network are loaded in two queries and
+    kept as a directed graph in compressed sparse row (CSR) form: the nodes
+    are numbered 0..n-1 and, for each node, the links leaving it are
+    stored contiguously, so its neighbours are a slice of one array.
+    The same is kept for the links entering each node, for walking upstream.
+    Links go from node_1 to node_2.
+
+    The graph of each network is kept until its nodes or links change.
+"""
+
+import logging
+from collections import deque
+
+import numpy as np
+
+from hydra_base import db
+from hydra_base.db.model import Network, Node, Link
+from hydra_base.util.permissions import required_perms
+from hydra_base import config
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import LRUCache, invalidate_after_commit
+
+log = logging.getLogger(__name__)
+
+#The graph of each network, keyed on network ID.
+network_graphs = LRUCache(config.getint('hydra_server', 'topology_cache_size', 100))
+
+def invalidate(network_id):
+    """
+        Drop the graph of a network when its nodes or links change.
+    """
+    invalidate_after_commit(lambda: network_graphs.pop(network_id))
+
+def get_link_network_id(link_id):
+    """
+        Get the network of a link, before the link is deleted.
+    """
+    row = db.DBSession.query(Link.network_id).filter(Link.id == link_id).first()
+    if row is None:
+        raise ResourceNotFoundError("Link %s not found"%(link_id))
+    return row.network_id
+
+def _make_csr(num_nodes, src, dst, link_ids):
+    """
+        Returns:
+            tuple: (ptr, nbrs, links), where the neighbours of node i are
+                nbrs[ptr[i]:ptr[i+1]], reached by links[ptr[i]:ptr[i+1]]
+    """
+    order = np.argsort(src, kind='stable')
+    counts = np.bincount(src, minlength=num_nodes)
+    ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(counts, out=ptr[1:])
+    return ptr, dst[order], link_ids[order]
+
+class NetworkGraph(object):
+    """
+        The active nodes and links of a network, as CSR adjacency arrays.
+    """
+    def __init__(self, network_id, node_ids, links):
+        """
+            Args:
+                node_ids (list): The IDs of the nodes
+                links (list): (link_id, node_1_id, node_2_id) tuples. Links to
+                    nodes which aren't in node_ids are left out.
+        """
+        self.network_id = network_id
+        self.node_ids = np.array(sorted(node_ids), dtype=np.int64)
+        self.positions = dict((node_id, pos) for pos, node_id in enumerate(self.node_ids.tolist()))
+
+        link_ids, src, dst = [], [], []
+        for link_id, node_1_id, node_2_id in links:
+            if node_1_id in self.positions and node_2_id in self.positions:
+                link_ids.append(link_id)
+                src.append(self.positions[node_1_id])
+                dst.append(self.positions[node_2_id])
+        link_ids = np.array(link_ids, dtype=np.int64)
+        src = np.array(src, dtype=np.int64)
+        dst = np.array(dst, dtype=np.int64)
+        self.num_links = len(link_ids)
+
+        self.out_ptr, self.out_nbrs, self.out_links = _make_csr(len(self.node_ids), src, dst, link_ids)
+        self.in_ptr, self.in_nbrs, self.in_links = _make_csr(len(self.node_ids), dst, src, link_ids)
+
+        #Plain lists are faster than arrays for walking one node at a time
+        self._out = (self.out_ptr.tolist(), self.out_nbrs.tolist(), self.out_links.tolist())
+        self._in = (self.in_ptr.tolist(), self.in_nbrs.tolist(), self.in_links.tolist())
+
+    def get_position(self, node_id):
+        pos = self.positions.get(node_id)
+        if pos is None:
+            raise ResourceNotFoundError("Node %s is not an active node in network %s"%
+                                        (node_id, self.network_id))
+        return pos
+
+    def _get_adjacency(self, direction):
+        if direction == 'downstream':
+            return [self._out]
+        if direction == 'upstream':
+            return [self._in]
+        if direction == 'both':
+            return [self._out, self._in]
+        raise HydraError("Direction must be upstream, downstream or both, not %s"%(direction,))
+
+    def _neighbours(self, pos, adjacency):
+        for ptr, nbrs, links in adjacency:
+            for i in range(ptr[pos], ptr[pos + 1]):
+                yield nbrs[i], links[i]
+
+    def get_neighbours(self, node_ids):
+        """
+            Returns:
+                set: The active nodes linked to any of node_ids, in either
+                    direction. Nodes which aren't active are ignored.
+        """
+        adjacency = self._get_adjacency('both')
+        neighbours = set()
+        for node_id in node_ids:
+            pos = self.positions.get(node_id)
+            if pos is None:
+                continue
+            for nbr, _ in self._neighbours(pos, adjacency):
+                neighbours.add(int(self.node_ids[nbr]))
+        return neighbours
+
+    def get_orphan_nodes(self):
+        degree = np.diff(self.out_ptr) + np.diff(self.in_ptr)
+        return self.node_ids[degree == 0].tolist()
+
+    def get_components(self):
+        """
+            The weakly connected components, largest first.
+
+            Returns:
+                list: The node IDs in each component, in ascending order
+        """
+        adjacency = self._get_adjacency('both')
+        component = [-1] * len(self.node_ids)
+        components = []
+        for start in range(len(self.node_ids)):
+            if component[start] != -1:
+                continue
+            members = [start]
+            component[start] = len(components)
+            queue = deque([start])
+            while queue:
+                pos = queue.popleft()
+                for nbr, _ in self._neighbours(pos, adjacency):
+                    if component[nbr] == -1:
+                        component[nbr] = len(components)
+                        members.append(nbr)
+                        queue.append(nbr)
+            components.append(members)
+
+        node_ids = self.node_ids
+        result = [sorted(node_ids[members].tolist()) for members in components]
+        result.sort(key=lambda c: (-len(c), c[0]))
+        return result
+
+    def traverse(self, node_id, direction='downstream', max_depth=None):
+        """
+            Breadth first walk from a node.
+
+            Returns:
+                dict: The node IDs reached, in the order they were reached
+                    (starting with node_id), and the IDs of the links followed
+                    to reach them.
+        """
+        adjacency = self._get_adjacency(direction)
+        start = self.get_position(node_id)
+        depth = {start: 0}
+        node_order = [start]
+        link_ids = []
+        queue = deque([start])
+        while queue:
+            pos = queue.popleft()
+            if max_depth is not None and depth[pos] >= max_depth:
+                continue
+            for nbr, link_id in self._neighbours(pos, adjacency):
+                if nbr not in depth:
+                    depth[nbr] = depth[pos] + 1
+                    node_order.append(nbr)
+                    link_ids.append(link_id)
+                    queue.append(nbr)
+
+        return {'node_ids' : self.node_ids[node_order].tolist(),
+                'link_ids' : link_ids}
+
+    def shortest_path(self, from_node_id, to_node_id, directed=True):
+        """
+            The path with fewest links between two nodes.
+
+            Returns:
+                dict: The node IDs and link IDs along the path, or None if
+                    there is no path.
+        """
+        adjacency = self._get_adjacency('downstream' if directed else 'both')
+        start = self.get_position(from_node_id)
+        end = self.get_position(to_node_id)
+
+        #The previous node and link on the path to each node reached
+        previous = {start: None}
+        queue = deque([start])
+        while queue and end not in previous:
+            pos = queue.popleft()
+            for nbr, link_id in self._neighbours(pos, adjacency):
+                if nbr not in previous:
+                    previous[nbr] = (pos, link_id)
+                    queue.append(nbr)
+
+        if end not in previous:
+            return None
+
+        node_path = [end]
+        link_path = []
+        while previous[node_path[-1]] is not None:
+            pos, link_id = previous[node_path[-1]]
+            node_path.append(pos)
+            link_path.append(link_id)
+
+        node_path.reverse()
+        link_path.reverse()
+        return {'node_ids' : self.node_ids[node_path].tolist(),
+                'link_ids' : link_path}
+
+    def find_cycles(self):
+        """
+            Find the groups of nodes which are on directed cycles, using
+            Tarjan's strongly connected components algorithm (without recursion,
+            as networks can be deeper than Python's recursion limit).
+
+            Returns:
+                list: The node IDs of each strongly connected component with
+                    a cycle: more than one node, or one node with a link to itself.
+        """
+        ptr, nbrs, _ = self._out
+        num_nodes = len(self.node_ids)
+        index = [-1] * num_nodes
+        lowlink = [0] * num_nodes
+        on_stack = [False] * num_nodes
+        stack = []
+        cycles = []
+        counter = 0
+
+        for root in range(num_nodes):
+            if index[root] != -1:
+                continue
+            #Each frame is a node and the position of its next neighbour to visit
+            frames = [(root, ptr[root])]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            while frames:
+                pos, i = frames[-1]
+                if i < ptr[pos + 1]:
+                    frames[-1] = (pos, i + 1)
+                    nbr = nbrs[i]
+                    if index[nbr] == -1:
+                        index[nbr] = lowlink[nbr] = counter
+                        counter += 1
+                        stack.append(nbr)
+                        on_stack[nbr] = True
+                        frames.append((nbr, ptr[nbr]))
+                    elif on_stack[nbr]:
+                        lowlink[pos] = min(lowlink[pos], index[nbr])
+                    continue
+
+                frames.pop()
+                if frames:
+                    parent = frames[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[pos])
+                if lowlink[pos] == index[pos]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        members.append(member)
+                        if member == pos:
+                            break
+                    if len(members) > 1 or pos in nbrs[ptr[pos]:ptr[pos + 1]]:
+                        cycles.append(sorted(self.node_ids[members].tolist()))
+
+        cycles.sort(key=lambda c: c[0])
+        return cycles
+
+def _load_graph(network_id):
+    node_ids = [r.id for r in db.DBSession.query(Node.id).filter(
+        Node.network_id == network_id, Node.status == 'A').all()]
+    links = db.DBSession.query(Link.id, Link.node_1_id, Link.node_2_id).filter(
+        Link.network_id == network_id, Link.status == 'A').all()
+
+    graph = NetworkGraph(network_id, node_ids, links)
+
+    log.info("Loaded the topology of network %s: %s nodes, %s links",
+             network_id, len(graph.node_ids), graph.num_links)
+    return graph
+
+def get_graph(network_id, user_id, write=False):
+    """
+        Get the graph of a network, after checking the user can read it
+        (or write to it, if 'write' is True).
+    """
+    net_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if net_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id))
+    if write is True:
+        net_i.check_write_permission(user_id)
+    else:
+        net_i.check_read_permission(user_id)
+
+    graph = network_graphs.get(network_id)
+    if graph is None:
+        graph = _load_graph(network_id)
+        network_graphs.set(network_id, graph)
+    return graph
+
+@required_perms('get_network')
+def validate_network_topology(network_id, **kwargs):
+    """
+        Get the active nodes in a network which have no active links,
+        as hydra_base's validate_network_topology does.
+    """
+    return get_graph(network_id, kwargs.get('user_id'), write=True).get_orphan_nodes()
+
+@required_perms('get_network')
+def get_connected_components(network_id, **kwargs):
+    return get_graph(network_id, kwargs.get('user_id')).get_components()
+
+@required_perms('get_network')
+def traverse_network(network_id, node_id, direction='downstream', max_depth=None, **kwargs):
+    return get_graph(network_id, kwargs.get('user_id')).traverse(node_id, direction, max_depth)
+
+@required_perms('get_network')
+def get_shortest_path(network_id, from_node_id, to_node_id, directed=True, **kwargs):
+    return get_graph(network_id, kwargs.get('user_id')).shortest_path(from_node_id,
+                                                                      to_node_id,
+                                                                      directed)
+
+@required_perms('get_network')
+def find_cycles(network_id, **kwargs):
+    return get_graph(network_id, kwargs.get('user_id')).find_cycles()
@@ -0,0 +1,291 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Assigning template types to many resources at once.
+
+    hydra_base's assign_types_to_resources loads each resource with its
+    attributes and types through the ORM and looks up the network template
+    of each one. Here the attributes and types of all the resources are
+    loaded with one query per type of resource, the missing resource
+    attributes are worked out in memory, and the new resource attributes,
+    resource scenarios and resource types are added with bulk inserts.
+"""
+
+import logging
+
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import ResourceAttr, ResourceType, ResourceScenario, Scenario, Network
+from hydra_base.lib import template
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .util import chunked
+from .resourceattrs import ref_key_columns, network_resources, bulk_add_resource_attributes
+from . import templatecache
+
+log = logging.getLogger(__name__)
+
+def _group_by_ref_key(resource_keys):
+    ref_ids_by_key = {}
+    for ref_key, ref_id in resource_keys:
+        ref_ids_by_key.setdefault(ref_key, set()).add(ref_id)
+    return ref_ids_by_key
+
+def get_network_ids(ref_ids_by_key, user_id):
+    """
+        Find the network of each resource, and check the user can write to them.
+
+        Returns:
+            dict: The ID of the network of each resource, keyed on (ref_key, ref_id)
+    """
+    network_ids = {}
+    for ref_id in ref_ids_by_key.get('NETWORK', []):
+        network_ids[('NETWORK', ref_id)] = ref_id
+
+    for ref_key, resource_class in network_resources.items():
+        ref_ids = ref_ids_by_key.get(ref_key, set())
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(resource_class.id, resource_class.network_id).filter(
+                resource_class.id.in_(id_chunk)).all()
+            for row in rows:
+                network_ids[(ref_key, row.id)] = row.network_id
+        missing = set(ref_id for ref_id in ref_ids if (ref_key, ref_id) not in network_ids)
+        if missing:
+            raise ResourceNotFoundError("%s(s) %s not found"%(ref_key.lower(), sorted(missing)))
+
+    found = set()
+    for id_chunk in chunked(list(set(network_ids.values()))):
+        for net_i in db.DBSession.query(Network).filter(Network.id.in_(id_chunk)).all():
+            net_i.check_write_permission(user_id)
+            found.add(net_i.id)
+    missing = set(network_ids.values()) - found
+    if missing:
+        raise ResourceNotFoundError("network(s) %s not found"%(sorted(missing)))
+
+    return network_ids
+
+def _get_by_resource(ref_ids_by_key, model, column):
+    """
+        Get a column of the resource attributes or resource types of resources.
+
+        Returns:
+            dict: The set of values of each resource, keyed on (ref_key, ref_id)
+    """
+    values = {}
+    for ref_key, ref_ids in ref_ids_by_key.items():
+        ref_col = getattr(model, ref_key_columns[ref_key])
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(ref_col, getattr(model, column)).filter(
+                ref_col.in_(id_chunk)).all()
+            for ref_id, value in rows:
+                values.setdefault((ref_key, ref_id), set()).add(value)
+    return values
+
+def get_resource_type_ids(ref_ids_by_key):
+    return _get_by_resource(ref_ids_by_key, ResourceType, 'type_id')
+
+def insert_resource_types(types, network_ids, existing_type_ids, **kwargs):
+    """
+        Assign types to the resources which don't already have them, after
+        checking they are compatible with the types the resources do have.
+
+        Args:
+            types (dict): The type to assign to each resource, keyed on (ref_key, ref_id)
+            network_ids (dict): The network of each resource, keyed on (ref_key, ref_id)
+            existing_type_ids (dict): The IDs of the types each resource already
+                has, keyed on (ref_key, ref_id)
+
+        Returns:
+            int: The number of types assigned
+    """
+    child_template_ids = {}
+    compatibility_errors = {}
+    rows = []
+    for (ref_key, ref_id), ttype in types.items():
+        resource_type_ids = existing_type_ids.get((ref_key, ref_id), set())
+        if ttype.id in resource_type_ids:
+            continue
+
+        for existing_type_id in resource_type_ids:
+            pair = (existing_type_id, ttype.id)
+            if pair not in compatibility_errors:
+                compatibility_errors[pair] = template.check_type_compatibility(existing_type_id,
+                                                                               ttype.id,
+                                                                               **kwargs)
+            if len(compatibility_errors[pair]) > 0:
+                raise HydraError("Cannot apply type %s to %s %s as it "
+                                 "conflicts with type %s. Errors are: %s"
+                                 %(ttype.name, ref_key.lower(), ref_id,
+                                   existing_type_id, ','.join(compatibility_errors[pair])))
+
+        network_id = network_ids[(ref_key, ref_id)]
+        if (network_id, ttype.id) not in child_template_ids:
+            child_template_ids[(network_id, ttype.id)] = template.get_network_template(network_id,
+                                                                                       ttype.id)
+
+        row = {'ref_key'           : ref_key,
+               'type_id'           : ttype.id,
+               'child_template_id' : child_template_ids[(network_id, ttype.id)]}
+        for col in ref_key_columns.values():
+            if col != 'project_id':
+                row[col] = None
+        row[ref_key_columns[ref_key]] = ref_id
+        rows.append(row)
+
+    if len(rows) > 0:
+        db.DBSession.execute(ResourceType.__table__.insert(), rows)
+        mark_changed(db.DBSession())
+
+    return len(rows)
+
+def get_types(type_ids, template_id=None):
+    """
+        Get the types, with their inherited typeattrs, from the given
+        template if there is one, or from their own templates.
+    """
+    types = {}
+    if template_id is not None:
+        types_in_template = templatecache.get_resolved_template(template_id).types_by_id
+        for type_id in type_ids:
+            if type_id in types_in_template:
+                types[type_id] = types_in_template[type_id]
+    missing = [type_id for type_id in type_ids if type_id not in types]
+    if len(missing) > 0:
+        types.update(templatecache.get_types_by_id(missing))
+    return types
+
+def _add_default_data(new_ras, network_ids, resource_typeattrs):
+    """
+        Give new resource attributes the default value of their typeattr,
+        in every scenario of their network.
+
+        Args:
+            new_ras (list): (ref_key, ref_id, attr_id, resource_attr_id) tuples
+            resource_typeattrs (dict): The typeattrs of each resource's
+                new types, as {(ref_key, ref_id): {attr_id: typeattr}}
+
+        Returns:
+            int: The number of resource scenarios added
+    """
+    #hydra_base only adds defaults for nodes, links and groups
+    defaults = []
+    for ref_key, ref_id, attr_id, ra_id in new_ras:
+        if ref_key == 'NETWORK':
+            continue
+        dataset_id = resource_typeattrs[(ref_key, ref_id)][attr_id].default_dataset_id
+        if dataset_id is not None:
+            defaults.append((network_ids[(ref_key, ref_id)], ra_id, dataset_id))
+
+    if len(defaults) == 0:
+        return 0
+
+    scenario_ids = {}
+    for id_chunk in chunked(list(set(d[0] for d in defaults))):
+        rows = db.DBSession.query(Scenario.id, Scenario.network_id).filter(
+            Scenario.network_id.in_(id_chunk)).all()
+        for row in rows:
+            scenario_ids.setdefault(row.network_id, []).append(row.id)
+
+    rows = []
+    for network_id, ra_id, dataset_id in defaults:
+        for scenario_id in scenario_ids.get(network_id, []):
+            rows.append({'scenario_id'      : scenario_id,
+                         'resource_attr_id' : ra_id,
+                         'dataset_id'       : dataset_id})
+
+    if len(rows) > 0:
+        db.DBSession.execute(ResourceScenario.__table__.insert(), rows)
+        mark_changed(db.DBSession())
+
+    return len(rows)
+
+@required_perms('edit_network')
+def assign_types_to_resources(resource_types, template_id=None, **kwargs):
+    """
+        Assign types to resources, as hydra_base's assign_types_to_resources
+        does: resources are given the attributes of their new type which they
+        don't have (with the type's default values, in every scenario of their
+        network), and the type, unless they already have it.
+
+        Args:
+            resource_types (list): Objects with ref_key, ref_id and type_id
+            template_id (int): The template the types come from. If None,
+                each type is taken from its own template.
+
+        Returns:
+            dict: The number of resources, types assigned, and resource
+                attributes and resource scenarios added.
+    """
+    user_id = kwargs.get('user_id')
+
+    assignments = []
+    for resource_type in resource_types:
+        ref_key = resource_type.ref_key.upper()
+        if ref_key not in ref_key_columns or ref_key == 'PROJECT':
+            raise HydraError('Resource type "%s" not recognised.'%(resource_type.ref_key))
+        assignments.append((ref_key, resource_type.ref_id, resource_type.type_id))
+
+    if template_id is None and len(resource_types) > 0:
+        template_id = resource_types[0].template_id
+
+    types_by_id = get_types(set(a[2] for a in assignments), template_id)
+
+    ref_ids_by_key = _group_by_ref_key((ref_key, ref_id) for ref_key, ref_id, _ in assignments)
+    network_ids = get_network_ids(ref_ids_by_key, user_id)
+    existing_attr_ids = _get_by_resource(ref_ids_by_key, ResourceAttr, 'attr_id')
+    existing_type_ids = get_resource_type_ids(ref_ids_by_key)
+
+    #The typeattrs of each resource's new types, keyed on attr_id
+    resource_typeattrs = {}
+    types_to_assign = {}
+    for ref_key, ref_id, type_id in assignments:
+        ttype = types_by_id[type_id]
+        typeattrs = resource_typeattrs.setdefault((ref_key, ref_id), {})
+        for typeattr in ttype.typeattrs:
+            typeattrs.setdefault(typeattr.attr_id, typeattr)
+        types_to_assign.setdefault((ref_key, ref_id), []).append(ttype)
+
+    missing = []
+    for (ref_key, ref_id), typeattrs in resource_typeattrs.items():
+        attr_ids = existing_attr_ids.get((ref_key, ref_id), set())
+        for attr_id, typeattr in typeattrs.items():
+            if attr_id not in attr_ids:
+                missing.append((ref_key, ref_id, attr_id, typeattr.attr_is_var))
+
+    ra_ids = bulk_add_resource_attributes(missing, user_id)
+    new_ras = [(ref_key, ref_id, attr_id, ra_id)
+               for (ref_key, ref_id, attr_id, _), ra_id in zip(missing, ra_ids)]
+    num_scenarios = _add_default_data(new_ras, network_ids, resource_typeattrs)
+
+    #A resource can be given more than one type, so insert each in turn
+    num_types = 0
+    while len(types_to_assign) > 0:
+        types = dict((key, ttypes.pop(0)) for key, ttypes in types_to_assign.items())
+        num_types += insert_resource_types(types, network_ids, existing_type_ids, **kwargs)
+        for key, ttype in types.items():
+            existing_type_ids.setdefault(key, set()).add(ttype.id)
+        types_to_assign = dict((key, t) for key, t in types_to_assign.items() if len(t) > 0)
+
+    log.info("Types assigned to %s resources. %s types, %s resource attributes"
+             " and %s resource scenarios added.",
+             len(resource_typeattrs), num_types, len(new_ras), num_scenarios)
+
+    return {'resources'                 : len(resource_typeattrs),
+            'types_assigned'            : num_types,
+            'resource_attributes_added' : len(new_ras),
+            'resource_scenarios_added'  : num_scenarios}
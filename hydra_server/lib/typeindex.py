@@ -0,0 +1,273 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Matching resources to template types by their attributes.
+
+    A resource matches a type if it has all the attributes of the type.
+    Rather than comparing each resource with every type, each template is
+    indexed once: every attribute used in the template gets a bit, each
+    type has a mask of the bits it requires, and each attribute points to
+    the types which use it. Matching a resource is then a matter of
+    looking up its attributes and comparing masks.
+
+    The index of a template includes the types and typeattrs it inherits.
+    It is built from the template cache, and dropped with it.
+"""
+
+import logging
+from collections import namedtuple
+
+from hydra_base import db
+from hydra_base.db.model import Template, ResourceAttr, ResourceType, Network
+from hydra_base.lib import template
+from hydra_base.util.permissions import required_perms
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .resourceattrs import ref_key_columns, network_resources, resource_classes
+from . import templatecache, typeassign
+
+log = logging.getLogger(__name__)
+
+#A plain tuple rather than a JSONObject, as JSONObject turns
+#numeric-looking names into numbers.
+TypeMatch = namedtuple('TypeMatch', ['id',
+                                     'name',
+                                     'resource_type',
+                                     'template_id',
+                                     'template_name',
+                                     'child_template_id'])
+
+class TypeIndex(object):
+    """
+        The types of a template, indexed by the attributes they require.
+        Types are kept in the order returned by Template.get_types,
+        so the first match is the one hydra_base would pick.
+    """
+    def __init__(self, template_id, template_name, types):
+        self.template_id = template_id
+        self.template_name = template_name
+        self.types = types
+        #The bit of each attribute used in the template
+        self.attr_bits = {}
+        #The positions of the types using each attribute
+        self.types_by_attr = {}
+        #The attributes required by each type, as a mask of attribute bits
+        self.required = []
+        #Types with no attributes, which match any resource
+        self.unconstrained = []
+
+        for pos, ttype in enumerate(types):
+            mask = 0
+            for typeattr in ttype.typeattrs:
+                bit = self.attr_bits.get(typeattr.attr_id)
+                if bit is None:
+                    bit = 1 << len(self.attr_bits)
+                    self.attr_bits[typeattr.attr_id] = bit
+                mask |= bit
+                self.types_by_attr.setdefault(typeattr.attr_id, set()).add(pos)
+            self.required.append(mask)
+            if mask == 0:
+                self.unconstrained.append(pos)
+
+    def match(self, attr_ids, resource_type=None):
+        """
+            Get the types whose attributes are all in attr_ids.
+
+            Args:
+                attr_ids (iterable): The attributes of the resource
+                resource_type (string): NETWORK, NODE, LINK or GROUP. If None,
+                    types of any resource type are returned.
+
+            Returns:
+                list: The matching types, in template order
+        """
+        mask = 0
+        candidates = set(self.unconstrained)
+        for attr_id in attr_ids:
+            bit = self.attr_bits.get(attr_id)
+            if bit is None:
+                continue
+            mask |= bit
+            candidates.update(self.types_by_attr[attr_id])
+
+        matches = []
+        for pos in sorted(candidates):
+            ttype = self.types[pos]
+            if resource_type is not None and ttype.resource_type != resource_type:
+                continue
+            required = self.required[pos]
+            if required & mask == required:
+                matches.append(ttype)
+        return matches
+
+    def get_network_type(self):
+        for ttype in self.types:
+            if ttype.resource_type == 'NETWORK':
+                return ttype
+        return None
+
+    def make_match(self, ttype):
+        return TypeMatch(ttype.id,
+                         ttype.name,
+                         ttype.resource_type,
+                         ttype.template_id,
+                         self.template_name,
+                         getattr(ttype, 'child_template_id', self.template_id))
+
+def get_index(template_id):
+    resolved = templatecache.get_resolved_template(template_id)
+    if resolved.type_index is None:
+        tmpl = resolved.template
+        resolved.type_index = TypeIndex(tmpl.id, tmpl.name, tmpl.templatetypes)
+        log.info("Indexed %s types and %s attributes of template %s",
+                 len(resolved.type_index.types), len(resolved.type_index.attr_bits), template_id)
+    return resolved.type_index
+
+def _get_indexes(template_id=None):
+    if template_id is not None:
+        return [get_index(template_id)]
+    template_ids = [t.id for t in db.DBSession.query(Template.id).order_by(Template.id).all()]
+    return [get_index(t_id) for t_id in template_ids]
+
+@required_perms('get_template')
+def get_types_by_attr(attr_ids, resource_type=None, template_id=None, **kwargs):
+    """
+        Get the types, in one template or all of them, which a resource
+        with the given attributes matches.
+
+        Returns:
+            list: The matching types, as returned by Template.get_types
+    """
+    attr_ids = set(attr_ids)
+    matches = []
+    for index in _get_indexes(template_id):
+        matches.extend(index.match(attr_ids, resource_type))
+    return matches
+
+@required_perms('get_template')
+def get_matching_resource_types(resource_type, resource_id, **kwargs):
+    """
+        Get the types, in all templates, which a resource matches.
+
+        Returns:
+            list: A TypeMatch for each matching type
+    """
+    resource_type = resource_type.upper()
+    resource_class = resource_classes.get(resource_type)
+    if resource_class is None:
+        raise HydraError('Resource type "%s" not recognised.'%(resource_type))
+
+    if db.DBSession.query(resource_class.id).filter(resource_class.id == resource_id).first() is None:
+        raise ResourceNotFoundError("%s %s not found"%(resource_type.lower(), resource_id))
+
+    ref_col = getattr(ResourceAttr, ref_key_columns[resource_type])
+    attr_ids = set(r.attr_id for r in db.DBSession.query(ResourceAttr.attr_id).filter(
+        ref_col == resource_id).all())
+
+    matches = []
+    for index in _get_indexes():
+        matches.extend(index.make_match(t) for t in index.match(attr_ids, resource_type))
+    return matches
+
+def _get_network_attr_ids(network_id):
+    """
+        Get the attributes of all the nodes, links and groups in a network,
+        with one query for each type of resource.
+
+        Returns:
+            dict: The attr_ids of each resource, keyed on (ref_key, ref_id).
+                Resources with no attributes are included.
+    """
+    resource_attr_ids = {}
+    for ref_key, resource_class in network_resources.items():
+        ref_col = getattr(ResourceAttr, ref_key_columns[ref_key])
+        rows = db.DBSession.query(resource_class.id, ResourceAttr.attr_id).outerjoin(
+            ResourceAttr, ref_col == resource_class.id).filter(
+                resource_class.network_id == network_id).all()
+        for ref_id, attr_id in rows:
+            attr_ids = resource_attr_ids.setdefault((ref_key, ref_id), set())
+            if attr_id is not None:
+                attr_ids.add(attr_id)
+    return resource_attr_ids
+
+def _get_network_type_ids(network_id):
+    """
+        Get the types already assigned to the nodes, links and groups in a network.
+
+        Returns:
+            dict: The type IDs of each resource, keyed on (ref_key, ref_id)
+    """
+    resource_type_ids = {}
+    for ref_key, resource_class in network_resources.items():
+        ref_col = getattr(ResourceType, ref_key_columns[ref_key])
+        rows = db.DBSession.query(ref_col, ResourceType.type_id).join(
+            resource_class, ref_col == resource_class.id).filter(
+                resource_class.network_id == network_id).all()
+        for ref_id, type_id in rows:
+            resource_type_ids.setdefault((ref_key, ref_id), set()).add(type_id)
+    return resource_type_ids
+
+def match_network(index, network_id):
+    """
+        Match every node, link and group in a network against a template.
+
+        Returns:
+            dict: The first matching type of each resource which matches one,
+                keyed on (ref_key, ref_id)
+    """
+    matches = {}
+    for key, attr_ids in _get_network_attr_ids(network_id).items():
+        resource_matches = index.match(attr_ids, key[0])
+        if len(resource_matches) > 0:
+            matches[key] = resource_matches[0]
+    return matches
+
+@required_perms('edit_network')
+def apply_template_to_network(template_id, network_id, **kwargs):
+    """
+        Assign each node, link and group in a network the first type in the
+        template which it matches, and the template's network type to
+        the network, as hydra_base's apply_template_to_network does.
+
+        Returns:
+            int: The number of nodes, links and groups given a new type
+    """
+    net_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if net_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id))
+    net_i.check_write_permission(kwargs.get('user_id'))
+
+    index = get_index(template_id)
+
+    network_type = index.get_network_type()
+    if network_type is not None:
+        template.assign_type_to_resource(network_type.id, 'NETWORK', network_id, **kwargs)
+    else:
+        log.debug("No network type to set.")
+
+    #A resource only matches a type if it already has all the type's
+    #attributes, so unlike assign_types_to_resources, there are no
+    #resource attributes or default values to add.
+    matches = match_network(index, network_id)
+    num_assigned = typeassign.insert_resource_types(matches,
+                                                    dict((key, network_id) for key in matches),
+                                                    _get_network_type_ids(network_id),
+                                                    **kwargs)
+
+    log.info("Template %s applied to network %s. %s of %s matching resources given a new type.",
+             template_id, network_id, num_assigned, len(matches))
+
+    return num_assigned
@@ -0,0 +1,154 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    In-memory catalogue of units and dimensions.
+
+    Units and dimensions rarely change but are read all the time, so they
+    are loaded with two queries and kept until a unit or dimension is
+    added, updated or deleted.
+"""
+
+import logging
+
+from hydra_base import db
+from hydra_base.db.model import Unit, Dimension
+from hydra_base.lib.objects import JSONObject
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import Catalogue
+
+log = logging.getLogger(__name__)
+
+class UnitIndex(object):
+    """
+        All the units and dimensions, indexed for lookups.
+    """
+    def __init__(self, dimensions, units):
+        self.units_by_id = {}
+        self.units_by_abbreviation = {}
+        self.dimensions_by_id = {}
+        self.dimensions_by_name = {}
+
+        units_by_dimension = {}
+        for u in units:
+            unit = JSONObject({'id'           : u.id,
+                               'name'         : u.name,
+                               'abbreviation' : u.abbreviation,
+                               'lf'           : u.lf,
+                               'cf'           : u.cf,
+                               'description'  : u.description,
+                               'dimension_id' : u.dimension_id,
+                               'project_id'   : u.project_id})
+            self.units_by_id[u.id] = unit
+            self.units_by_abbreviation.setdefault(u.abbreviation, []).append(unit)
+            units_by_dimension.setdefault(u.dimension_id, []).append(unit)
+
+        for d in dimensions:
+            dimension = JSONObject({'id'          : d.id,
+                                    'name'        : d.name,
+                                    'description' : d.description,
+                                    'project_id'  : d.project_id})
+            dimension.units = units_by_dimension.get(d.id, [])
+            self.dimensions_by_id[d.id] = dimension
+            self.dimensions_by_name[d.name.strip().lower()] = dimension
+
+    @property
+    def dimensions(self):
+        return list(self.dimensions_by_id.values())
+
+    @property
+    def units(self):
+        return list(self.units_by_id.values())
+
+def _load():
+    dimensions = db.DBSession.query(Dimension).all()
+    units = db.DBSession.query(Unit).all()
+    log.info("Loaded %s dimensions and %s units", len(dimensions), len(units))
+    return UnitIndex(dimensions, units)
+
+catalogue = Catalogue(_load)
+
+def get_index():
+    return catalogue.get()
+
+def invalidate():
+    catalogue.invalidate()
+
+def parse_unit(measure_or_unit_abbreviation):
+    """
+        Extract the constant factor from units such as '10^6 m^3'.
+        Same as hydra_base.lib.units._parse_unit.
+
+        Returns:
+            tuple(string, float): The unit abbreviation and the factor
+    """
+    try:
+        float(measure_or_unit_abbreviation[0])
+        factor, unit_abbreviation = measure_or_unit_abbreviation.split(' ', 1)
+        return unit_abbreviation, float(factor)
+    except ValueError:
+        return measure_or_unit_abbreviation, 1.0
+
+def get_unit(unit_id):
+    unit = get_index().units_by_id.get(unit_id)
+    if unit is None:
+        raise ResourceNotFoundError("Unit %s not found"%(unit_id))
+    return unit
+
+def get_unit_by_abbreviation(unit_abbreviation):
+    if unit_abbreviation is None:
+        unit_abbreviation = ''
+    units = get_index().units_by_abbreviation.get(unit_abbreviation.strip(), [])
+    if len(units) != 1:
+        raise ResourceNotFoundError("Unit '%s' not found"%(unit_abbreviation))
+    return units[0]
+
+def get_unit_by_measure_or_abbreviation(measure_or_unit_abbreviation):
+    """
+        Get the unit of a measure such as '10^6 m^3', or of a plain abbreviation.
+    """
+    unit_abbreviation, factor = parse_unit(measure_or_unit_abbreviation)
+
+    units = get_index().units_by_abbreviation.get(unit_abbreviation, [])
+
+    if len(units) == 0:
+        raise HydraError('Unit %s not found.'%(unit_abbreviation))
+    elif len(units) > 1:
+        raise HydraError('Unit %s has multiple dimensions not found.'%(unit_abbreviation))
+
+    return units[0]
+
+def get_dimension(dimension_id):
+    dimension = get_index().dimensions_by_id.get(dimension_id)
+    if dimension is None:
+        raise ResourceNotFoundError("Dimension %s not found"%(dimension_id))
+    return dimension
+
+def get_dimension_by_name(dimension_name):
+    if dimension_name is None:
+        dimension_name = ''
+    dimension = get_index().dimensions_by_name.get(dimension_name.strip().lower())
+    if dimension is None:
+        raise ResourceNotFoundError("Dimension %s not found"%(dimension_name))
+    return dimension
+
+def get_dimension_by_unit_id(unit_id):
+    return get_dimension(get_unit(unit_id).dimension_id)
+
+def get_dimension_by_unit_measure_or_abbreviation(measure_or_unit_abbreviation):
+    unit = get_unit_by_measure_or_abbreviation(measure_or_unit_abbreviation)
+    return get_dimension(unit.dimension_id)
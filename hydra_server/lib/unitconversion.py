@@ -0,0 +1,329 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Vectorised unit conversion.
+
+    Converting from one unit to another is always 'value * scale + offset',
+    so the (scale, offset) pair for each pair of units is worked out once,
+    cached, and applied to whole arrays, dataframes and timeseries with numpy.
+"""
+
+import json
+import logging
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import and_, or_, bindparam
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+from hydra_base.db.model import Dataset, Attr, Network, Scenario,\
+        ResourceAttr, ResourceScenario
+from hydra_base.exceptions import HydraError, ResourceNotFoundError, ValidationError
+from hydra_base.util.permissions import required_perms
+
+from . import metadatacache
+from . import unitcatalogue
+from . import dataingest
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#(source unit id, source factor, target unit id, target factor) -> (scale, offset),
+#for the unit catalogue version in _factor_cache_version.
+_factor_cache = {}
+_factor_cache_version = None
+_factor_lock = threading.Lock()
+
+def _get_cached_factors(key):
+    """
+        Look up a pair of units in the factor cache, dropping everything in
+        it first if the units have changed since it was filled.
+    """
+    global _factor_cache_version
+    version = unitcatalogue.catalogue.version
+    with _factor_lock:
+        if _factor_cache_version != version:
+            _factor_cache.clear()
+            _factor_cache_version = version
+        return _factor_cache.get(key)
+
+def get_conversion_factors(unit1, unit2):
+    """
+        Get the scale and offset which convert values in unit1 to unit2.
+        Both can be a unit abbreviation or a measure like '10^6 m^3'.
+
+        Returns:
+            tuple(float, float): (scale, offset)
+
+        Raises:
+            HydraError if the units don't exist or have different dimensions.
+    """
+    source = unitcatalogue.get_unit_by_measure_or_abbreviation(unit1)
+    target = unitcatalogue.get_unit_by_measure_or_abbreviation(unit2)
+
+    return get_unit_conversion_factors(source,
+                                       target,
+                                       source_factor=unitcatalogue.parse_unit(unit1)[1],
+                                       target_factor=unitcatalogue.parse_unit(unit2)[1])
+
+def get_unit_conversion_factors(source, target, source_factor=1.0, target_factor=1.0):
+    """
+        Get the scale and offset which convert values in the source unit to
+        the target unit, where both are units from the unit catalogue.
+    """
+    key = (source.id, source_factor, target.id, target_factor)
+    factors = _get_cached_factors(key)
+    if factors is not None:
+        return factors
+
+    if source.dimension_id != target.dimension_id:
+        raise HydraError("Unit conversion: dimensions are not consistent.")
+
+    source_lf = float(source.lf) if source.lf is not None else 1.0
+    source_cf = float(source.cf) if source.cf is not None else 0.0
+    target_lf = float(target.lf) if target.lf is not None else 1.0
+    target_cf = float(target.cf) if target.cf is not None else 0.0
+
+    #Same as hydra_base.lib.units.convert, rearranged into value * scale + offset
+    scale = (source_lf * source_factor) / (target_lf * target_factor)
+    offset = (source_cf - target_cf) / (target_lf * target_factor)
+
+    with _factor_lock:
+        _factor_cache[key] = (scale, offset)
+
+    return scale, offset
+
+def convert_values(values, unit1, unit2):
+    """
+        Convert a list of numbers from unit1 to unit2.
+
+        Returns:
+            numpy.ndarray: The converted values
+    """
+    scale, offset = get_conversion_factors(unit1, unit2)
+    return np.asarray(values, dtype=float) * scale + offset
+
+def _convert_nested(value, scale, offset):
+    """
+        Convert a nested list which can't be made into a numpy array
+        because its rows are of different lengths.
+    """
+    if isinstance(value, list):
+        return [_convert_nested(v, scale, offset) for v in value]
+    return float(value) * scale + offset
+
+def convert_value(data_type, value, scale, offset):
+    """
+        Convert the value of a dataset, as stored in the DB.
+
+        Returns:
+            string: The converted value, in the same format.
+    """
+    data_type = data_type.lower()
+
+    try:
+        if data_type == 'scalar':
+            return str(float(value) * scale + offset)
+        elif data_type == 'array':
+            arr = json.loads(value)
+            try:
+                converted = np.asarray(arr, dtype=float) * scale + offset
+                return json.dumps(converted.tolist())
+            except ValueError:
+                return json.dumps(_convert_nested(arr, scale, offset))
+        elif data_type in ('timeseries', 'dataframe'):
+            jo = json.loads(value, object_pairs_hook=collections.OrderedDict)
+            df = pd.DataFrame.from_dict(jo)
+            df = df.apply(pd.to_numeric) * scale + offset
+            return df.to_json()
+    except (TypeError, ValueError) as e:
+        raise HydraError("Unable to convert %s value: %s"%(data_type, e))
+
+    raise HydraError("Cannot convert %s."%(data_type,))
+
+def convert_datasets(dataset_ids, target_unit, user_id=None):
+    """
+        Convert several datasets to a new unit. As with
+        hydra_base.lib.units.convert_dataset, conversion always makes a new
+        dataset (or re-uses an identical existing one).
+
+        Args:
+            dataset_ids (list(int)): The datasets to convert
+            target_unit (string): The abbreviation of the unit to convert to
+            user_id (int): The user doing the conversion
+
+        Returns:
+            list(int): The ID of the converted dataset for each dataset, in input order.
+    """
+    target = unitcatalogue.get_unit_by_abbreviation(target_unit)
+
+    datasets = {}
+    for chunk in chunked(set(dataset_ids)):
+        for dataset_i in db.DBSession.query(Dataset).filter(Dataset.id.in_(chunk)).all():
+            datasets[dataset_i.id] = dataset_i
+
+    missing = set(dataset_ids) - set(datasets.keys())
+    if len(missing) > 0:
+        raise ResourceNotFoundError("Datasets %s not found"%(sorted(missing),))
+
+    for dataset_i in datasets.values():
+        if dataset_i.hidden == 'Y':
+            dataset_i.check_read_permission(user_id)
+
+    metadata = metadatacache.get_metadata(list(datasets.keys()),
+                                          dict((d.id, d.hash) for d in datasets.values()))
+
+    converted = {}
+    for dataset_id, dataset_i in datasets.items():
+        if dataset_i.unit_id is None:
+            raise HydraError("Dataset %s has no unit, so cannot be converted."%(dataset_id,))
+
+        scale, offset = get_unit_conversion_factors(unitcatalogue.get_unit(dataset_i.unit_id),
+                                                    target)
+
+        converted[dataset_id] = {
+            'type'       : dataset_i.type,
+            'name'       : dataset_i.name,
+            'unit_id'    : target.id,
+            'created_by' : user_id,
+            'value'      : convert_value(dataset_i.type, dataset_i.value, scale, offset),
+            #Where the new value is stored is decided when it's inserted
+            'metadata'   : dataingest.strip_storage_metadata(metadata[dataset_id]),
+        }
+
+    log.info("Converted %s datasets to %s", len(converted), target.abbreviation)
+
+    new_ids = dataingest.insert_datasets(list(converted.values()), user_id=user_id)
+    id_map = dict(zip(converted.keys(), new_ids))
+
+    return [id_map[dataset_id] for dataset_id in dataset_ids]
+
+@required_perms('edit_network')
+def apply_unit_to_network_rs(network_id, unit_id, attr_id, scenario_id=None,
+                             convert=False, dry_run=False, **kwargs):
+    """
+        Set the unit of all the datasets of an attribute in a network (or one
+        of its scenarios), optionally converting their values to the new unit.
+
+        The affected resource scenarios are found with one query. Datasets are
+        shared, so rather than changing them in place, new datasets with the
+        new unit are inserted in bulk and the resource scenarios are
+        re-pointed to them with one executemany.
+
+        Args:
+            network_id (int): The network
+            unit_id (int): The unit to apply
+            attr_id (int): The attribute whose datasets are to be changed
+            scenario_id (int): Optional. Only change datasets in this scenario.
+            convert (bool): Convert the values from their current unit. If
+                            False, only the unit is changed. Datasets with no
+                            unit are never converted.
+            dry_run (bool): Only count what would be changed.
+
+        Returns:
+            dict: The number of resource scenarios and datasets changed.
+
+        Raises:
+            ValidationError if the unit is incompatible with the attribute's dimension
+    """
+    user_id = kwargs.get('user_id')
+
+    network_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if network_i is None:
+        raise ResourceNotFoundError("Network %s not found"%(network_id,))
+    network_i.check_write_permission(user_id)
+
+    attr_i = db.DBSession.query(Attr).filter(Attr.id == attr_id).first()
+    if attr_i is None:
+        raise ResourceNotFoundError("Attribute %s not found"%(attr_id,))
+
+    unit = unitcatalogue.get_unit(unit_id)
+    if unit.dimension_id != attr_i.dimension_id:
+        raise ValidationError("Unit %s has a dimension of %s, not %s"%(
+            unit.name, unit.dimension_id, attr_i.dimension_id))
+
+    rs_qry = db.DBSession.query(ResourceScenario.scenario_id,
+                                ResourceScenario.resource_attr_id,
+                                ResourceScenario.dataset_id,
+                                Dataset.unit_id).filter(
+                                    Scenario.network_id == network_id,
+                                    ResourceScenario.scenario_id == Scenario.id,
+                                    ResourceAttr.id == ResourceScenario.resource_attr_id,
+                                    ResourceAttr.attr_id == attr_id,
+                                    Dataset.id == ResourceScenario.dataset_id,
+                                    or_(Dataset.unit_id != unit_id, Dataset.unit_id == None))
+
+    if scenario_id is not None:
+        rs_qry = rs_qry.filter(Scenario.id == scenario_id)
+
+    rs_rows = rs_qry.all()
+
+    dataset_ids = set(r.dataset_id for r in rs_rows)
+
+    summary = {'resource_scenarios' : len(rs_rows),
+               'datasets'           : len(dataset_ids),
+               'dry_run'            : 'Y' if dry_run else 'N'}
+
+    if dry_run is True or len(rs_rows) == 0:
+        return summary
+
+    datasets = {}
+    for chunk in chunked(dataset_ids):
+        for dataset_i in db.DBSession.query(Dataset).filter(Dataset.id.in_(chunk)).all():
+            datasets[dataset_i.id] = dataset_i
+
+    metadata = metadatacache.get_metadata(list(datasets.keys()),
+                                          dict((d.id, d.hash) for d in datasets.values()))
+
+    new_data = {}
+    for dataset_id, dataset_i in datasets.items():
+        value = dataset_i.value
+        if convert is True and dataset_i.unit_id is not None:
+            scale, offset = get_unit_conversion_factors(unitcatalogue.get_unit(dataset_i.unit_id),
+                                                        unit)
+            value = convert_value(dataset_i.type, value, scale, offset)
+
+        new_data[dataset_id] = {
+            'type'       : dataset_i.type,
+            'name'       : dataset_i.name,
+            'unit_id'    : unit_id,
+            'created_by' : user_id,
+            'value'      : value,
+            'metadata'   : dataingest.strip_storage_metadata(metadata[dataset_id]),
+        }
+
+    new_ids = dataingest.insert_datasets(list(new_data.values()), user_id=user_id)
+    id_map = dict(zip(new_data.keys(), new_ids))
+
+    rs_update = ResourceScenario.__table__.update().where(and_(
+        ResourceScenario.__table__.c.scenario_id == bindparam('b_scenario_id'),
+        ResourceScenario.__table__.c.resource_attr_id == bindparam('b_resource_attr_id'))).values(
+            dataset_id=bindparam('b_dataset_id'))
+
+    db.DBSession.execute(rs_update, [{'b_scenario_id'      : r.scenario_id,
+                                      'b_resource_attr_id' : r.resource_attr_id,
+                                      'b_dataset_id'       : id_map[r.dataset_id]} for r in rs_rows])
+    mark_changed(db.DBSession())
+
+    log.info("Applied unit %s to %s resource scenarios in network %s",
+             unit_id, len(rs_rows), network_id)
+
+    return summary
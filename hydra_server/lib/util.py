@@ -0,0 +1,32 @@
+
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Small helpers shared by the server-side query code in hydra_server.lib.
+"""
+
+#Keep IN clauses below the SQLite host parameter limit. MySQL and Postgres
+#accept more, but the chunks are big enough that it makes little difference.
+qry_in_threshold = 999
+
+def chunked(items, size=qry_in_threshold):
+    """
+        Split a list into consecutive lists of at most 'size' items,
+        so they can be used in IN clauses without hitting DB limits.
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,601 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Validation of scenarios and networks against their templates.
+
+    These give the same results as hydra_base's validate_* functions, but
+    the types, names and attributes of the resources are loaded with one
+    query per type of resource rather than one per resource, and the
+    template types come from the template cache.
+
+    The data restrictions of each typeattr are compiled once per version
+    of the template cache. Values are checked in batches of resources,
+    over a process pool when there is more than one batch (see restrictions.py).
+    Everything needed from the DB is loaded first, and the errors are
+    returned as a generator. Callers must consume it within the request,
+    so errors raised while checking are handled like any other.
+"""
+
+import json
+import logging
+
+from hydra_base import db
+from hydra_base.db.model import ResourceAttr, ResourceScenario, ResourceType, Scenario, Network, Dataset
+from hydra_base.util.permissions import required_perms
+from hydra_base import config
+from hydra_base.exceptions import HydraError, ResourceNotFoundError
+
+from .cache import LRUCache
+from .util import chunked
+from .resourceattrs import ref_key_columns, network_resources, resource_classes
+from .restrictions import RestrictionChecker, check_batches
+from . import attrindex, templatecache, unitcatalogue, validationstate
+
+log = logging.getLogger(__name__)
+
+#Compiled restrictions, keyed on (template cache version, typeattr ID)
+checkers = LRUCache(config.getint('hydra_server', 'validation_checker_cache_size', 10000))
+
+def _group_by_ref_key(resource_keys):
+    ref_ids_by_key = {}
+    for ref_key, ref_id in resource_keys:
+        ref_ids_by_key.setdefault(ref_key, set()).add(ref_id)
+    return ref_ids_by_key
+
+def get_resource_type_ids(resource_keys):
+    """
+        Get the types of resources.
+
+        Args:
+            resource_keys (iterable): (ref_key, ref_id) tuples
+
+        Returns:
+            dict: The type IDs of each resource with types, keyed on
+                (ref_key, ref_id), in the order they were assigned.
+    """
+    type_ids = {}
+    for ref_key, ref_ids in _group_by_ref_key(resource_keys).items():
+        if ref_key == 'PROJECT':
+            continue
+        ref_col = getattr(ResourceType, ref_key_columns[ref_key])
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(ref_col, ResourceType.type_id).filter(
+                ref_col.in_(id_chunk)).order_by(ResourceType.id).all()
+            for ref_id, type_id in rows:
+                type_ids.setdefault((ref_key, ref_id), []).append(type_id)
+    return type_ids
+
+def get_resource_names(resource_keys):
+    """
+        Returns:
+            dict: The name of each resource, keyed on (ref_key, ref_id)
+    """
+    names = {}
+    for ref_key, ref_ids in _group_by_ref_key(resource_keys).items():
+        resource_class = resource_classes[ref_key]
+        for id_chunk in chunked(list(ref_ids)):
+            rows = db.DBSession.query(resource_class.id, resource_class.name).filter(
+                resource_class.id.in_(id_chunk)).all()
+            for ref_id, name in rows:
+                names[(ref_key, ref_id)] = name
+    return names
+
+def get_restriction(typeattr):
+    """
+        The data restriction of a typeattr as a dict, which is empty if there isn't one.
+    """
+    restriction = typeattr.data_restriction
+    if restriction is None or restriction == '':
+        return {}
+    if isinstance(restriction, str):
+        return json.loads(restriction)
+    return restriction
+
+def get_checker(typeattr):
+    key = (templatecache.get_version(), typeattr.id)
+    checker = checkers.get(key)
+    if checker is None:
+        checker = RestrictionChecker(get_restriction(typeattr))
+        checkers.set(key, checker)
+    return checker
+
+def _get_type_checkers(types_by_id):
+    """
+        Returns:
+            dict: The checkers of each attribute of each type, as {type_id: {attr_id: [checker]}},
+                leaving out typeattrs with no restrictions.
+    """
+    type_checkers = {}
+    for type_id, ttype in types_by_id.items():
+        attr_checkers = type_checkers.setdefault(type_id, {})
+        for typeattr in ttype.typeattrs:
+            checker = get_checker(typeattr)
+            if len(checker.restriction) > 0:
+                attr_checkers.setdefault(typeattr.attr_id, []).append(checker)
+    return type_checkers
+
+def _get_resource_key(ra):
+    return (ra.ref_key, getattr(ra, ref_key_columns[ra.ref_key]))
+
+def _get_scenario(scenario_id, user_id):
+    scenario_i = db.DBSession.query(Scenario).filter(Scenario.id == scenario_id).first()
+    if scenario_i is None:
+        raise ResourceNotFoundError("Scenario %s not found"%(scenario_id))
+    scenario_i.network.check_read_permission(user_id)
+    return scenario_i
+
+def _query_resource_scenarios(scenario_id):
+    return db.DBSession.query(ResourceScenario.resource_attr_id,
+                              ResourceScenario.dataset_id,
+                              ResourceAttr.attr_id,
+                              ResourceAttr.ref_key,
+                              ResourceAttr.network_id,
+                              ResourceAttr.project_id,
+                              ResourceAttr.node_id,
+                              ResourceAttr.link_id,
+                              ResourceAttr.group_id).join(
+                                  ResourceAttr, ResourceAttr.id == ResourceScenario.resource_attr_id).filter(
+                                      ResourceScenario.scenario_id == scenario_id)
+
+def _get_values(dataset_ids):
+    """
+        Returns:
+            dict: The value of each dataset, or the HydraError raised getting it
+    """
+    values = {}
+    for id_chunk in chunked(list(dataset_ids)):
+        for dataset_i in db.DBSession.query(Dataset).filter(Dataset.id.in_(id_chunk)).all():
+            try:
+                values[dataset_i.id] = dataset_i.get_val()
+            except HydraError as e:
+                values[dataset_i.id] = e
+    return values
+
+def _plan_checks(scenario_i, rows, template_id):
+    """
+        Work out which restrictions apply to each resource scenario, as
+        validate_resourcescenario does.
+
+        Returns:
+            dict: The checkers for each row, keyed on position in rows
+            dict: Errors found without checking values, keyed on position in rows
+    """
+    resource_type_ids = get_resource_type_ids(set(_get_resource_key(row) for row in rows))
+    types_by_id = templatecache.get_types_by_id(
+        set(t_id for type_ids in resource_type_ids.values() for t_id in type_ids))
+    type_checkers = _get_type_checkers(types_by_id)
+
+    planned = {}
+    errors = {}
+    for idx, row in enumerate(rows):
+        type_ids = resource_type_ids.get(_get_resource_key(row), [])
+        if len(type_ids) == 0:
+            continue
+
+        if template_id is not None:
+            if template_id not in [types_by_id[t_id].template_id for t_id in type_ids]:
+                errors[idx] = "Template %s is not used for resource attribute %s in scenario %s"%\
+                    (template_id, attrindex.get_attribute_by_id(row.attr_id).name, scenario_i.name)
+                continue
+            type_ids = [t_id for t_id in type_ids if types_by_id[t_id].template_id == template_id]
+
+        row_checkers = []
+        for type_id in type_ids:
+            row_checkers.extend(type_checkers[type_id].get(row.attr_id, []))
+        if len(row_checkers) > 0:
+            planned[idx] = row_checkers
+
+    return planned, errors
+
+def _make_batches(rows, planned, values, errors):
+    """
+        Split the checks into batches of whole resources, adding errors
+        from getting values to 'errors'.
+
+        Returns:
+            list: The items for check_values in each batch
+    """
+    batch_size = config.getint('hydra_server', 'validation_batch_size', 1000)
+
+    batches = []
+    batch = []
+    resources_in_batch = 0
+    last_key = None
+    for idx in sorted(planned):
+        value = values.get(rows[idx].dataset_id)
+        if isinstance(value, HydraError):
+            errors[idx] = value.args[0]
+            continue
+
+        key = _get_resource_key(rows[idx])
+        if key != last_key:
+            if resources_in_batch == batch_size:
+                batches.append(batch)
+                batch = []
+                resources_in_batch = 0
+            resources_in_batch += 1
+            last_key = key
+        batch.append((idx, planned[idx], value))
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+def _sort_rows(rows):
+    #Batches are of whole resources, so put each resource's rows together
+    return sorted(rows, key=lambda row: (_get_resource_key(row), row.resource_attr_id))
+
+def _get_error_maker(scenario_id, template_id, rows, idxs):
+    """
+        Load the names needed to describe errors on the given rows.
+
+        Returns:
+            function: Makes the dict describing an error, from the
+                position of its row and the error text
+    """
+    names = get_resource_names(set(_get_resource_key(rows[idx]) for idx in idxs))
+    attr_names = dict((a.id, a.name) for a in attrindex.get_attributes_by_id(
+        list(set(rows[idx].attr_id for idx in idxs))))
+
+    def make_error(idx, error_text):
+        row = rows[idx]
+        key = _get_resource_key(row)
+        return dict(
+            ref_key=row.ref_key,
+            ref_id=key[1],
+            ref_name=names.get(key),
+            resource_attr_id=row.resource_attr_id,
+            attr_id=row.attr_id,
+            attr_name=attr_names.get(row.attr_id),
+            dataset_id=row.dataset_id,
+            scenario_id=scenario_id,
+            template_id=template_id,
+            error_text=error_text)
+
+    return make_error
+
+def _check_resource_scenarios(scenario_i, rows, template_id):
+    """
+        Check the values of resource scenarios against the restrictions of the
+        types of their resources.
+
+        Args:
+            rows (list): Rows from _query_resource_scenarios
+
+        Returns:
+            generator: A dict describing each resource scenario which fails validation
+    """
+    rows = _sort_rows(rows)
+
+    planned, errors = _plan_checks(scenario_i, rows, template_id)
+    values = _get_values(set(rows[idx].dataset_id for idx in planned))
+    batches = _make_batches(rows, planned, values, errors)
+
+    make_error = _get_error_maker(scenario_i.id, template_id, rows, list(planned) + list(errors))
+
+    log.info("Checking %s values in scenario %s", len(planned), scenario_i.id)
+
+    def generate_errors():
+        #Errors found without checking values are sent in order with the others.
+        pending = sorted(errors.items())
+        for failures in check_batches(batches):
+            if len(failures) > 0:
+                last_idx = failures[-1][0]
+                batch_errors = [e for e in pending if e[0] < last_idx]
+                pending = pending[len(batch_errors):]
+                for idx, error_text in sorted(batch_errors + failures):
+                    yield make_error(idx, error_text)
+        for idx, error_text in pending:
+            yield make_error(idx, error_text)
+
+    return generate_errors()
+
+@required_perms('get_network')
+def validate_attr(resource_attr_id, scenario_id, template_id=None, **kwargs):
+    """
+        Check that a resource attribute's value in a scenario satisfies the
+        restrictions of all the types of its resource.
+
+        Returns:
+            dict: The error, or None if the value is valid
+    """
+    scenario_i = _get_scenario(scenario_id, kwargs.get('user_id'))
+
+    rows = _query_resource_scenarios(scenario_id).filter(
+        ResourceScenario.resource_attr_id == resource_attr_id).all()
+    if len(rows) == 0:
+        raise ResourceNotFoundError("Resource attribute %s has no value in scenario %s"%
+                                    (resource_attr_id, scenario_id))
+
+    return next(_check_resource_scenarios(scenario_i, rows, template_id), None)
+
+@required_perms('get_network')
+def validate_attrs(resource_attr_ids, scenario_id, template_id=None, **kwargs):
+    """
+        Check that the values of multiple resource attributes in a scenario
+        satisfy the restrictions of the types of their resources.
+
+        Returns:
+            generator: A dict describing each value which fails validation
+    """
+    scenario_i = _get_scenario(scenario_id, kwargs.get('user_id'))
+
+    rows = []
+    for id_chunk in chunked(list(set(resource_attr_ids))):
+        rows.extend(_query_resource_scenarios(scenario_id).filter(
+            ResourceScenario.resource_attr_id.in_(id_chunk)).all())
+
+    return _check_resource_scenarios(scenario_i, rows, template_id)
+
+@required_perms('get_network')
+def validate_scenario(scenario_id, template_id=None, **kwargs):
+    """
+        Check that all the values in a scenario satisfy the restrictions of the
+        types of their resources. If a template is specified, only its
+        types are checked.
+
+        Returns:
+            generator: A dict describing each value which fails validation
+    """
+    scenario_i = _get_scenario(scenario_id, kwargs.get('user_id'))
+
+    rows = _query_resource_scenarios(scenario_id).all()
+
+    return _check_resource_scenarios(scenario_i, rows, template_id)
+
+@required_perms('get_network')
+def validate_scenario_incremental(scenario_id, template_id=None, **kwargs):
+    """
+        Check the values in a scenario against the restrictions of the types
+        of their resources, as validate_scenario does, but only check the
+        values which have changed, or whose restrictions have changed, since
+        the last time this was called for the scenario and template.
+
+        Returns:
+            list: A dict describing each value which fails validation, including
+                those found by previous validations which still apply.
+    """
+    scenario_i = _get_scenario(scenario_id, kwargs.get('user_id'))
+    template_key = template_id if template_id is not None else validationstate.ALL_TEMPLATES
+
+    rows = _query_resource_scenarios(scenario_id).join(
+        Dataset, Dataset.id == ResourceScenario.dataset_id).add_columns(
+            Dataset.hash.label('dataset_hash')).all()
+    rows = _sort_rows(rows)
+
+    planned, errors = _plan_checks(scenario_i, rows, template_id)
+    restriction_hashes = validationstate.get_restriction_hashes(planned)
+    stored = validationstate.get_results(scenario_id, template_key)
+
+    to_check = {}
+    for idx, checkers in planned.items():
+        row = rows[idx]
+        result = stored.get(row.resource_attr_id)
+        if result is not None and result[0] == row.dataset_hash and result[1] == restriction_hashes[idx]:
+            if result[2] is not None:
+                errors[idx] = result[2]
+        else:
+            to_check[idx] = checkers
+
+    log.info("%s of %s values in scenario %s changed since they were last validated",
+             len(to_check), len(planned), scenario_id)
+
+    values = _get_values(set(rows[idx].dataset_id for idx in to_check))
+    new_errors = {}
+    batches = _make_batches(rows, to_check, values, new_errors)
+    for failures in check_batches(batches):
+        new_errors.update(failures)
+    errors.update(new_errors)
+
+    #Results of values which are no longer checked are dropped too
+    planned_ra_ids = set(rows[idx].resource_attr_id for idx in planned)
+    outdated_ra_ids = set(ra_id for ra_id in stored if ra_id not in planned_ra_ids)
+    results = []
+    for idx in to_check:
+        row = rows[idx]
+        results.append({'scenario_id'      : scenario_id,
+                        'template_id'      : template_key,
+                        'resource_attr_id' : row.resource_attr_id,
+                        'dataset_hash'     : row.dataset_hash,
+                        'restriction_hash' : restriction_hashes[idx],
+                        'error_text'       : new_errors.get(idx)})
+        if row.resource_attr_id in stored:
+            outdated_ra_ids.add(row.resource_attr_id)
+    validationstate.store_results(scenario_id, template_key, outdated_ra_ids, results)
+
+    make_error = _get_error_maker(scenario_id, template_id, rows, list(errors))
+    return [make_error(idx, error_text) for idx, error_text in sorted(errors.items())]
+
+def _get_network_resources(network_i):
+    """
+        Get the network, nodes, links and groups of a network, with their
+        attributes and types.
+
+        Returns:
+            list: (ref_key, ref_id, name) for each resource
+            dict: The (resource_attr_id, attr_id) of each resource, keyed on (ref_key, ref_id)
+    """
+    resources = [('NETWORK', network_i.id, network_i.name)]
+    for ref_key, resource_class in network_resources.items():
+        rows = db.DBSession.query(resource_class.id, resource_class.name).filter(
+            resource_class.network_id == network_i.id).order_by(resource_class.id).all()
+        resources.extend((ref_key, row.id, row.name) for row in rows)
+
+    resource_attrs = {}
+    ra_rows = db.DBSession.query(ResourceAttr.id, ResourceAttr.attr_id).filter(
+        ResourceAttr.network_id == network_i.id).order_by(ResourceAttr.id).all()
+    resource_attrs[('NETWORK', network_i.id)] = [tuple(r) for r in ra_rows]
+    for ref_key, resource_class in network_resources.items():
+        ref_col = getattr(ResourceAttr, ref_key_columns[ref_key])
+        ra_rows = db.DBSession.query(ref_col, ResourceAttr.id, ResourceAttr.attr_id).join(
+            resource_class, ref_col == resource_class.id).filter(
+                resource_class.network_id == network_i.id).order_by(ResourceAttr.id).all()
+        for ref_id, ra_id, attr_id in ra_rows:
+            resource_attrs.setdefault((ref_key, ref_id), []).append((ra_id, attr_id))
+
+    return resources, resource_attrs
+
+def _get_network_type_ids(network_i):
+    """
+        As get_resource_type_ids, for every resource in a network.
+    """
+    type_ids = {}
+    rows = db.DBSession.query(ResourceType.type_id).filter(
+        ResourceType.network_id == network_i.id).order_by(ResourceType.id).all()
+    if len(rows) > 0:
+        type_ids[('NETWORK', network_i.id)] = [r.type_id for r in rows]
+    for ref_key, resource_class in network_resources.items():
+        ref_col = getattr(ResourceType, ref_key_columns[ref_key])
+        rows = db.DBSession.query(ref_col, ResourceType.type_id).join(
+            resource_class, ref_col == resource_class.id).filter(
+                resource_class.network_id == network_i.id).order_by(ResourceType.id).all()
+        for ref_id, type_id in rows:
+            type_ids.setdefault((ref_key, ref_id), []).append(type_id)
+    return type_ids
+
+def _get_unit_ids(scenario_id):
+    """
+        Returns:
+            dict: The unit of the value of each resource attribute in a scenario
+    """
+    rows = db.DBSession.query(ResourceScenario.resource_attr_id, Dataset.unit_id).join(
+        Dataset, Dataset.id == ResourceScenario.dataset_id).filter(
+            ResourceScenario.scenario_id == scenario_id).all()
+    return dict((row.resource_attr_id, row.unit_id) for row in rows)
+
+def _get_dimension_id(unit_id):
+    if unit_id is None:
+        return None
+    return unitcatalogue.get_dimension_by_unit_id(unit_id).id
+
+class _TypeRules(object):
+    """
+        What validate_network checks for a type, worked out once per call
+        rather than once per resource.
+    """
+    def __init__(self, ttype):
+        self.typeattrs = dict((ta.attr_id, ta) for ta in ttype.typeattrs)
+        self.attrs = dict((a.id, a) for a in attrindex.get_attributes_by_id(list(self.typeattrs)))
+
+    def check(self, ref_key, name, resource_attrs, unit_ids, dimension_ids):
+        """
+            Check a resource has all the attributes of the type and, if there is
+            data, that the values have the right dimension and unit.
+        """
+        errors = []
+
+        attr_ids = set(attr_id for _, attr_id in resource_attrs)
+
+        for attr_id in self.typeattrs:
+            if attr_id not in attr_ids:
+                errors.append("Resource %s does not have attribute %s"%
+                              (name, self.attrs[attr_id].name))
+
+        for ra_id, attr_id in resource_attrs:
+            if ra_id not in unit_ids or attr_id not in self.typeattrs:
+                continue
+            attr = self.attrs[attr_id]
+            rs_unit_id = unit_ids[ra_id]
+            rs_dimension_id = dimension_ids[rs_unit_id]
+
+            if rs_dimension_id != attr.dimension_id:
+                errors.append("Dimension mismatch on %s %s, attribute %s: "
+                              "%s on attribute, %s on type"%
+                              (ref_key, name, attr.name,
+                               rs_dimension_id, attr.dimension_id))
+
+            type_unit_id = self.typeattrs[attr_id].unit_id
+            if type_unit_id is not None and rs_unit_id != type_unit_id:
+                errors.append("Unit mismatch on attribute %s. "
+                              "%s on attribute, %s on type"%
+                              (attr.name, rs_unit_id, type_unit_id))
+
+        return errors
+
+@required_perms('get_network')
+def validate_network(network_id, template_id, scenario_id=None, **kwargs):
+    """
+        Check that all the resources in a network with a type from the template
+        have the attributes the type requires and, if a scenario is given,
+        that their values have the dimensions and units the type requires.
+
+        Returns:
+            generator: A description of each problem found
+    """
+    network_i = db.DBSession.query(Network).filter(Network.id == network_id).first()
+    if network_i is None:
+        raise HydraError("Could not find network %s"%(network_id))
+    network_i.check_read_permission(kwargs.get('user_id'))
+
+    unit_ids = {}
+    if scenario_id is not None:
+        if db.DBSession.query(Scenario.id).filter(Scenario.id == scenario_id).first() is None:
+            raise HydraError("Could not find scenario %s"%(scenario_id,))
+        unit_ids = _get_unit_ids(scenario_id)
+
+    tmpl = templatecache.get_resolved_template(template_id)
+    resource_types = set(t.resource_type for t in tmpl.template.templatetypes)
+
+    resources, resource_attrs = _get_network_resources(network_i)
+    resource_type_ids = _get_network_type_ids(network_i)
+
+    #Work out which type of the template each resource is checked against,
+    #and the rules of those types, before anything is returned.
+    checks = []
+    type_rules = {}
+    for ref_key, ref_id, name in resources:
+        #Only check if there are type definitions for this kind of resource in the template.
+        if ref_key not in resource_types:
+            continue
+
+        #No validation required if the resource has no type.
+        type_ids = resource_type_ids.get((ref_key, ref_id), [])
+        if len(type_ids) == 0:
+            continue
+
+        for type_id in type_ids:
+            ttype = tmpl.types_by_id.get(type_id)
+            if ttype is not None and ttype.resource_type == ref_key:
+                break
+        else:
+            ttype = None
+
+        if ttype is not None and ttype.id not in type_rules:
+            type_rules[ttype.id] = _TypeRules(ttype)
+        checks.append((ref_key, ref_id, name, ttype))
+
+    dimension_ids = dict((unit_id, _get_dimension_id(unit_id)) for unit_id in set(unit_ids.values()))
+
+    def generate_errors():
+        num_errors = 0
+        for ref_key, ref_id, name, ttype in checks:
+            if ttype is None:
+                errors = ["No type from template %s found on %s %s"%(template_id, ref_key, name)]
+            else:
+                errors = type_rules[ttype.id].check(ref_key,
+                                                    name,
+                                                    resource_attrs.get((ref_key, ref_id), []),
+                                                    unit_ids,
+                                                    dimension_ids)
+            for error in errors:
+                num_errors += 1
+                yield error
+        if num_errors > 0:
+            log.warning("%s problems found validating network %s against template %s",
+                        num_errors, network_id, template_id)
+
+    return generate_errors()
@@ -0,0 +1,105 @@
+# (c) Copyright 2013, 2014, University of Manchester
+#
+# HydraPlatform is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# HydraPlatform is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
+#
+"""
+    Stored results of validating the values in scenarios, for incremental
+    validation (see validation.validate_scenario_incremental).
+
+    The result of checking each value is stored along with the hash of its
+    dataset and a hash of the restrictions it was checked against.
+    Whether a value passes depends only on the value and the restrictions,
+    so a stored result is correct whenever both hashes match, even if the
+    scenario has been changed and changed back in between.
+"""
+
+import json
+import hashlib
+import logging
+
+from sqlalchemy import Table, Column, Integer, BigInteger, String, Text, MetaData, and_
+from zope.sqlalchemy import mark_changed
+
+from hydra_base import db
+
+from .util import chunked
+
+log = logging.getLogger(__name__)
+
+#Results are stored under this template ID when all templates are checked
+ALL_TEMPLATES = 0
+
+validation_results = Table('tValidationResult', MetaData(),
+                           Column('scenario_id', Integer, primary_key=True, autoincrement=False),
+                           Column('template_id', Integer, primary_key=True, autoincrement=False),
+                           Column('resource_attr_id', Integer, primary_key=True, autoincrement=False),
+                           Column('dataset_hash', BigInteger, nullable=False),
+                           Column('restriction_hash', String(40), nullable=False),
+                           Column('error_text', Text, nullable=True))
+
+def create_tables(engine):
+    """
+        Create the table of stored results if it is not already in the DB.
+        Safe to call on every startup.
+    """
+    validation_results.create(engine, checkfirst=True)
+
+def hash_restrictions(checkers):
+    restrictions = [checker.restriction for checker in checkers]
+    return hashlib.sha1(json.dumps(restrictions, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_restriction_hashes(planned):
+    """
+        Returns:
+            dict: The hash of the restrictions each row is checked against, keyed on position
+    """
+    #Rows of the same typeattrs share their list of checkers
+    hashes_by_checkers = {}
+    restriction_hashes = {}
+    for idx, checkers in planned.items():
+        key = tuple(id(checker) for checker in checkers)
+        if key not in hashes_by_checkers:
+            hashes_by_checkers[key] = hash_restrictions(checkers)
+        restriction_hashes[idx] = hashes_by_checkers[key]
+    return restriction_hashes
+
+def get_results(scenario_id, template_id):
+    """
+        Returns:
+            dict: (dataset hash, restriction hash, error text) keyed on resource attribute ID
+    """
+    rows = db.DBSession.execute(validation_results.select().where(and_(
+        validation_results.c.scenario_id == scenario_id,
+        validation_results.c.template_id == template_id))).fetchall()
+    return dict((row.resource_attr_id, (row.dataset_hash, row.restriction_hash, row.error_text))
+                for row in rows)
+
+def store_results(scenario_id, template_id, ra_ids_to_delete, results):
+    """
+        Replace the stored results of the given resource attributes.
+
+        Args:
+            ra_ids_to_delete (iterable): Resource attributes whose results are out of date
+            results (list): dicts of the new results
+    """
+    for id_chunk in chunked(list(ra_ids_to_delete)):
+        db.DBSession.execute(validation_results.delete().where(and_(
+            validation_results.c.scenario_id == scenario_id,
+            validation_results.c.template_id == template_id,
+            validation_results.c.resource_attr_id.in_(id_chunk))))
+
+    if len(results) > 0:
+        db.DBSession.execute(validation_results.insert(), results)
+
+    mark_changed(db.DBSession())
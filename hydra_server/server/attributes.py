@@ -28,6 +28,8 @@ from .service import HydraService
 from hydra_base.lib import attributes
 from hydra_base.lib.objects import JSONObject
 
+from ..lib import attrindex, resourceattrs, dedupe, mappinggraph, templatecache
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -59,6 +61,7 @@ class AttributeService(HydraService):
         """
 
         attr = attributes.add_attribute_no_checks(attr, **ctx.in_header.__dict__)
+        attrindex.invalidate()
         return Attr(attr)
 
     @rpc(Attr, _returns=Attr)
@@ -83,6 +86,7 @@ class AttributeService(HydraService):
         """
 
         attr = attributes.add_attribute(attr, **ctx.in_header.__dict__)
+        attrindex.invalidate()
         return Attr(attr)
 
     @rpc(Attr, _returns=Attr)
@@ -93,6 +97,7 @@ class AttributeService(HydraService):
         """
         log.debug("Adding attribute: %s", attr.name)
         attr = attributes.add_attribute_no_checks(attr, **ctx.in_header.__dict__)
+        attrindex.invalidate()
         return Attr(attr)
 
     @rpc(Attr, _returns=Attr)
@@ -117,6 +122,9 @@ class AttributeService(HydraService):
 
         """
         attr = attributes.update_attribute(attr, **ctx.in_header.__dict__)
+        attrindex.invalidate()
+        #Cached templates include the attributes of their typeattrs
+        templatecache.invalidate()
         return Attr(attr)
 
     @rpc(Integer, _returns=Unicode)
@@ -132,6 +140,8 @@ class AttributeService(HydraService):
 
         """
         attributes.delete_attribute(attr_id, **ctx.in_header.__dict__)
+        attrindex.invalidate()
+        templatecache.invalidate()
 
         return 'OK'
 
@@ -151,6 +161,7 @@ class AttributeService(HydraService):
         """
 
         attrs = attributes.add_attributes(attrs, **ctx.in_header.__dict__)
+        attrindex.invalidate()
         ret_attrs = [Attr(attr) for attr in attrs]
         return ret_attrs
 
@@ -166,7 +177,7 @@ class AttributeService(HydraService):
             List[Attr]: A list of attribute complex models
         """
 
-        attrs = attributes.get_attributes(**ctx.in_header.__dict__)
+        attrs = attrindex.get_all_attributes()
         ret_attrs = [Attr(attr) for attr in attrs]
         return ret_attrs
 
@@ -182,7 +193,7 @@ class AttributeService(HydraService):
             complexmodels.Attr: An attribute complex model.
                 Returns None if no attribute is found.
         """
-        attr = attributes.get_attribute_by_id(attr_id, **ctx.in_header.__dict__)
+        attr = attrindex.get_attribute_by_id(attr_id)
 
         return Attr(attr)
 
@@ -198,7 +209,7 @@ class AttributeService(HydraService):
             list(complexmodels.Attr): An attribute complex model.
                 Returns [] if no attribute is found.
         """
-        attrs = attributes.get_attributes_by_id(attr_ids, **ctx.in_header.__dict__)
+        attrs = attrindex.get_attributes_by_id(attr_ids)
 
         return [Attr(attr) for attr in attrs]
 
@@ -210,25 +221,47 @@ class AttributeService(HydraService):
 
         Args:
             name (unicode): The name of the attribute
-            dimension (unicode): The dimension of the attribute
-            network_id (integer): Search for attributes only within this network scope
-            project_id (integer): Search for attributes only within this project scope
+            dimension_id (int): The ID of the dimension of the attribute
 
         Returns:
             complexmodels.Attr: An attribute complex model.
                 Returns None if no attribute is found.
 
         """
-        attr = attributes.get_attribute_by_name_and_dimension(name,
-                                                              dimension_id,
-                                                              network_id,
-                                                              project_id,
-                                                              **ctx.in_header.__dict__)
+        attr = attrindex.get_attribute_by_name_and_dimension(name, dimension_id)
         if attr:
             return Attr(attr)
 
         return None
 
+    @rpc(SpyneArray(Attr), Unicode(pattern="['YN']", default='N'), _returns=SpyneArray(Attr))
+    def resolve_attributes(ctx, attrs, create_missing):
+        """
+        Look up a list of attributes by name and dimension in one call.
+
+        .. code-block:: python
+
+            (Attr){
+                name = "Test Attr"
+                dimension_id = 1  # or dimension = "Volume"
+                network_id (optional) = 456
+                project_id (optional) = 123
+            }
+
+        Args:
+            attrs (List[Attr]): The attributes to look up, as described above.
+            create_missing (char): 'Y' to add the attributes which don't exist.
+
+        Returns:
+            List[Attr]: The attributes, in the order requested. If create_missing
+                is 'N', attributes which don't exist are returned as None.
+        """
+        resolved = attrindex.resolve_attributes(attrs,
+                                                create_missing=create_missing=='Y',
+                                                **ctx.in_header.__dict__)
+
+        return [Attr(attr) if attr is not None else None for attr in resolved]
+
     @rpc(Integer, _returns=SpyneArray(Attr))
     def get_template_attributes(ctx, template_id):
         """
@@ -332,6 +365,34 @@ class AttributeService(HydraService):
 
         return return_dict
 
+    @rpc(SpyneArray(ResourceAttr), _returns=SpyneArray(Integer))
+    def bulk_add_resource_attributes(ctx, resource_attributes):
+        """
+        Add many resource attributes in one go. Resource attributes which
+        already exist are not duplicated, but their attr_is_var is updated.
+
+        .. code-block:: python
+
+            (ResourceAttr){
+                ref_key = "NODE"
+                ref_id = 123
+                attr_id = 456
+                attr_is_var = "N"
+            }
+
+        Args:
+            resource_attributes (List[ResourceAttr]): The resource attributes to add, as described above.
+
+        Returns:
+            List[int]: The ID of each resource attribute, in the order they were sent.
+
+        Raises:
+            ResourceNotFoundError: If a resource or attribute does not exist
+        """
+        ras = [(ra.ref_key, ra.ref_id, ra.attr_id, ra.attr_is_var) for ra in resource_attributes]
+
+        return resourceattrs.bulk_add_resource_attributes(ras, ctx.in_header.user_id)
+
     @rpc(Integer, Unicode(pattern="['YN']"), _returns=ResourceAttr)
     def update_resource_attribute(ctx, resource_attr_id, is_var):
         """
@@ -905,6 +966,7 @@ class AttributeService(HydraService):
             ResourceNotFoundError: If either resource attribute is not found.
         """
         attributes.set_attribute_mapping(resource_attr_a, resource_attr_b, **ctx.in_header.__dict__)
+        mappinggraph.invalidate()
 
         return 'OK'
 
@@ -923,6 +985,7 @@ class AttributeService(HydraService):
 
         """
         attributes.delete_attribute_mapping(resource_attr_a, resource_attr_b, **ctx.in_header.__dict__)
+        mappinggraph.invalidate()
 
         return 'OK'
 
@@ -958,6 +1021,7 @@ class AttributeService(HydraService):
             string: 'OK'
         """
         attributes.delete_mappings_in_network(network_id, network_2_id, **ctx.in_header.__dict__)
+        mappinggraph.invalidate()
 
         return 'OK'
 
@@ -1157,9 +1221,14 @@ class AttributeGroupService(HydraService):
                 3: Remap all resource attributes and type attributes to point from
                    duplicate attrs to the keeper.
                 4: Delete the duplicates.
+
+            This is done in batches, committing after each one.
+            See run_duplicate_attribute_cleanup.
         """
 
-        attributes.delete_all_duplicate_attributes(**ctx.in_header.__dict__)
+        dedupe.delete_duplicate_attributes(**ctx.in_header.__dict__)
+
+        return 'OK'
 
     @rpc(_returns=Unicode)
     def delete_duplicate_resourceattributes(ctx):
@@ -1167,5 +1236,69 @@ class AttributeGroupService(HydraService):
         for every resource, find any situations where there are duplicate attribute
         names, ex 2 max_flows, but where the attribute IDs are different. In this case,
         remove one of them, and keep the one which is used in the template for that node.
+
+        This is done in batches, committing after each one.
+        See run_duplicate_resourceattribute_cleanup.
         """
-        attributes.delete_duplicate_resourceattributes(**ctx.in_header.__dict__)
+        dedupe.delete_duplicate_resourceattributes(**ctx.in_header.__dict__)
+
+        return 'OK'
+
+    @rpc(Unicode(pattern="['YN']", default='N'),
+         Integer(default=100),
+         Integer(default=None),
+         _returns=AnyDict)
+    def run_duplicate_attribute_cleanup(ctx, dry_run, batch_size, max_batches):
+        """
+        Merge duplicate attributes (same name, dimension and scope) into
+        the oldest of each set, a batch of sets at a time, committing
+        after each batch so tResourceAttr is not locked for long.
+
+        Args:
+            dry_run (char): 'Y' to report the duplicates and the number of
+                rows which would change, without changing anything.
+            batch_size (int): The number of sets of duplicates per batch
+            max_batches (int): Stop after this many batches. Call again to
+                carry on. Leave empty to process everything.
+
+        Returns:
+            dict: A report of the job: the number of sets of duplicates found
+                and processed, whether the job is complete, the rows changed
+                (or which would be changed) by type, and the sets processed.
+        """
+        return dedupe.delete_duplicate_attributes(dry_run=dry_run=='Y',
+                                                  batch_size=batch_size,
+                                                  max_batches=max_batches,
+                                                  **ctx.in_header.__dict__)
+
+    @rpc(Integer(default=None),
+         Unicode(pattern="['YN']", default='N'),
+         Integer(default=1000),
+         Integer(default=None),
+         _returns=AnyDict)
+    def run_duplicate_resourceattribute_cleanup(ctx, network_id, dry_run, batch_size, max_batches):
+        """
+        Find resources with several attributes of the same name, and remove
+        the ones not used by the resource's types, moving their data to the
+        one which is. Done a batch of resources at a time, committing after
+        each batch.
+
+        Args:
+            network_id (int): Only clean up this network. Leave empty to clean
+                up the input attributes of every network.
+            dry_run (char): 'Y' to report the duplicates and the number of
+                rows which would change, without changing anything.
+            batch_size (int): The number of sets of duplicates per batch
+            max_batches (int): Stop after this many batches. Call again to
+                carry on. Leave empty to process everything.
+
+        Returns:
+            dict: A report of the job, as for run_duplicate_attribute_cleanup.
+                Each set lists the resource attribute kept, and the ones merged,
+                deleted or left for the user to deal with as they have data.
+        """
+        return dedupe.delete_duplicate_resourceattributes(network_id=network_id,
+                                                          dry_run=dry_run=='Y',
+                                                          batch_size=batch_size,
+                                                          max_batches=max_batches,
+                                                          **ctx.in_header.__dict__)
@@ -37,6 +37,7 @@ from hydra_base.exceptions import HydraError
 import six
 
 from hydra_base.lib.objects import JSONObject, Dataset
+from ..lib import metadatacache
 
 NS = "server.complexmodels"
 log = logging.getLogger(__name__)
@@ -222,13 +223,23 @@ class Dataset(HydraComplexModel):
         self.metadata = None
 
         if include_metadata is True:
-            if isinstance(parent.metadata, dict):
+            #Check the metadata cache first, so the metadata of ORM datasets
+            #is not lazy-loaded one dataset at a time.
+            cached_metadata = None
+            if parent.id is not None:
+                cached_metadata = metadatacache.get_cached_metadata(parent.id, parent.hash)
+
+            if cached_metadata is not None:
+                self.metadata = json.dumps(cached_metadata)
+            elif isinstance(parent.metadata, dict):
                 self.metadata = json.dumps(parent.metadata)
             elif hasattr(parent, 'metadata') and parent.metadata is not None:
                 metadata = {}
                 if parent.metadata:
                     for m in parent.metadata:
                         metadata[m.key] = str(m.value)
+                if parent.id is not None:
+                    metadatacache.set_cached_metadata(parent.id, metadata, parent.hash)
                 self.metadata = json.dumps(metadata)
 
     def parse_value(self):
@@ -354,6 +365,28 @@ class DatasetCollection(HydraComplexModel):
         self.items = [DatasetCollectionItem(d) for d in parent.items]
         self.cr_date = str(parent.cr_date)
 
+class DatasetSearchResult(HydraComplexModel):
+    """
+    - **datasets**    SpyneArray(Dataset)
+    - **next_cursor** Integer(default=None) # Pass as after_id to get the next page. None on the last page.
+    - **count**       Integer(default=None) # Only set when counting
+    """
+    _type_info = [
+        ('datasets',    SpyneArray(Dataset)),
+        ('next_cursor', Integer(default=None)),
+        ('count',       Integer(default=None)),
+    ]
+
+    def __init__(self, datasets=None, next_cursor=None, count=None):
+        super(DatasetSearchResult, self).__init__()
+
+        if datasets is None:
+            datasets = []
+
+        self.datasets    = [Dataset(d) for d in datasets]
+        self.next_cursor = next_cursor
+        self.count       = count
+
 class Attr(HydraComplexModel):
     """
        - **id** Integer(default=None)
@@ -1897,3 +1930,27 @@ class Dimension(HydraComplexModel):
         self.units = [Unit(u) for u in parent.units]
         self.description = parent.description
         self.project_id = parent.project_id
+
+class UnitsCatalogue(HydraComplexModel):
+    """
+        All the dimensions, with their units.
+       - **version** Unicode
+       - **changed** Unicode(pattern='[YN]') # 'N' if the client's version is current, in which case dimensions is empty.
+       - **dimensions** SpyneArray(Dimension)
+    """
+    _type_info = [
+        ('version', Unicode),
+        ('changed', Unicode(pattern='[YN]', default='Y')),
+        ('dimensions', SpyneArray(Dimension)),
+    ]
+
+    def __init__(self, version=None, dimensions=None):
+        super(UnitsCatalogue, self).__init__()
+
+        self.version = version
+        if dimensions is None:
+            self.changed = 'N'
+            self.dimensions = []
+        else:
+            self.changed = 'Y'
+            self.dimensions = [Dimension(d) for d in dimensions]
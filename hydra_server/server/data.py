@@ -17,9 +17,11 @@ from spyne.model.primitive import Integer, Integer32, Boolean, Unicode, AnyDict,
 from spyne.model.complex import Array as SpyneArray
 from spyne.decorator import rpc
 from .complexmodels import Dataset,\
-        DatasetCollection
+        DatasetCollection,\
+        DatasetSearchResult
 
 from hydra_base.lib import data
+from ..lib import datasearch, dataingest, dataslice, metadatacache
 
 import json
 
@@ -86,6 +88,7 @@ class DataService(HydraService):
             ResourceNotFoundError: If none of the requested datasets were found.
         """
         datasets = data.get_datasets(dataset_ids, **ctx.in_header.__dict__)
+        metadatacache.prefetch(datasets)
         ret_datasets = [Dataset(d) for d in datasets]
         return ret_datasets
 
@@ -108,6 +111,43 @@ class DataService(HydraService):
 
         return Dataset(dataset_i)
 
+    @rpc(Integer,
+         Unicode(min_occurs=0, max_occurs='unbounded'), #columns
+         Unicode, #start
+         Unicode, #end
+         Unicode, #index slice
+         _returns=Dataset)
+    def get_dataset_slice(ctx, dataset_id, columns, start, end, index_slice):
+        """
+        Get part of a large array, dataframe or timeseries dataset, rather than
+        the whole value. The decoded value is cached on the server, so getting
+        several slices of the same dataset is cheap.
+
+        Args:
+            dataset_id  (int): The ID of the requested dataset
+            columns     (List(string)): Dataframes and timeseries only. The columns to return.
+            start       (string): Timeseries only. Return values from this time onwards.
+            end         (string): Timeseries only. Return values up to and including this time.
+            index_slice (string): For arrays, a numpy-style index, such as '0:10, 2'.
+                                  For dataframes and timeseries, a range of rows, such as '0:10'.
+
+        Returns:
+            Dataset: The dataset complex model, with only the requested part of the value.
+            Scalars and descriptors are returned whole.
+
+        Raises:
+            ResourceNotFoundError: If the dataset does not exist.
+        """
+
+        dataset = dataslice.get_dataset_slice(dataset_id,
+                                              ctx.in_header.user_id,
+                                              columns=columns,
+                                              start=start,
+                                              end=end,
+                                              index_slice=index_slice)
+
+        return Dataset(dataset)
+
     @rpc(Integer, _returns=Dataset)
     def clone_dataset(ctx, dataset_id):
         """
@@ -203,6 +243,78 @@ class DataService(HydraService):
 
         return cm_datasets
 
+    @rpc(Unicode, Unicode, Unicode,
+         Integer, Integer, Unicode, Unicode,
+         Integer, Integer, Unicode,
+         Unicode(pattern='[YN]', default='N'), #include metadata flag
+         Unicode(pattern='[YN]', default='N'), # include value flag
+         Integer(default=None), Integer(default=2000), #cursor, page size
+         Unicode(pattern='[YN]', default='N'), #count only flag
+         _returns=DatasetSearchResult)
+    def search_datasets_by_cursor(ctx,
+                name,
+                collection_name,
+                data_type,
+                unit_id,
+                scenario_id,
+                metadata_name,
+                metadata_val,
+                attr_id,
+                type_id,
+                unconnected,
+                inc_metadata,
+                inc_val,
+                after_id,
+                page_size,
+                count_only):
+        """
+        Search for datasets that satisfy the criteria specified, one page at a time.
+        Datasets are returned in ID order. To get the next page, pass the
+        'next_cursor' of the result as 'after_id'. Unlike search_datasets,
+        the time taken to retrieve a page does not depend on how deep the page is.
+
+        Args:
+            name            (string) : The name of the dataset
+            collection_name (string) : Search for datsets in a collection with this name
+            data_type       (string) : 'scalar', 'descriptor', 'array', 'timeseries'
+            unit_id         (int)    : Datasets with this unit.
+            scenario_id     (int)    : Datasets in this scenraio
+            metadata_name   (string) : Datasets that have this metadata key (exact match)
+            metadata_val    (string) : Datasets that have this metadata value (exact match)
+            attr_id         (int)    : Datasts that are associated with this attribute via resource scenario & resource attribute
+            type_id         (int)    : Datasets that are associated with this type via resource scenario -> resource attribute -> attribute -> type
+            unconnected     (char)   : Datasets that are not in any scenarios
+            inc_metadata    (char) (default 'N')   : Return metadata with retrieved datasets.
+            inc_val         (char) (default 'N')  : Include the value with the dataset. 'Y' gives a performance hit
+            after_id        (int)    : Return datasets with an ID greater than this. Leave empty for the first page.
+            page_size       (int)    : Return this number of datasets in one go. default is 2000.
+            count_only      (char) (default 'N') : Return only the number of matching datasets, in 'count'.
+
+        Returns:
+            DatasetSearchResult: The datasets in the page and the cursor for the next one,
+            or just the count if count_only is 'Y'.
+
+        """
+        datasets, next_cursor, count = datasearch.search_datasets(
+                                     ctx.in_header.user_id,
+                                     dataset_name=name,
+                                     collection_name=collection_name,
+                                     data_type=data_type,
+                                     unit_id=unit_id,
+                                     scenario_id=scenario_id,
+                                     metadata_key=metadata_name,
+                                     metadata_val=metadata_val,
+                                     attr_id=attr_id,
+                                     type_id=type_id,
+                                     unconnected=unconnected,
+                                     inc_metadata=inc_metadata,
+                                     inc_val=inc_val,
+                                     after_id=after_id,
+                                     page_size=page_size,
+                                     count_only=count_only == 'Y')
+
+        return DatasetSearchResult(datasets, next_cursor, count)
+
     @rpc(Integer(max_occurs="unbounded"), _returns=Unicode)
     def get_metadata(ctx, dataset_ids):
         """
@@ -225,6 +337,25 @@ class DataService(HydraService):
 
         return json.dumps(metadata_dict)
 
+    @rpc(SpyneArray(Integer32), _returns=AnyDict)
+    def get_metadata_bulk(ctx, dataset_ids):
+        """
+        Get the metadata of each of a list of datasets.
+
+        Args:
+            dataset_ids (List(int)): The list of dataset IDS that you want metadata for
+
+        Returns:
+            (dict): A dictionary keyed on dataset ID, with each value being a
+            dictionary of that dataset's metadata, keyed on metadata name.
+            Datasets with no metadata have an empty dictionary.
+        """
+
+        #The hashes are needed to spot entries which are out of date, as the
+        #metadata can be changed elsewhere (by hydra_base or another process).
+        return metadatacache.get_metadata(dataset_ids,
+                                          metadatacache.get_dataset_hashes(dataset_ids))
+
     @rpc(SpyneArray(Dataset), _returns=SpyneArray(Dataset))
     def bulk_insert_data(ctx, bulk_data):
         """
@@ -237,9 +368,29 @@ class DataService(HydraService):
                 List(int): A list of new dataset IDS
         """
         datasets = data.bulk_insert_data(bulk_data, **ctx.in_header.__dict__)
+        metadatacache.prefetch(datasets)
 
         return [Dataset(d) for d in datasets]
 
+    @rpc(SpyneArray(Dataset), _returns=SpyneArray(Integer))
+    def bulk_ingest_data(ctx, bulk_data):
+        """
+            Insert lots of datasets at once. Datasets which are already in
+            the DB (those with the same type, unit, value and metadata) are
+            re-used rather than inserted again, including repeats within
+            bulk_data, so this is much faster than bulk_insert_data for model
+            results with lots of identical values.
+
+            Args:
+                bulk_data (List(Dataset)): A list of Dataset complex models
+
+            Returns:
+                List(int): The dataset ID of each incoming dataset, in the same order as bulk_data
+        """
+        return dataingest.bulk_ingest_datasets(bulk_data,
+                                               user_id=ctx.in_header.user_id,
+                                               source=ctx.in_header.appname)
+
     @rpc(_returns=SpyneArray(DatasetCollection))
     def get_all_dataset_collections(ctx):
         """
@@ -450,6 +601,7 @@ class DataService(HydraService):
         """
         collection_datasets = data.get_collection_datasets(collection_id,
                                                  **ctx.in_header.__dict__)
+        metadatacache.prefetch(collection_datasets)
         ret_data = [Dataset(d) for d in collection_datasets]
 
         return ret_data
@@ -480,6 +632,7 @@ class DataService(HydraService):
                                               unit_id,
                                               metadata,
                                               **ctx.in_header.__dict__)
+        metadatacache.invalidate([id])
 
         return Dataset(updated_dataset)
 
@@ -497,6 +650,7 @@ class DataService(HydraService):
                 string: 'OK'
         """
         data.delete_dataset(dataset_id, **ctx.in_header.__dict__)
+        metadatacache.invalidate([dataset_id])
         return 'OK'
 
     @rpc(Integer, Unicode(min_occurs=0, max_occurs='unbounded'), _returns=AnyDict)
@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with HydraPlatform.  If not, see <http://www.gnu.org/licenses/>
 #
-from spyne.model.primitive import Unicode, Integer, AnyDict
+from spyne.model.primitive import Unicode, Integer, Double, AnyDict
 from spyne.model.complex import Array as SpyneArray
 from spyne.decorator import rpc
 from .complexmodels import Network,\
@@ -28,6 +28,7 @@ from .complexmodels import Network,\
     ResourceData
 import hydra_base as hb
 from .service import HydraService
+from ..lib import networkbulk, networkdata, networkupload, resourcebatch, spatial, subnetwork, topology, unitconversion
 import datetime
 import logging
 import json
@@ -70,6 +71,111 @@ class NetworkService(HydraService):
 
         return JSONObject(ret_net)
 
+    @rpc(AnyDict, _returns=Integer)
+    def begin_network_upload(ctx, net):
+        """
+        Start uploading a network which is too big to send with add_network.
+        The nodes, links, groups and scenarios are then sent in chunks with
+        upload_network_chunk, and the network is created with commit_network_upload.
+
+        Args:
+            net (dict): The network, as for add_network, without its nodes,
+                        links, resourcegroups or scenarios
+
+        Returns:
+            int: The ID of the upload
+
+        Raises:
+            HydraError: If the project is not found, or already has a network with the same name
+        """
+        return networkupload.begin_network_upload(net, **ctx.in_header.__dict__)
+
+    @rpc(Integer, Unicode(pattern="nodes|links|resourcegroups|scenarios"), Integer, SpyneArray(AnyDict),
+         _returns=AnyDict)
+    def upload_network_chunk(ctx, upload_id, kind, chunk_index, items):
+        """
+        Send a chunk of the nodes, links, resourcegroups or scenarios of a
+        network upload. Sending a chunk with the same kind and index again
+        replaces it, so a failed upload can be carried on by sending the
+        chunks which are missing, as shown by get_network_upload_status.
+
+        New resources and resource attributes have negative IDs, as in
+        add_network, which links, groups and scenario data in other chunks
+        can refer to. The data of a large scenario can be split over several
+        chunks, each part having the scenario's name.
+
+        Args:
+            upload_id (int): The upload, from begin_network_upload
+            kind (string): nodes, links, resourcegroups or scenarios
+            chunk_index (int): The position of this chunk among those of the same kind
+            items (List(dict)): The nodes, links, groups or scenarios in this chunk
+
+        Returns:
+            dict: The status of the upload, as get_network_upload_status
+
+        Raises:
+            ResourceNotFoundError: If the upload is not found
+        """
+        return networkupload.upload_network_chunk(upload_id,
+                                                  kind,
+                                                  chunk_index,
+                                                  items,
+                                                  **ctx.in_header.__dict__)
+
+    @rpc(Integer, _returns=AnyDict)
+    def get_network_upload_status(ctx, upload_id):
+        """
+        Get the chunks of a network upload which have been received.
+
+        Args:
+            upload_id (int): The upload, from begin_network_upload
+
+        Returns:
+            dict: 'status' (O if open, C if committed), 'network_id' (once
+                  committed) and 'chunks': the indexes of the chunks of each kind
+
+        Raises:
+            ResourceNotFoundError: If the upload is not found
+        """
+        return networkupload.get_network_upload_status(upload_id, **ctx.in_header.__dict__)
+
+    @rpc(Integer, _returns=AnyDict)
+    def commit_network_upload(ctx, upload_id):
+        """
+        Create the network from the chunks of an upload. If this fails,
+        nothing is saved and the chunks are kept, so it can be tried again
+        once the problem has been fixed.
+
+        Args:
+            upload_id (int): The upload, from begin_network_upload
+
+        Returns:
+            dict: The 'network_id' of the new network and the number of
+                  nodes, links, resourcegroups and scenarios in it
+
+        Raises:
+            ResourceNotFoundError: If the upload is not found
+            HydraError: If the upload has already been committed
+        """
+        return networkupload.commit_network_upload(upload_id, **ctx.in_header.__dict__)
+
+    @rpc(Integer, _returns=Unicode)
+    def delete_network_upload(ctx, upload_id):
+        """
+        Abandon a network upload, removing the chunks which have been sent.
+
+        Args:
+            upload_id (int): The upload, from begin_network_upload
+
+        Returns:
+            string: 'OK'
+
+        Raises:
+            ResourceNotFoundError: If the upload is not found
+        """
+        networkupload.delete_network_upload(upload_id, **ctx.in_header.__dict__)
+        return 'OK'
+
     @rpc(Integer,
          Unicode(pattern="[YN]", default='N'), #include attributes
          Unicode(pattern="[YN]", default='Y'), #include data
@@ -260,6 +366,8 @@ class NetworkService(HydraService):
                                      upd_groups,
                                      upd_scenarios,
                                      **ctx.in_header.__dict__)
+        topology.invalidate(net.id)
+        spatial.invalidate(net.id)
 
         return Network(net, include_attributes=False, include_data=True)
 
@@ -370,6 +478,98 @@ class NetworkService(HydraService):
             ret_group = ResourceGroup(group)
             return ret_group
 
+    @rpc(SpyneArray(Integer), Integer(min_occurs=0), _returns=SpyneArray(Node))
+    def get_nodes(ctx, node_ids, scenario_id):
+        """
+        Get several nodes in one call, with their data if a scenario_id is given.
+        This takes a fixed number of queries however many nodes there are,
+        rather than one call to get_node for each.
+
+        Args:
+            node_ids (list(int)): The nodes to retrieve
+            scenario_id (int) (optional): Include this if you want to include data with the scenario
+
+        Returns:
+            list(complexmodels.Node): The nodes, in the order of node_ids
+
+        Raises:
+            ResourceNotFoundError: If any of the nodes or the scenario is not found
+
+        """
+        nodes, rs_dict = resourcebatch.get_resources('NODE',
+                                                     node_ids,
+                                                     scenario_id,
+                                                     **ctx.in_header.__dict__)
+        ret_nodes = []
+        for node in nodes:
+            ret_node = Node(node)
+            for ra in ret_node.attributes:
+                if rs_dict.get(ra.id):
+                    ra.resourcescenario = ResourceScenario(rs_dict[ra.id])
+            ret_nodes.append(ret_node)
+
+        return ret_nodes
+
+    @rpc(SpyneArray(Integer), Integer(min_occurs=0), _returns=SpyneArray(Link))
+    def get_links(ctx, link_ids, scenario_id):
+        """
+        Get several links in one call, with their data if a scenario_id is given.
+
+        Args:
+            link_ids (list(int)): The links to retrieve
+            scenario_id (int) (optional): Include this if you want to include data with the scenario
+
+        Returns:
+            list(complexmodels.Link): The links, in the order of link_ids
+
+        Raises:
+            ResourceNotFoundError: If any of the links or the scenario is not found
+
+        """
+        links, rs_dict = resourcebatch.get_resources('LINK',
+                                                     link_ids,
+                                                     scenario_id,
+                                                     **ctx.in_header.__dict__)
+        ret_links = []
+        for link in links:
+            ret_link = Link(link)
+            for ra in ret_link.attributes:
+                if rs_dict.get(ra.id):
+                    ra.resourcescenario = ResourceScenario(rs_dict[ra.id])
+            ret_links.append(ret_link)
+
+        return ret_links
+
+    @rpc(SpyneArray(Integer), Integer(min_occurs=0), _returns=SpyneArray(ResourceGroup))
+    def get_resourcegroups(ctx, group_ids, scenario_id):
+        """
+        Get several resource groups in one call, with their data if a scenario_id is given.
+
+        Args:
+            group_ids (list(int)): The resource groups to retrieve
+            scenario_id (int) (optional): Include this if you want to include data with the scenario
+
+        Returns:
+            list(complexmodels.ResourceGroup): The groups, in the order of group_ids
+
+        Raises:
+            ResourceNotFoundError: If any of the groups or the scenario is not found
+
+        """
+        groups, rs_dict = resourcebatch.get_resources('GROUP',
+                                                      group_ids,
+                                                      scenario_id,
+                                                      **ctx.in_header.__dict__)
+        ret_groups = []
+        for group in groups:
+            ret_group = ResourceGroup(group)
+            for ra in ret_group.attributes:
+                if rs_dict.get(ra.id):
+                    ra.resourcescenario = ResourceScenario(rs_dict[ra.id])
+            ret_groups.append(ret_group)
+
+        return ret_groups
+
     @rpc(Integer, Unicode(pattern='[XY]'), _returns=Unicode)
     def delete_network(ctx, network_id, purge_data):
         """
@@ -387,6 +587,8 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the network is not found
         """
         hb.network.delete_network(network_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, Unicode(pattern="[YN]", default='Y'), _returns=Unicode)
@@ -406,6 +608,8 @@ class NetworkService(HydraService):
         """
         #check_perm('delete_network')
         hb.network.purge_network(network_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, Unicode(pattern="[AX]"),  _returns=Unicode)
@@ -426,6 +630,7 @@ class NetworkService(HydraService):
 
         #check_perm('edit_topology')
         hb.network.set_network_status(network_id, status.upper(), **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
 
@@ -446,6 +651,7 @@ class NetworkService(HydraService):
         """
         #check_perm('delete_network')
         hb.network.set_network_status(network_id, 'A', **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, _returns=NetworkExtents)
@@ -467,7 +673,7 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the network is not found.
 
         """
-        extents = hb.network.get_network_extents(network_id, **ctx.in_header.__dict__)
+        extents = spatial.get_network_extents(network_id, **ctx.in_header.__dict__)
 
         ne = NetworkExtents()
         ne.network_id = extents['network_id']
@@ -478,6 +684,86 @@ class NetworkService(HydraService):
 
         return ne
 
+    @rpc(Integer,
+         Double,
+         Double,
+         Double,
+         Double,
+         Unicode(pattern="[YN]", default='Y'),
+         _returns=AnyDict)
+    def get_resources_in_extent(ctx, network_id, min_x, min_y, max_x, max_y, include_links):
+        """
+        Get the nodes of a network inside a rectangle, such as the part of
+        the network shown on a map, without fetching the whole network.
+
+        Args:
+            network_id (int): The network to search
+            min_x (float): The left edge of the rectangle
+            min_y (float): The bottom edge of the rectangle
+            max_x (float): The right edge of the rectangle
+            max_y (float): The top edge of the rectangle
+            include_links (char) (Y or N): Also return the links with at least
+                                           one end inside the rectangle
+
+        Returns:
+            dict: 'nodes', with the id, name, x and y of each active node
+                  inside the rectangle and 'links', with the id, name,
+                  node_1_id and node_2_id of each active link.
+
+        Raises:
+            ResourceNotFoundError: If the network is not found
+        """
+        return spatial.get_resources_in_extent(network_id,
+                                               min_x,
+                                               min_y,
+                                               max_x,
+                                               max_y,
+                                               include_links in ('Y', None),
+                                               **ctx.in_header.__dict__)
+
+    @rpc(Integer,
+         SpyneArray(Integer), #group ids
+         SpyneArray(Integer), #type ids
+         SpyneArray(Double), #extent
+         Unicode(pattern="[YN]", default='N'), #include connected nodes
+         SpyneArray(Integer), #scenario ids
+         Unicode(pattern="[YN]", default='Y'), #include data
+         _returns=AnyDict)
+    def get_subnetwork(ctx, network_id, group_ids, type_ids, extent, include_connected, scenario_ids, include_data):
+        """
+        Get part of a network, such as a sub-catchment, without fetching the
+        whole network: the active nodes in some groups, with some types and/or
+        inside a rectangle, the active links between them and their data.
+        If more than one of group_ids, type_ids and extent is given, the nodes
+        must match all of them.
+
+        Args:
+            network_id (int): The network
+            group_ids (List(int)) (optional): Nodes in these groups (or their subgroups), or at either end of links in them
+            type_ids (List(int)) (optional): Nodes with these types
+            extent (List(float)) (optional): Nodes inside the rectangle min_x, min_y, max_x, max_y
+            include_connected (char) (Y or N): Also include the nodes linked to the chosen
+                                               nodes, so that all their links are returned
+            scenario_ids (List(int)) (optional): The scenarios to return. All of them if not specified.
+            include_data (char) (Y or N): Include the data of the subnetwork in each scenario
+
+        Returns:
+            dict: The network's id and name, and the 'nodes', 'links', 'resourcegroups' and
+                  'scenarios' of the subnetwork, as in get_network
+
+        Raises:
+            ResourceNotFoundError: If the network or a scenario is not found
+            HydraError: If none of group_ids, type_ids and extent are given
+        """
+        return subnetwork.get_subnetwork(network_id,
+                                         group_ids=group_ids,
+                                         type_ids=type_ids,
+                                         extent=extent,
+                                         include_connected=include_connected == 'Y',
+                                         scenario_ids=scenario_ids,
+                                         include_data=include_data in ('Y', None),
+                                         **ctx.in_header.__dict__)
+
     @rpc(Integer, Node, _returns=Node)
     def add_node(ctx, network_id, node):
 
@@ -516,6 +802,8 @@ class NetworkService(HydraService):
         """
 
         node_dict = hb.network.add_node(network_id, node, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_dict.id])
 
         new_node = Node(node_dict)
 
@@ -540,12 +828,17 @@ class NetworkService(HydraService):
         """
 
         node_s = hb.network.add_nodes(network_id, nodes, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_.id for node_ in node_s])
+        #Names are only unique among nodes with the same status, so keep the first
+        nodes_by_name = {}
+        for node_ in node_s:
+            nodes_by_name.setdefault(node_.node_name, node_)
         new_nodes=[]
         for node in nodes:
-            for node_ in node_s:
-                if(node.name==node_.node_name):
-                    new_nodes.append(Node(node_, include_attributes=True))
-                    break
+            node_ = nodes_by_name.get(node.name)
+            if node_ is not None:
+                new_nodes.append(Node(node_, include_attributes=True))
 
         return new_nodes
 
@@ -567,16 +860,49 @@ class NetworkService(HydraService):
 
         """
         link_s = hb.network.add_links(network_id, links, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
 
+        links_by_name = {}
+        for link_ in link_s:
+            links_by_name.setdefault(link_.link_name, link_)
         new_links=[]
         for link in links:
-            for link_ in link_s:
-                if(link.name==link_.link_name):
-                    new_links.append(Link(link_, include_attributes=True))
-                    break
+            link_ = links_by_name.get(link.name)
+            if link_ is not None:
+                new_links.append(Link(link_, include_attributes=True))
 
         return new_links
 
+    @rpc(Integer, SpyneArray(Node), SpyneArray(Link), _returns=AnyDict)
+    def add_nodes_and_links(ctx, network_id, nodes, links):
+        """
+        Add many nodes and links to a network at once. Links can refer to
+        the new nodes by negative temporary IDs, as in add_network, or to
+        nodes already in the network. Only the IDs are returned, so this
+        is much faster than add_nodes and add_links for large numbers of
+        nodes and links.
+
+        Args:
+            network_id (int):  The id of the network to receive the nodes and links
+            nodes (List(complexmodels.Node)): The nodes to be added
+            links (List(complexmodels.Link)): The links to be added
+
+        Returns:
+            dict: 'nodes' and 'links': a list with the temp_id, name and
+                  new id of each node and link, in the order they were sent.
+                  'resource_attributes': the temp_id and new id of each
+                  resource attribute which was sent with an ID.
+
+        Raises:
+            ResourceNotFoundError: If the network is not found
+            HydraError: If a name is used twice, or a link refers to a node
+                        which is not in the network
+        """
+        return networkbulk.add_nodes_and_links(network_id,
+                                               nodes,
+                                               links,
+                                               **ctx.in_header.__dict__)
+
 
     @rpc(Node, _returns=Node)
     def update_node(ctx, node):
@@ -625,6 +951,7 @@ class NetworkService(HydraService):
         """
 
         node_dict = hb.network.update_node(node, **ctx.in_header.__dict__)
+        spatial.nodes_changed(node_dict.network_id, [node_dict.id])
         updated_node = Node(node_dict)
 
         return updated_node
@@ -645,7 +972,10 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the node is not found
         """
         #check_perm('edit_topology')
+        network_id = spatial.get_node_network_id(node_id)
         hb.network.set_node_status(node_id, status.upper(), **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_id])
         return 'OK'
 
 
@@ -665,7 +995,10 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the node is not found
 
         """
+        network_id = spatial.get_node_network_id(node_id)
         hb.network.delete_node(node_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_id])
         return 'OK'
 
     @rpc(Integer, _returns=Unicode)
@@ -686,7 +1019,10 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the node is not found.
         """
         #check_perm('edit_topology')
+        network_id = spatial.get_node_network_id(node_id)
         hb.network.set_node_status(node_id, 'A', **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_id])
         return 'OK'
 
     @rpc(Integer, Unicode(pattern="[YN]", default='Y'), _returns=Unicode)
@@ -707,7 +1043,10 @@ class NetworkService(HydraService):
         Raises:
             ResourceNotFoundError: If the node is not found
         """
+        network_id = spatial.get_node_network_id(node_id)
         hb.network.delete_node(node_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
+        spatial.nodes_changed(network_id, [node_id])
         return 'OK'
 
     @rpc(Integer, Link, _returns=Link)
@@ -727,6 +1066,7 @@ class NetworkService(HydraService):
         """
 
         link_dict = hb.network.add_link(network_id, link, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         new_link = Link(link_dict)
 
         return new_link
@@ -745,11 +1085,75 @@ class NetworkService(HydraService):
         Raises:
             ResourceNotFoundError: If the link is not found
         """
+        network_id = topology.get_link_network_id(link.id)
         link_dict = hb.network.update_link(link, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         updated_link = Link(link_dict)
 
         return updated_link
 
+    @rpc(SpyneArray(AnyDict), _returns=SpyneArray(Integer))
+    def update_nodes(ctx, nodes):
+        """
+        Update many nodes in one go, such as moving them all after
+        re-projecting a network. Only the fields which are sent are
+        changed, so each node only needs its id and the fields to change.
+
+        .. code-block:: python
+
+            [{'id': 1039, 'x': 12.5, 'y': 3.0},
+             {'id': 1040, 'name': 'Node 2', 'status': 'X'}]
+
+        Args:
+            nodes (List(dict)): The id of each node, and any of name,
+                                description, x, y, layout and status
+
+        Returns:
+            List(int): The IDs of the updated nodes
+
+        Raises:
+            ResourceNotFoundError: If a node is not found
+            HydraError: If a field can't be updated, or a new name is already used
+        """
+        return networkbulk.update_nodes(nodes, **ctx.in_header.__dict__)
+
+    @rpc(SpyneArray(AnyDict), _returns=SpyneArray(Integer))
+    def update_links(ctx, links):
+        """
+        Update many links in one go. Only the fields which are sent are changed.
+
+        Args:
+            links (List(dict)): The id of each link, and any of name,
+                                description, layout and status
+
+        Returns:
+            List(int): The IDs of the updated links
+
+        Raises:
+            ResourceNotFoundError: If a link is not found
+            HydraError: If a field can't be updated, or a new name is already used
+        """
+        return networkbulk.update_links(links, **ctx.in_header.__dict__)
+
+    @rpc(SpyneArray(AnyDict), _returns=SpyneArray(Integer))
+    def update_groups(ctx, groups):
+        """
+        Update many resource groups in one go. Only the fields which are
+        sent are changed.
+
+        Args:
+            groups (List(dict)): The id of each group, and any of name,
+                                 description and status
+
+        Returns:
+            List(int): The IDs of the updated groups
+
+        Raises:
+            ResourceNotFoundError: If a group is not found
+            HydraError: If a field can't be updated, or a new name is already used
+        """
+        return networkbulk.update_groups(groups, **ctx.in_header.__dict__)
+
     @rpc(Integer, Unicode(pattern='[YN]'), _returns=Unicode)
     def delete_link(ctx, link_id, purge_data):
         """
@@ -766,7 +1170,9 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the link is not found
 
         """
+        network_id = topology.get_link_network_id(link_id)
         hb.network.delete_link(link_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, Unicode(pattern='[AX]'), _returns=Unicode)
@@ -785,7 +1191,9 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the link is not found.
 
         """
+        network_id = topology.get_link_network_id(link_id)
         hb.network.set_link_status(link_id, status_code, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, _returns=Unicode)
@@ -803,7 +1211,9 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the link is not found.
 
         """
+        network_id = topology.get_link_network_id(link_id)
         hb.network.set_link_status(link_id, 'A', **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, Unicode(pattern="[YN]", default='Y'), _returns=Unicode)
@@ -823,7 +1233,9 @@ class NetworkService(HydraService):
         Raises:
             ResourceNotFoundError: If the link is not found.
         """
+        network_id = topology.get_link_network_id(link_id)
         hb.network.delete_link(link_id, purge_data, **ctx.in_header.__dict__)
+        topology.invalidate(network_id)
         return 'OK'
 
     @rpc(Integer, ResourceGroup, _returns=ResourceGroup)
@@ -958,7 +1370,101 @@ class NetworkService(HydraService):
             ResourceNotFoundError: If the network is not found
 
         """
-        return hb.network.validate_network_topology(network_id, **ctx.in_header.__dict__)
+        return topology.validate_network_topology(network_id, **ctx.in_header.__dict__)
+
+    @rpc(Integer, _returns=SpyneArray(SpyneArray(Integer)))
+    def get_connected_components(ctx, network_id):
+        """
+        Find the groups of nodes in a network which are connected to each
+        other by links, ignoring the direction of the links.
+
+        Args:
+            network_id (int): The network to check
+
+        Returns:
+            List(List(int)): The IDs of the nodes in each group, largest group first
+
+        Raises:
+            ResourceNotFoundError: If the network is not found
+        """
+        return topology.get_connected_components(network_id, **ctx.in_header.__dict__)
+
+    @rpc(Integer,
+         Integer,
+         Unicode(pattern="downstream|upstream|both", default='downstream'),
+         Integer(min_occurs=0, max_occurs=1, default=None),
+         _returns=AnyDict)
+    def traverse_network(ctx, network_id, node_id, direction, max_depth):
+        """
+        Find the nodes which can be reached from a node by following links
+        downstream (from node_1 to node_2), upstream, or both.
+
+        Args:
+            network_id (int): The network of the node
+            node_id (int): The node to start from
+            direction (string): 'downstream', 'upstream' or 'both'
+            max_depth (int): The most links to follow from the node. No limit if not set.
+
+        Returns:
+            dict: 'node_ids' the nodes reached, starting with node_id, and
+                  'link_ids' the links followed to reach them
+
+        Raises:
+            ResourceNotFoundError: If the network is not found, or the node
+                                   is not an active node in it
+        """
+        return topology.traverse_network(network_id,
+                                         node_id,
+                                         direction or 'downstream',
+                                         max_depth,
+                                         **ctx.in_header.__dict__)
+
+    @rpc(Integer,
+         Integer,
+         Integer,
+         Unicode(pattern="[YN]", default='Y'),
+         _returns=AnyDict)
+    def get_shortest_path(ctx, network_id, from_node_id, to_node_id, directed):
+        """
+        Find the path with the fewest links between two nodes.
+
+        Args:
+            network_id (int): The network of the nodes
+            from_node_id (int): The node to start from
+            to_node_id (int): The node to finish at
+            directed (char) (Y or N): Only follow links from node_1 to node_2
+
+        Returns:
+            dict: 'node_ids' and 'link_ids' along the path. Empty if there is no path.
+
+        Raises:
+            ResourceNotFoundError: If the network is not found, or either node
+                                   is not an active node in it
+        """
+        path = topology.get_shortest_path(network_id,
+                                          from_node_id,
+                                          to_node_id,
+                                          directed in ('Y', None),
+                                          **ctx.in_header.__dict__)
+        if path is None:
+            return {}
+        return path
+
+    @rpc(Integer, _returns=SpyneArray(SpyneArray(Integer)))
+    def find_cycles(ctx, network_id):
+        """
+        Find the groups of nodes in a network which are on a cycle of links.
+
+        Args:
+            network_id (int): The network to check
+
+        Returns:
+            List(List(int)): The IDs of the nodes in each group
+
+        Raises:
+            ResourceNotFoundError: If the network is not found
+        """
+        return topology.find_cycles(network_id, **ctx.in_header.__dict__)
 
     @rpc(Integer, Integer, _returns=SpyneArray(ResourceSummary))
     def get_resources_of_type(ctx, network_id, type_id):
@@ -1251,6 +1757,49 @@ class NetworkService(HydraService):
 
         return return_ras
 
+    @rpc(Integer,
+         Integer,
+         SpyneArray(Unicode(pattern="NETWORK|NODE|LINK|GROUP")), #ref keys
+         SpyneArray(Integer), #attr ids
+         SpyneArray(Integer), #type ids
+         SpyneArray(Unicode), #fields
+         _returns=AnyDict)
+    def get_network_resource_data(ctx, network_id, scenario_id, ref_keys, attr_ids, type_ids, fields):
+        """
+        Get the data of the nodes, links, groups and/or the network itself in a
+        scenario, as rows of only the fields which are needed. This is much
+        lighter than get_all_node_data and friends, which return every field
+        of every resource attribute and resource scenario.
+
+        Args:
+            network_id (int): The network to search in
+            scenario_id (int): The scenario to search
+            ref_keys (List(string)) (optional): NETWORK, NODE, LINK and/or GROUP. All of them if not specified.
+            attr_ids (List(int)) (optional): Only return the data of these attributes
+            type_ids (List(int)) (optional): Only return the data of resources with these types
+            fields (List(string)) (optional): The fields in each row. Any of ref_key, ref_id,
+                resource_attr_id, attr_id, attr_name, attr_is_var, source, dataset_id,
+                type, unit_id, name, hash and value. Default ref_key, ref_id, attr_id and value.
+
+        Returns:
+            dict: 'fields', the fields, and 'rows', a list of the values of the fields for each resource scenario.
+
+        Raises:
+            ResourceNotFoundError: If the scenario is not found
+            HydraError: If the scenario is not in the network, or a field is not recognised
+
+        """
+        fields, rows = networkdata.iter_network_data(network_id,
+                                                     scenario_id,
+                                                     ref_keys=ref_keys,
+                                                     attr_ids=attr_ids,
+                                                     type_ids=type_ids,
+                                                     fields=fields,
+                                                     **ctx.in_header.__dict__)
+
+        return {'fields' : fields,
+                'rows'   : [list(row) for row in rows]}
+
     @rpc(Integer, Integer, _returns=SpyneArray(ResourceAttr))
     def get_all_resource_attributes_in_network(ctx, attr_id, network_id):
         """
@@ -1276,10 +1825,40 @@ class NetworkService(HydraService):
             raises:
                 ValidationError if the supplied unit is incompatible with the attribute's dimension
         """
-        res = hb.network.apply_unit_to_network_rs(
-            network_id,
-            unit_id,
-            attr_id,
-            scenario_id=scenario_id,
-            **ctx.in_header.__dict__)
+        unitconversion.apply_unit_to_network_rs(network_id,
+                                                unit_id,
+                                                attr_id,
+                                                scenario_id=scenario_id,
+                                                **ctx.in_header.__dict__)
         return 'OK'
+
+    @rpc(Integer, Integer, Integer, Integer,
+         Unicode(pattern='[YN]', default='N'),
+         Unicode(pattern='[YN]', default='N'),
+         _returns=AnyDict)
+    def bulk_apply_unit_to_network_rs(ctx, network_id, unit_id, attr_id, scenario_id, convert, dry_run):
+        """
+            Set the unit on all the datasets in a network which have the supplied
+            attribute, optionally converting their values to the new unit.
+            Datasets are shared, so the resource scenarios are pointed at new
+            datasets with the new unit rather than the datasets being changed.
+            args:
+                network_id (int): The network in which to operate
+                unit_id (int): The unit ID to set on the network's datasets
+                attr_id (int): The attribute ID
+                scenario_id (int) (optional): Supplied if only datasets in a
+                                              specific scenario are to be affected
+                convert (char) (default 'N'): 'Y' to convert the values from their current unit
+                dry_run (char) (default 'N'): 'Y' to only count what would change
+            returns:
+                dict: {'resource_scenarios': number changed, 'datasets': number changed, 'dry_run': 'Y' or 'N'}
+            raises:
+                ValidationError if the supplied unit is incompatible with the attribute's dimension
+        """
+        return unitconversion.apply_unit_to_network_rs(network_id,
+                                                       unit_id,
+                                                       attr_id,
+                                                       scenario_id=scenario_id,
+                                                       convert=convert == 'Y',
+                                                       dry_run=dry_run == 'Y',
+                                                       **ctx.in_header.__dict__)
@@ -31,6 +31,8 @@ from hydra_base.lib import scenario
 from .service import HydraService
 from hydra_base.lib.objects import JSONObject
 
+from ..lib import mappinggraph
+
 class ScenarioService(HydraService):
     """
         The scenario SOAP service
@@ -600,6 +602,34 @@ class ScenarioService(HydraService):
         else:
             return None
 
+    @rpc(Integer,
+         SpyneArray(Integer),
+         SpyneArray(Integer),
+         _returns=AnyDict)
+    def propagate_mapped_values(ctx, scenario_id, source_resource_attr_ids, target_scenario_ids):
+        """
+            Copy the values of a list of resource attributes in a scenario
+            to every resource attribute they are mapped to, including
+            through chains of mappings across several networks, in one go.
+
+            Args:
+                scenario_id (int): The scenario to take the values from.
+                    Targets in the same network are also written here.
+                source_resource_attr_ids (List(int)): The resource attributes to copy
+                target_scenario_ids (List(int)): (optional) The scenario to write to
+                    in each of the other networks. Targets in networks with no
+                    scenario here are skipped.
+
+            Returns:
+                dict: The number of target resource scenarios created, updated,
+                    deleted (where the source has no value) and unchanged, and
+                    the number of targets skipped.
+        """
+        return mappinggraph.propagate_mapped_values(scenario_id,
+                                                    source_resource_attr_ids,
+                                                    target_scenario_ids,
+                                                    **ctx.in_header.__dict__)
+
 
     @rpc(Integer,
          Integer,
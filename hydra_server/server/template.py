@@ -15,6 +15,7 @@
 #
 from spyne.model.complex import Array as SpyneArray
 from spyne.model.primitive import Integer, Integer32, Unicode, AnyDict
+from spyne.model.binary import ByteArray
 from spyne.decorator import rpc
 from .complexmodels import Template,\
 TemplateType,\
@@ -27,6 +28,8 @@ ValidationError
 from .service import HydraService
 from hydra_base.lib import template
 
+from ..lib import attrindex, typeassign, typeindex, templatecache, templateimport, validation
+
 class TemplateService(HydraService):
     """
         The template SOAP service
@@ -49,9 +52,40 @@ class TemplateService(HydraService):
         tmpl_i = template.import_template_xml(template_xml,
                                               allow_update=allow_update,
                                               **ctx.in_header.__dict__)
+        #Importing a template can add attributes
+        attrindex.invalidate()
+        templatecache.invalidate()
 
         return Template(tmpl_i)
 
+    @rpc(ByteArray, Unicode(pattern='[YN]'), Integer(default=None), _returns=AnyDict)
+    def import_template_xml_file(ctx, template_file, allow_update, batch_size):
+        """
+            Add or update the template, types and typeattrs described in an
+            XML file, as import_template_xml does. The file is parsed as it is
+            read, and the types and typeattrs are written in batches, so big
+            templates can be imported without holding the whole document in memory.
+
+            Returns:
+                A summary of the import: the template's ID and name, the number
+                of batches written and the number of types and typeattrs
+                added, updated and deleted.
+        """
+        if allow_update is None or allow_update.upper() == 'Y':
+            allow_update = True
+        else:
+            allow_update = False
+
+        summary = templateimport.import_template_xml(template_file,
+                                                     allow_update=allow_update,
+                                                     batch_size=batch_size,
+                                                     **ctx.in_header.__dict__)
+        #Importing a template can add attributes
+        attrindex.invalidate()
+        templatecache.invalidate()
+
+        return summary
+
     @rpc(AnyDict, Unicode(pattern='[YN]'), _returns=Template)
     def import_template_dict(ctx, template_dict, allow_update):
         """
@@ -70,6 +104,9 @@ class TemplateService(HydraService):
         tmpl_i = template.import_template_dict(template_dict,
                                                allow_update=allow_update,
                                               **ctx.in_header.__dict__)
+        #Importing a template can add attributes
+        attrindex.invalidate()
+        templatecache.invalidate()
 
         return Template(tmpl_i)
 
@@ -91,6 +128,9 @@ class TemplateService(HydraService):
         tmpl_i = template.import_template_json(template_dict,
                                                allow_update=allow_update,
                                               **ctx.in_header.__dict__)
+        #Importing a template can add attributes
+        attrindex.invalidate()
+        templatecache.invalidate()
 
         return Template(tmpl_i)
 
@@ -102,9 +142,9 @@ class TemplateService(HydraService):
 
             @returns A list of TypeSummary objects.
         """
-        types = template.get_matching_resource_types(resource_type,
-                                                     resource_id,
-                                                     **ctx.in_header.__dict__)
+        types = typeindex.get_matching_resource_types(resource_type,
+                                                      resource_id,
+                                                      **ctx.in_header.__dict__)
         ret_types = [TypeSummary(ts) for ts in types]
         return ret_types
 
@@ -119,12 +159,29 @@ class TemplateService(HydraService):
         function can also be used to update resources, when a resource type has
         changed.
         """
-        types = template.assign_types_to_resources(resource_types,
-                                                   template_id,
-                                                   **ctx.in_header.__dict__)
-        ret_val = [TemplateType(t) for t in types]
+        typeassign.assign_types_to_resources(resource_types,
+                                             template_id,
+                                             **ctx.in_header.__dict__)
+        types = typeassign.get_types(set(rt.type_id for rt in resource_types), template_id)
+        ret_val = [TemplateType(t) for t in types.values()]
         return ret_val
 
+    @rpc(SpyneArray(ResourceTypeDef),
+         Integer(default=None),
+         _returns=AnyDict)
+    def bulk_assign_types_to_resources(ctx, resource_types, template_id):
+        """
+            Assign new types to a list of resources, as assign_types_to_resources
+            does, adding the attributes each resource needs with bulk inserts.
+
+            Returns:
+                A summary: the number of resources, types assigned, and
+                resource attributes and resource scenarios added.
+        """
+        return typeassign.assign_types_to_resources(resource_types,
+                                                    template_id,
+                                                    **ctx.in_header.__dict__)
+
 
     @rpc(Integer, Unicode, Integer, _returns=TypeSummary)
     def assign_type_to_resource(ctx, type_id, resource_type, resource_id):
@@ -152,9 +209,9 @@ class TemplateService(HydraService):
             Given a template and a network, try to match up and assign
             all the nodes & links in the network to the types in the template
         """
-        template.apply_template_to_network(template_id,
-                                           network_id,
-                                           **ctx.in_header.__dict__)
+        typeindex.apply_template_to_network(template_id,
+                                            network_id,
+                                            **ctx.in_header.__dict__)
         return 'OK'
 
     @rpc(Integer, Integer, Unicode(pattern="[YN]", default='N'), _returns=Unicode)
@@ -190,6 +247,7 @@ class TemplateService(HydraService):
         """
         tmpl_i = template.add_template(tmpl,
                                       **ctx.in_header.__dict__)
+        templatecache.invalidate()
 
         return Template(tmpl_i)
 
@@ -199,6 +257,7 @@ class TemplateService(HydraService):
                                                    name,
                                                    description=description,
                                                    **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return Template(child_tmpl_i)
 
     @rpc(Template, _returns=Template)
@@ -208,6 +267,7 @@ class TemplateService(HydraService):
         """
         tmpl_i = template.update_template(tmpl,
                                            **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return Template(tmpl_i)
 
     @rpc(Integer, _returns=Template)
@@ -217,6 +277,7 @@ class TemplateService(HydraService):
         """
         template.activate_template(template_id,
                                            **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return 'OK'
 
     @rpc(Integer, _returns=Template)
@@ -226,6 +287,7 @@ class TemplateService(HydraService):
         """
         template.deactivate_template(template_id,
                                            **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return 'OK'
 
 
@@ -237,6 +299,7 @@ class TemplateService(HydraService):
         template.delete_template(template_id,
                                  delete_resourcetypes = delete_resourcetypes == 'Y',
                                            **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return 'OK'
 
     @rpc(Unicode(pattern='[YN]', default='Y'), Unicode(pattern='[YN]', default='N'), _returns=SpyneArray(Template))
@@ -246,7 +309,7 @@ class TemplateService(HydraService):
         """
         load_all = load_all != 'N' #it can be null or 'Y' etc
         include_inactive = include_inactive=='Y'
-        tmpls = template.get_templates(load_all=load_all, include_inactive=include_inactive, **ctx.in_header.__dict__)
+        tmpls = templatecache.get_templates(load_all=load_all, include_inactive=include_inactive, **ctx.in_header.__dict__)
         ret_templates = [Template(t) for t in tmpls]
 
         return ret_templates
@@ -261,6 +324,7 @@ class TemplateService(HydraService):
         template.remove_attr_from_type(type_id,
                                        attr_id,
                                        **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return success
 
     @rpc(Integer, _returns=Template)
@@ -268,8 +332,8 @@ class TemplateService(HydraService):
         """
             Get a specific resource template template, either by ID or name.
         """
-        tmpl_i = template.get_template(template_id,
-                                      **ctx.in_header.__dict__)
+        tmpl_i = templatecache.get_template(template_id,
+                                            **ctx.in_header.__dict__)
         tmpl = Template(tmpl_i)
 
         return tmpl
@@ -299,8 +363,8 @@ class TemplateService(HydraService):
         """
             Get a specific resource template, either by ID or name.
         """
-        tmpl_i = template.get_template_by_name(template_name,
-                                              **ctx.in_header.__dict__)
+        tmpl_i = templatecache.get_template_by_name(template_name,
+                                                    **ctx.in_header.__dict__)
         if tmpl_i is not None:
             tmpl = Template(tmpl_i)
 
@@ -316,6 +380,7 @@ class TemplateService(HydraService):
 
         tmpl_type = template.add_templatetype(templatetype,
                                               **ctx.in_header.__dict__)
+        templatecache.invalidate()
 
         return TemplateType(tmpl_type)
 
@@ -327,6 +392,7 @@ class TemplateService(HydraService):
 
         cloned_type = template.clone_templatetype(type_id,
                                                   **ctx.in_header.__dict__)
+        templatecache.invalidate()
 
         return TemplateType(cloned_type)
 
@@ -338,6 +404,7 @@ class TemplateService(HydraService):
         tmpl_type = template.add_child_templatetype(parent_id,
                                                     child_template_id,
                                                     **ctx.in_header.__dict__)
+        templatecache.invalidate()
 
         return TemplateType(tmpl_type)
 
@@ -351,6 +418,7 @@ class TemplateService(HydraService):
         """
         type_i = template.update_templatetype(templatetype,
                                               **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return TemplateType(type_i)
 
     @rpc(Integer,
@@ -364,6 +432,7 @@ class TemplateService(HydraService):
                                      delete_resourcetypes = delete_resourcetypes == 'Y',
                                      delete_children=delete_children == 'Y',
                                      **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return 'OK'
 
     @rpc(Integer, _returns=TemplateType)
@@ -371,8 +440,8 @@ class TemplateService(HydraService):
         """
             Get a specific resource type by ID.
         """
-        type_i = template.get_templatetype(type_id,
-                                           **ctx.in_header.__dict__)
+        type_i = templatecache.get_templatetype(type_id,
+                                                **ctx.in_header.__dict__)
         templatetype = TemplateType(type_i)
         return templatetype
 
@@ -382,9 +451,9 @@ class TemplateService(HydraService):
             Get a specific resource type by name.
         """
 
-        type_i = template.get_templatetype_by_name(template_id,
-                                                   type_name,
-                                                   **ctx.in_header.__dict__)
+        type_i = templatecache.get_templatetype_by_name(template_id,
+                                                        type_name,
+                                                        **ctx.in_header.__dict__)
         tmpltype = TemplateType(type_i)
 
         return tmpltype
@@ -398,6 +467,7 @@ class TemplateService(HydraService):
                                            **ctx.in_header.__dict__)
 
         ta = TypeAttr(new_typeattr)
+        templatecache.invalidate()
 
         return ta
 
@@ -406,8 +476,8 @@ class TemplateService(HydraService):
         """
             Add an typeattr to an existing type.
         """
-        typeattr = template.get_typeattr(typeattr_id,
-                                         **ctx.in_header.__dict__)
+        typeattr = templatecache.get_typeattr(typeattr_id,
+                                              **ctx.in_header.__dict__)
 
         ta = TypeAttr(typeattr)
 
@@ -424,6 +494,7 @@ class TemplateService(HydraService):
                                            **ctx.in_header.__dict__)
 
         ta = TypeAttr(updated_typeattr)
+        templatecache.invalidate()
 
         return ta
 
@@ -437,6 +508,7 @@ class TemplateService(HydraService):
                                                      **ctx.in_header.__dict__)
 
         ta = TypeAttr(child_typeattr)
+        templatecache.invalidate()
 
         return ta
 
@@ -449,13 +521,14 @@ class TemplateService(HydraService):
                                            **ctx.in_header.__dict__)
 
         ta = TypeAttr(updated_template_type)
+        templatecache.invalidate()
 
         return ta
 
     @rpc(Integer, Unicode, _returns=TypeAttr)
     def get_typeattr(ctx, typeattr_id, include_parent_data):
-        typeattr = template.get_typeattr(typeattr_id,
-                                         include_parent_data == 'Y',
+        typeattr = templatecache.get_typeattr(typeattr_id,
+                                              include_parent_data == 'Y',
                                            **ctx.in_header.__dict__)
 
         ta = TypeAttr(typeattr)
@@ -472,6 +545,7 @@ class TemplateService(HydraService):
                                            **ctx.in_header.__dict__)
 
         ta = TypeAttr(updated_template_type)
+        templatecache.invalidate()
 
         return ta
 
@@ -484,6 +558,7 @@ class TemplateService(HydraService):
         success = 'OK'
         template.delete_typeattr(typeattr_id,
                                  **ctx.in_header.__dict__)
+        templatecache.invalidate()
         return success
 
     @rpc(Integer, _returns=Unicode)
@@ -507,7 +582,7 @@ class TemplateService(HydraService):
             template is specified, (set as null), then validation will be made
             against every template on the network.
         """
-        error_dict = template.validate_attr(resource_attr_id, scenario_id, template_id, **ctx.in_header.__dict__)
+        error_dict = validation.validate_attr(resource_attr_id, scenario_id, template_id, **ctx.in_header.__dict__)
         if error_dict is None:
             return None
 
@@ -527,52 +602,38 @@ class TemplateService(HydraService):
 
     @rpc(SpyneArray(Integer32), Integer, Integer, _returns=SpyneArray(ValidationError))
     def validate_attrs(ctx, resource_attr_ids, scenario_id, template_id):
-        errors = []
-        error_dicts = template.validate_attrs(resource_attr_ids, scenario_id, template_id, **ctx.in_header.__dict__)
-        for error_dict in error_dicts:
-            error = ValidationError(
-                 ref_key = error_dict.get('ref_key'),
-                 ref_id  = error_dict.get('ref_id'),
-                 ref_name = error_dict.get('ref_name'),
-                 resource_attr_id = error_dict.get('resource_attr_id'),
-                 attr_id          = error_dict.get('attr_id'),
-                 attr_name        = error_dict.get('attr_name'),
-                 dataset_id       = error_dict.get('dataset_id'),
-                 scenario_id=error_dict.get('scenario_id'),
-                 template_id=error_dict.get('template_id'),
-                 error_text=error_dict.get('error_text')
-            )
-            errors.append(error)
-
-        return errors
+        error_dicts = validation.validate_attrs(resource_attr_ids, scenario_id, template_id, **ctx.in_header.__dict__)
+        #The errors are generated as the values are checked, so they must all be
+        #got here, where any exception can still roll back the transaction.
+        return [ValidationError(**error_dict) for error_dict in error_dicts]
 
     @rpc(Integer, Integer, _returns=SpyneArray(ValidationError))
     def validate_scenario(ctx, scenario_id, template_id):
-        errors = []
-        error_dicts = template.validate_scenario(scenario_id, template_id,
+        error_dicts = validation.validate_scenario(scenario_id, template_id,
                                                             **ctx.in_header.__dict__)
-        for error_dict in error_dicts:
-            error = ValidationError(
-             ref_key=error_dict.get('ref_key'),
-             ref_id=error_dict.get('ref_id'),
-             ref_name=error_dict.get('ref_name'),
-             resource_attr_id =error_dict.get('resource_attr_id'),
-             attr_id=error_dict.get('attr_id'),
-             attr_name=error_dict.get('attr_name'),
-             dataset_id=error_dict.get('dataset_id'),
-             scenario_id=error_dict.get('scenario_id'),
-             template_id=error_dict.get('template_id'),
-             error_text=error_dict.get('error_text')
-            )
-            errors.append(error)
+        #The errors are generated as the values are checked, so they must all be
+        #got here, where any exception can still roll back the transaction.
+        return [ValidationError(**error_dict) for error_dict in error_dicts]
 
-        return errors
+    @rpc(Integer, Integer, _returns=SpyneArray(ValidationError))
+    def validate_scenario_incremental(ctx, scenario_id, template_id):
+        """
+            Validate a scenario as validate_scenario does, but only check the
+            values which have changed, or whose data restrictions have changed,
+            since this was last called for the scenario and template.
+            All the errors which still apply are returned.
+        """
+        error_dicts = validation.validate_scenario_incremental(scenario_id, template_id,
+                                                               **ctx.in_header.__dict__)
+        return [ValidationError(**error_dict) for error_dict in error_dicts]
 
     @rpc(Integer, Integer, Integer(min_occurs=0, max_occurs=1), _returns=SpyneArray(Unicode))
     def validate_network(ctx, network_id, template_id, scenario_id):
-        errors = template.validate_network(network_id, template_id, scenario_id,
+        errors = validation.validate_network(network_id, template_id, scenario_id,
                                                             **ctx.in_header.__dict__)
-        return errors
+        #The errors are generated as the values are checked, so they must all be
+        #got here, where any exception can still roll back the transaction.
+        return [error for error in errors]
 
     @rpc(Integer, Integer, _returns=SpyneArray(Unicode))
     def check_type_compatibility(ctx, type_1_id, type_2_id):
@@ -586,18 +647,20 @@ class TemplateService(HydraService):
             Using the attributes of the resource, get all the
             types that this resource matches.
             args:
-                resource (a resource object (node, link etc), assumed to have a
-                        '.attributes' attribute)
+                resource (a resource object (node, link etc), with an
+                        'attributes' list, and optionally a 'resource_type'
+                        or 'ref_key' to only match types of that kind)
                 template_id: The ID of a template, which will filter the result to
                             just types in that template
             returns:
-                dict: keyed on the template name, with the
-                value being the list of type names which match the resources
-                attributes.
+                list: The types which match the resource's attributes.
         """
+        attr_ids = [ra['attr_id'] for ra in resource.get('attributes') or []]
+        resource_type = resource.get('resource_type', resource.get('ref_key'))
 
-        templatetypes = template.get_types_by_attr(resource,
-                                          template_id,
-                                          **ctx.in_header.__dict__)
+        templatetypes = typeindex.get_types_by_attr(attr_ids,
+                                                    resource_type,
+                                                    template_id,
+                                                    **ctx.in_header.__dict__)
 
         return [TemplateType(templatetype) for templatetype in templatetypes]
@@ -21,8 +21,9 @@ from spyne.model.complex import Array as SpyneArray, ComplexModel
 from spyne.decorator import rpc
 from spyne.util.dictdoc import get_object_as_dict
 from .service import HydraService
-from .complexmodels import Unit, Dimension
+from .complexmodels import Unit, Dimension, UnitsCatalogue
 from hydra_base.lib import units
+from ..lib import unitconversion, unitcatalogue
 import json
 
 from hydra_base.lib.objects import JSONObject
@@ -40,10 +41,10 @@ class UnitService(HydraService):
         """
             Gets the dimension details and the list of all units assigned to the dimension.
         """
-        accept_null_dimension = do_accept_dimension_id_none == 'Y'
-        dimension = units.get_dimension(dimension_id,
-                                        do_accept_dimension_id_none=accept_null_dimension,
-                                        **ctx.in_header.__dict__)
+        if dimension_id is None and do_accept_dimension_id_none == 'Y':
+            return Dimension(units.get_empty_dimension())
+
+        dimension = unitcatalogue.get_dimension(dimension_id)
 
         return Dimension(dimension)
 
@@ -52,7 +53,7 @@ class UnitService(HydraService):
         """
             Gets the dimension details and the list of all units assigned to the dimension.
         """
-        dimension = units.get_dimension_by_name(dimension_name, **ctx.in_header.__dict__)
+        dimension = unitcatalogue.get_dimension_by_name(dimension_name)
 
         return Dimension(dimension)
 
@@ -61,7 +62,7 @@ class UnitService(HydraService):
         """
             Gets a list of all physical dimensions available on the server.
         """
-        dim_list = units.get_dimensions(**ctx.in_header.__dict__)
+        dim_list = unitcatalogue.get_index().dimensions
         return [Dimension(d) for d in dim_list]
 
 
@@ -80,7 +81,7 @@ class UnitService(HydraService):
         """
             Gets the Unit details
         """
-        unit = units.get_unit(unit_id, **ctx.in_header.__dict__)
+        unit = unitcatalogue.get_unit(unit_id)
 
         return Unit(unit)
 
@@ -89,7 +90,7 @@ class UnitService(HydraService):
         """
             Gets the Unit details
         """
-        unit = units.get_unit_by_abbreviation(unit_abbr, **ctx.in_header.__dict__)
+        unit = unitcatalogue.get_unit_by_abbreviation(unit_abbr)
 
         return Unit(unit)
 
@@ -98,7 +99,7 @@ class UnitService(HydraService):
         """
             Get a list of all units corresponding to a physical dimension.
         """
-        unit_list = units.get_units(**ctx.in_header.__dict__)
+        unit_list = unitcatalogue.get_index().units
         return [Unit(u) for u in unit_list]
 
     @rpc(Integer, Unicode(pattern="[YN]"), _returns=Dimension)
@@ -112,10 +113,10 @@ class UnitService(HydraService):
             the function returns a Dimension with id None
             (unit_id can be none in some cases)
         """
-        accept_null_unit = do_accept_unit_id_none == 'Y'
-        unit_dimension = units.get_dimension_by_unit_id(unit_id,
-            do_accept_unit_id_none=accept_null_unit,
-            **ctx.in_header.__dict__)
+        if unit_id is None and do_accept_unit_id_none == 'Y':
+            return Dimension(units.get_empty_dimension())
+
+        unit_dimension = unitcatalogue.get_dimension_by_unit_id(unit_id)
         return Dimension(unit_dimension)
 
     @rpc(Unicode, _returns=Dimension)
@@ -133,10 +134,30 @@ class UnitService(HydraService):
             Raises:
                 HydraError if the unit is not found, or multiple dimensions are found
         """
-        unit_dimension = units.get_dimension_by_unit_measure_or_abbreviation(
-            measure_or_unit_abbreviation,
-            **ctx.in_header.__dict__)
+        unit_dimension = unitcatalogue.get_dimension_by_unit_measure_or_abbreviation(
+            measure_or_unit_abbreviation)
         return Dimension(unit_dimension)
+
+    @rpc(Unicode, _returns=UnitsCatalogue)
+    def get_units_catalogue(ctx, if_version):
+        """
+            Get all the dimensions and their units, with the version of the
+            catalogue. Units and dimensions only change when they are added,
+            updated or deleted, so clients can keep the catalogue and pass its
+            version as 'if_version' next time. If nothing has changed since,
+            'changed' is 'N' and no dimensions are returned.
+
+            Args:
+                if_version (string): The version the client already has. Optional.
+            Returns:
+                UnitsCatalogue
+        """
+        index, version = unitcatalogue.catalogue.get_with_version()
+
+        if if_version is not None and if_version == version:
+            return UnitsCatalogue(version)
+
+        return UnitsCatalogue(version, index.dimensions)
     """
     +---------------------------------------+
     | DIMENSION FUNCTIONS - ADD - DEL - UPD |
@@ -149,6 +170,7 @@ class UnitService(HydraService):
         done.
         """
         result = units.add_dimension(JSONObject(dimension), **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return Dimension(result)
 
     @rpc(Dimension, _returns=Dimension)
@@ -158,6 +180,7 @@ class UnitService(HydraService):
             servers list of dimensions.
         """
         result = units.update_dimension(JSONObject(dimension), **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return Dimension(result)
 
     @rpc(Integer, _returns=Boolean)
@@ -166,6 +189,7 @@ class UnitService(HydraService):
         that deleting works only for dimensions listed in the custom file.
         """
         result = units.delete_dimension(dimension_id, **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return 'OK'
     """
     +----------------------------------+
@@ -198,6 +222,7 @@ class UnitService(HydraService):
         # Convert the complex model into a dict
         #unitdict = get_object_as_dict(unit, Unit)#
         result = units.add_unit(JSONObject(unit), **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return result
 
 
@@ -207,6 +232,7 @@ class UnitService(HydraService):
         not that units built in to the library can not be updated.
         """
         result = units.update_unit(JSONObject(unit), **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return Unit(result)
 
 
@@ -215,6 +241,7 @@ class UnitService(HydraService):
         """Delete a unit from the custom unit collection.
         """
         result = units.delete_unit(unit_id, **ctx.in_header.__dict__)
+        unitcatalogue.invalidate()
         return 'OK'
 
 
@@ -234,8 +261,8 @@ class UnitService(HydraService):
         """
         if not isinstance(values, list):
             values = [values]
-        return_array = units.convert_units(values, unit1, unit2)
-        return return_array
+        return_array = unitconversion.convert_values(values, unit1, unit2)
+        return return_array.tolist()
 
     @rpc(Decimal,Unicode, Unicode, _returns=SpyneArray(Decimal))
     def convert_unit(ctx, value, unit1, unit2):
@@ -248,8 +275,8 @@ class UnitService(HydraService):
             >>> cli.service.convert_units(20.0, 'm', 'km')
             0.02
         """
-        values_to_return = units.convert_units(value, unit1, unit2, **ctx.in_header.__dict__)
-        return values_to_return
+        values_to_return = unitconversion.convert_values([value], unit1, unit2)
+        return values_to_return.tolist()
 
     @rpc(Unicode, Unicode, _returns=Boolean)
     def check_consistency(ctx, unit, dimension):
@@ -278,4 +305,16 @@ class UnitService(HydraService):
         """Convert a whole dataset (specified by 'dataset_id' to new unit
         ('to_unit').
         """
-        return units.convert_dataset(dataset_id, to_unit, **ctx.in_header.__dict__)
+        return unitconversion.convert_datasets([dataset_id],
+                                               to_unit,
+                                               user_id=ctx.in_header.user_id)[0]
+
+    @rpc(SpyneArray(Integer), Unicode, _returns=SpyneArray(Integer))
+    def convert_datasets(ctx, dataset_ids, to_unit):
+        """Convert several datasets to a new unit ('to_unit') at once.
+        Conversion always creates new datasets, so this returns the ID of
+        the converted dataset for each dataset, in the same order as dataset_ids.
+        """
+        return unitconversion.convert_datasets(dataset_ids,
+                                               to_unit,
+                                               user_id=ctx.in_header.user_id)
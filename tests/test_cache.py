@@ -0,0 +1,109 @@
+#Tests of the process-wide caches, and of invalidating them when a request is committed or rolled back
+import pytest
+
+from hydra_server.lib import cache
+from hydra_server.lib.cache import LRUCache, Catalogue, VersionedCache
+
+@pytest.fixture(autouse=True)
+def no_pending_callbacks():
+    #Start and end each test as if no request were in progress
+    cache.discard_pending_updates()
+    cache.run_pending_invalidations()
+    yield
+    cache.discard_pending_updates()
+    cache.run_pending_invalidations()
+
+def commit():
+    #What the server does once a request's transaction is committed
+    cache.run_pending_invalidations()
+
+def rollback():
+    #What the server does when a request fails
+    cache.discard_pending_updates()
+    cache.run_pending_invalidations()
+
+def test_invalidate_runs_now_and_after_commit():
+    calls = []
+    cache.invalidate_after_commit(lambda: calls.append('invalidate'))
+    assert calls == ['invalidate']
+
+    commit()
+    assert calls == ['invalidate', 'invalidate']
+
+    #Callbacks only run for the request which registered them
+    commit()
+    assert calls == ['invalidate', 'invalidate']
+
+def test_invalidate_runs_after_rollback():
+    #A rolled back request may still have reloaded the cache with its own changes
+    calls = []
+    cache.invalidate_after_commit(lambda: calls.append('invalidate'))
+
+    rollback()
+    assert calls == ['invalidate', 'invalidate']
+
+def test_update_runs_only_after_commit():
+    calls = []
+    cache.update_after_commit(lambda: calls.append('update'))
+    assert calls == []
+
+    commit()
+    assert calls == ['update']
+
+def test_update_discarded_on_rollback():
+    calls = []
+    cache.update_after_commit(lambda: calls.append('update'))
+
+    rollback()
+    assert calls == []
+
+    commit()
+    assert calls == []
+
+def test_catalogue_reloaded_after_commit():
+    loads = []
+    def loader():
+        loads.append(len(loads))
+        return len(loads)
+    catalogue = Catalogue(loader)
+
+    assert catalogue.get() == 1
+    version = catalogue.version
+
+    catalogue.invalidate()
+    #Another request reloads the catalogue before the write is committed
+    assert catalogue.get() == 2
+
+    commit()
+    assert catalogue.get() == 3
+    assert catalogue.version != version
+
+def test_versioned_cache_invalidate():
+    cached = VersionedCache(lambda key: [key])
+
+    item = cached.get(1)
+    assert cached.get(1) is item
+
+    version = cached.version
+    cached.invalidate()
+    assert cached.version != version
+    assert cached.get(1) is not item
+
+def test_lru_cache_drops_least_recently_used():
+    lru = LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+
+    #Using 'a' makes 'b' the least recently used
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+
+    assert 'b' not in lru
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert len(lru) == 2
+
+    assert lru.pop('a') == 1
+    assert lru.pop('a') is None
+    lru.clear()
+    assert len(lru) == 0
@@ -0,0 +1,45 @@
+#Tests of slicing decoded dataset values, and of the errors for bad values and slices
+import json
+
+import pytest
+
+from hydra_base.exceptions import HydraError
+
+from hydra_server.lib.dataslice import _decode_value, get_slice
+
+ARRAY = json.dumps([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+DATAFRAME = json.dumps({"a": {"0": 1, "1": 2, "2": 3}, "b": {"0": 10, "1": 20, "2": 30}})
+
+def test_array_slice():
+    decoded = _decode_value('array', ARRAY)
+
+    assert json.loads(get_slice(decoded, 'array', index_slice='0:2, 1')) == [2, 5]
+    assert json.loads(get_slice(decoded, 'array', index_slice='2, 2')) == 9
+    assert json.loads(get_slice(decoded, 'array')) == json.loads(ARRAY)
+
+def test_ragged_array():
+    with pytest.raises(HydraError):
+        _decode_value('array', json.dumps([[1, 2], [3]]))
+
+@pytest.mark.parametrize("index_slice", ["a:b", "0:1:2:3", "5, 5", "0, 0, 0"])
+def test_bad_array_slice(index_slice):
+    decoded = _decode_value('array', ARRAY)
+    with pytest.raises(HydraError):
+        get_slice(decoded, 'array', index_slice=index_slice)
+
+def test_dataframe_slice():
+    decoded = _decode_value('dataframe', DATAFRAME)
+
+    sliced = json.loads(get_slice(decoded, 'dataframe', columns=['b'], index_slice='1:'))
+    assert sliced == {"b": {"1": 20, "2": 30}}
+
+@pytest.mark.parametrize("index_slice", ["a:b", "0:1:2:3", "0:1, 2", "1"])
+def test_bad_dataframe_slice(index_slice):
+    decoded = _decode_value('dataframe', DATAFRAME)
+    with pytest.raises(HydraError):
+        get_slice(decoded, 'dataframe', index_slice=index_slice)
+
+def test_missing_dataframe_column():
+    decoded = _decode_value('dataframe', DATAFRAME)
+    with pytest.raises(HydraError):
+        get_slice(decoded, 'dataframe', columns=['c'])
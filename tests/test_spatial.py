@@ -0,0 +1,53 @@
+#Tests of the grid index of node coordinates used by get_resources_in_extent
+from decimal import Decimal
+
+from hydra_server.lib.spatial import GridIndex
+
+def brute_force(nodes, min_x, min_y, max_x, max_y, status='A'):
+    return sorted(node_id for node_id, x, y, node_status in nodes
+                  if node_status == status and x is not None and y is not None
+                  and min_x <= x <= max_x and min_y <= y <= max_y)
+
+def test_one_node_with_decimal_coordinates():
+    #The DB gives coordinates as Decimals, and the query bounds are floats
+    index = GridIndex(1, [(10, Decimal('1.5'), Decimal('2.5'), 'A')])
+
+    assert index.get_node_ids(0.0, 0.0, 3.0, 3.0) == [10]
+    assert index.get_node_ids(2.0, 0.0, 3.0, 3.0) == []
+    assert index.get_extents() == (1.5, 1.5, 2.5, 2.5)
+
+def test_float_bounds_on_decimal_grid():
+    nodes = [(i, Decimal(i % 20) / 4, Decimal(i // 20) / 3, 'A' if i % 7 else 'X')
+             for i in range(400)]
+    index = GridIndex(1, nodes)
+
+    for bounds in [(0.3, 0.2, 2.7, 4.1), (-1.0, -1.0, 100.0, 100.0), (1.25, 1.0, 1.25, 1.0)]:
+        float_nodes = [(i, float(x), float(y), s) for i, x, y, s in nodes]
+        assert index.get_node_ids(*bounds) == brute_force(float_nodes, *bounds)
+
+def test_nodes_without_coordinates():
+    index = GridIndex(1, [(1, None, None, 'A'), (2, Decimal('5'), None, 'A')])
+
+    assert index.get_node_ids(0.0, 0.0, 10.0, 10.0) == []
+    assert index.get_extents() == (5.0, 5.0, None, None)
+
+def test_set_and_remove_node():
+    index = GridIndex(1, [(1, Decimal('0'), Decimal('0'), 'A'),
+                          (2, Decimal('10'), Decimal('10'), 'A')])
+
+    index.set_node(3, Decimal('5'), Decimal('5'), 'A')
+    assert index.get_node_ids(4.0, 4.0, 6.0, 6.0) == [3]
+
+    #Moving a node on the edge of the network shrinks the extents
+    index.set_node(2, Decimal('6'), Decimal('6'), 'A')
+    assert index.get_extents() == (0.0, 6.0, 0.0, 6.0)
+
+    index.remove_node(3)
+    assert index.get_node_ids(4.0, 4.0, 6.0, 6.0) == [2]
+
+def test_status_filter():
+    index = GridIndex(1, [(1, Decimal('1'), Decimal('1'), 'A'),
+                          (2, Decimal('1'), Decimal('1'), 'X')])
+
+    assert index.get_node_ids(0.0, 0.0, 2.0, 2.0) == [1]
+    assert index.get_node_ids(0.0, 0.0, 2.0, 2.0, status='X') == [2]
@@ -0,0 +1,63 @@
+#Tests of the unit conversion factors and the permission check of apply_unit_to_network_rs
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from hydra_base.exceptions import HydraError, PermissionError
+from hydra_base.util import permissions
+
+from hydra_server.lib import unitconversion
+
+def make_unit(unit_id, dimension_id, lf, cf=0):
+    return SimpleNamespace(id=unit_id, dimension_id=dimension_id, lf=lf, cf=cf)
+
+def test_scale_factor():
+    km = make_unit(1001, 1, 1000)
+    m = make_unit(1002, 1, 1)
+
+    assert unitconversion.get_unit_conversion_factors(km, m) == (1000.0, 0.0)
+    assert unitconversion.get_unit_conversion_factors(m, km) == (0.001, 0.0)
+
+def test_offset_factor():
+    celsius = make_unit(1003, 2, 1, 273.15)
+    kelvin = make_unit(1004, 2, 1, 0)
+
+    scale, offset = unitconversion.get_unit_conversion_factors(celsius, kelvin)
+    assert scale == 1.0
+    assert offset == pytest.approx(273.15)
+
+def test_measure_factors():
+    #10^3 m -> m, as for a measure like '10^3 m'
+    m = make_unit(1005, 1, 1)
+    scale, offset = unitconversion.get_unit_conversion_factors(m, m, source_factor=1000.0)
+    assert (scale, offset) == (1000.0, 0.0)
+
+def test_different_dimensions():
+    m = make_unit(1006, 1, 1)
+    s = make_unit(1007, 3, 1)
+
+    with pytest.raises(HydraError):
+        unitconversion.get_unit_conversion_factors(m, s)
+
+def test_convert_value():
+    assert float(unitconversion.convert_value('scalar', '2', 1000.0, 0.0)) == 2000.0
+    assert json.loads(unitconversion.convert_value('array', '[1, 2]', 2.0, 1.0)) == [3.0, 5.0]
+    #Ragged arrays are converted item by item
+    assert json.loads(unitconversion.convert_value('array', '[[1], [2, 3]]', 2.0, 0.0)) == \
+        [[2.0], [4.0, 6.0]]
+
+    with pytest.raises(HydraError):
+        unitconversion.convert_value('scalar', 'not a number', 1.0, 0.0)
+
+def test_apply_unit_to_network_rs_needs_edit_network(monkeypatch):
+    checked = []
+    def check_perm(user_id, perm):
+        checked.append(perm)
+        raise PermissionError("User %s does not have permission %s"%(user_id, perm))
+    monkeypatch.setattr(permissions, 'check_perm', check_perm)
+
+    with pytest.raises(PermissionError):
+        unitconversion.apply_unit_to_network_rs(1, 1, 1, user_id=2)
+
+    assert checked == ['edit_network']